@@ -1,20 +1,37 @@
 # app.py
 import os
+from dotenv import load_dotenv
+load_dotenv()
+# 多进程部署时 Socket.IO 消息队列与共享状态通过 Redis 客户端的阻塞 socket 收发，
+# 需要在导入其他模块之前由 eventlet 打补丁，否则监听消息队列会阻塞整个进程
+if any(os.environ.get(name, '').startswith(('redis://', 'rediss://'))
+       for name in ('SOCKETIO_MESSAGE_QUEUE', 'SHARED_STATE_URL')):
+    import eventlet
+    eventlet.monkey_patch()
 import time
 import json
 import sys
 import shutil
+import stat
 import threading
+import functools
+import atexit
+import base64
+import random
+import secrets
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
 from pathlib import Path
 import sqlite3
 import logging
 from flask import (
     Flask, render_template, request, redirect, url_for, 
     flash, session, send_from_directory, send_file, jsonify, abort,
-    make_response
+    make_response, Response
 )
+from flask.json.provider import DefaultJSONProvider
 import importlib.metadata
+import click
 try:
     flask_version = importlib.metadata.version("flask")
 except importlib.metadata.PackageNotFoundError:
@@ -24,6 +41,14 @@ try:
     from PIL import Image
 except Exception:
     Image = None
+try:
+    import orjson
+except Exception:
+    orjson = None
+try:
+    import redis
+except Exception:
+    redis = None
 import tempfile
 import zipfile
 from flask_login import (
@@ -34,8 +59,12 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Length, EqualTo, Regexp
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+import socketio as python_socketio
+from sqlalchemy import create_engine, event, inspect, bindparam, select, Column, Integer, String, Text, DateTime, ForeignKey, func, or_, literal
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship, joinedload
 from markupsafe import escape, Markup
 import re
 import html
@@ -83,22 +112,744 @@ except Exception as e:
     logger = logging.getLogger('stellarsis')
 
 # 初始化数据库
-engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+def create_db_engine(uri):
+    """根据配置创建数据库引擎。
+    SQLite 使用文件连接池，并在每个新连接上设置 WAL、同步级别、忙等待与缓存等 PRAGMA。
+    """
+    cfg = app.config
+    if not uri.startswith('sqlite'):
+        return create_engine(uri,
+                             pool_size=cfg.get('DB_POOL_SIZE', 10),
+                             max_overflow=cfg.get('DB_MAX_OVERFLOW', 20),
+                             pool_timeout=cfg.get('DB_POOL_TIMEOUT', 30),
+                             pool_recycle=cfg.get('DB_POOL_RECYCLE', 3600),
+                             pool_pre_ping=True)
+
+    in_memory = uri in ('sqlite://', 'sqlite:///:memory:')
+    options = {
+        # 连接会在 eventlet 协程与后台线程之间复用
+        'connect_args': {'check_same_thread': False,
+                         'timeout': cfg.get('SQLITE_BUSY_TIMEOUT', 5000) / 1000.0},
+    }
+    if not in_memory:
+        options.update(pool_size=cfg.get('DB_POOL_SIZE', 10),
+                       max_overflow=cfg.get('DB_MAX_OVERFLOW', 20),
+                       pool_timeout=cfg.get('DB_POOL_TIMEOUT', 30),
+                       pool_recycle=cfg.get('DB_POOL_RECYCLE', 3600))
+    sqlite_engine = create_engine(uri, **options)
+
+    pragmas = [
+        ('busy_timeout', cfg.get('SQLITE_BUSY_TIMEOUT', 5000)),
+        ('synchronous', cfg.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+        ('cache_size', cfg.get('SQLITE_CACHE_SIZE', -64000)),
+    ]
+    if not in_memory:
+        pragmas.insert(0, ('journal_mode', cfg.get('SQLITE_JOURNAL_MODE', 'WAL')))
+        pragmas.append(('mmap_size', cfg.get('SQLITE_MMAP_SIZE', 0)))
+
+    @event.listens_for(sqlite_engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    return sqlite_engine
+
+
+engine = create_db_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+def checkpoint_database():
+    """将 WAL 日志合并回 SQLite 主数据库文件"""
+    if engine.dialect.name != 'sqlite':
+        return
+    conn = engine.raw_connection()
+    try:
+        conn.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception as e:
+        logger.error(f"WAL 检查点失败: {str(e)}")
+    finally:
+        conn.close()
 Base = declarative_base()
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 app.teardown_appcontext(lambda exc: db_session.remove())
 
-# 初始化Socket.IO
-socketio = SocketIO(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'], cors_allowed_origins='*')
+# ----------
+# JSON 编码
+# ----------
+
+# 安装了 orjson 且未在配置中关闭时使用它编码 Socket.IO 数据包与聊天消息
+json_backend = orjson if (orjson is not None and app.config.get('JSON_FAST_BACKEND', True)) else None
+
+
+def fast_dumps(obj):
+    """编码为紧凑的 UTF-8 JSON 字节串（不转义非 ASCII 字符）"""
+    if json_backend is not None:
+        try:
+            return json_backend.dumps(obj, option=json_backend.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # orjson 不支持的类型（如超过 64 位的整数）交给标准库处理
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def fast_loads(data):
+    if json_backend is not None:
+        return json_backend.loads(data)
+    return json.loads(data)
+
+
+class PreEncoded(dict):
+    """缓存自身 JSON 编码结果（UTF-8 字节串）的字典，用于聊天消息。
+
+    首次编码后结果随对象保存，广播、最近消息缓存、增量读取和历史接口共用同一份字节串；
+    编码后不应再修改内容，需要附加字段时使用 extend()。
+    """
+
+    __slots__ = ('_encoded',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encoded = None
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = fast_dumps(self)
+        return self._encoded
+
+    def extend(self, **fields):
+        """返回附加了字段的新对象，编码结果在本对象的字节串末尾拼接，不重新编码整条消息"""
+        extended = PreEncoded(self, **fields)
+        if fields and not any(key in self for key in fields):
+            extra = b''.join(b',' + fast_dumps(key) + b':' + fast_dumps(value) for key, value in fields.items())
+            extended._encoded = self.encoded[:-1] + extra + b'}'
+        return extended
+
+
+def contains_pre_encoded(obj, depth=2):
+    """obj 或其 depth 层以内的 dict / list 中是否包含 PreEncoded（消息只出现在事件参数或响应的浅层）"""
+    if isinstance(obj, PreEncoded):
+        return True
+    if isinstance(obj, dict):
+        values = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        values = obj
+    else:
+        return False
+    for value in values:
+        if isinstance(value, PreEncoded):
+            return True
+        if depth > 1 and isinstance(value, (dict, list, tuple)) and contains_pre_encoded(value, depth - 1):
+            return True
+    return False
+
+
+def encode_json(obj, default=None):
+    """编码为 UTF-8 JSON 字节串，PreEncoded 直接拼接缓存的编码结果。
+
+    default 用于处理其他不可直接编码的对象（与 json.dumps 的 default 参数相同）。
+    """
+    if isinstance(obj, PreEncoded):
+        return obj.encoded
+    if not contains_pre_encoded(obj):
+        if default is None:
+            return fast_dumps(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+    if isinstance(obj, dict):
+        return b'{' + b','.join([fast_dumps(str(key)) + b':' + encode_json(value, default)
+                                 for key, value in obj.items()]) + b'}'
+    return b'[' + b','.join([encode_json(value, default) for value in obj]) + b']'
+
+
+class SocketIOJSON:
+    """传给 Socket.IO 的 json 模块：事件参数中的 PreEncoded 消息不再重复编码"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return encode_json(obj).decode('utf-8')
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return fast_loads(data)
+
+
+class PreEncodedJSONProvider(DefaultJSONProvider):
+    """HTTP 响应中包含 PreEncoded 消息时直接拼接缓存的字节串，其余响应沿用 Flask 默认编码"""
+
+    def dumps(self, obj, **kwargs):
+        if contains_pre_encoded(obj):
+            return encode_json(obj, default=kwargs.get('default', self.default)).decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if contains_pre_encoded(obj):
+            return self._app.response_class(encode_json(obj, default=self.default) + b'\n', mimetype=self.mimetype)
+        return super().response(*args, **kwargs)
+
+
+app.json = PreEncodedJSONProvider(app)
+
+class LocalPubSubManager(python_socketio.PubSubManager):
+    """进程内的 Socket.IO 消息队列替身（SOCKETIO_MESSAGE_QUEUE=local://）。
+
+    与 Redis 消息队列走同一套发布/订阅流程（事件经 JSON 编码后投递给同一频道的所有服务器），
+    同一进程内创建的多个 Socket.IO 服务器共享频道，用于在单机上验证多进程模式。
+    """
+
+    name = 'local'
+    _channels = {}  # channel -> [队列, ...]
+    _channels_lock = threading.Lock()
+
+    def __init__(self, url='local://', channel='socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self._inbox = None
+
+    def _subscribe(self):
+        if self._inbox is None:
+            self._inbox = self.server.eio.create_queue()
+            with self._channels_lock:
+                self._channels.setdefault(self.channel, []).append(self._inbox)
+        return self._inbox
+
+    def initialize(self):
+        # 先登记队列再启动监听任务，避免丢失启动期间发布的消息
+        if not self.write_only:
+            self._subscribe()
+        super().initialize()
+
+    def _publish(self, data):
+        message = self.json.dumps(data)
+        with self._channels_lock:
+            inboxes = list(self._channels.get(self.channel, ()))
+        for inbox in inboxes:
+            inbox.put(message)
+
+    def _listen(self):
+        inbox = self._subscribe()
+        while True:
+            yield inbox.get()
+
+
+def socketio_queue_options():
+    """根据 SOCKETIO_MESSAGE_QUEUE 生成 SocketIO 的消息队列参数；未配置时为单进程模式"""
+    url = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    channel = app.config.get('SOCKETIO_CHANNEL', 'stellarsis')
+    if url.startswith('local://'):
+        return {'client_manager': LocalPubSubManager(url, channel=channel)}
+    return {'message_queue': url, 'channel': channel}
+
+
+# 初始化Socket.IO（配置了消息队列时，房间广播经消息队列送达所有工作进程）
+socketio = SocketIO(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'], cors_allowed_origins='*',
+                    json=SocketIOJSON, **socketio_queue_options())
+
+class ExpiringStore:
+    """带过期时间与容量上限的内存字典。
+
+    读取时忽略已过期的条目；超过 max_size 时按最近最少使用淘汰；
+    后台任务每 sweep_interval 秒清理一次过期条目，避免长期运行时无限增长。
+    """
+
+    def __init__(self, name, ttl, max_size, sweep_interval=60):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._sweeper_started = False
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= now:
+                del self._data[key]
+                self.expired += 1
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.time() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evicted += 1
+        if not self._sweeper_started:
+            self._sweeper_started = True
+            socketio.start_background_task(self._run)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def pop_where(self, predicate):
+        """删除 predicate(key, value) 为真的条目，返回删除数量"""
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def sweep(self):
+        """清理过期条目，返回清理数量"""
+        now = time.time()
+        with self._lock:
+            keys = [key for key, (expires_at, _) in self._data.items() if expires_at <= now]
+            for key in keys:
+                del self._data[key]
+            self.expired += len(keys)
+        return len(keys)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception(f'清理 {self.name} 失败')
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            approx_bytes = sys.getsizeof(self._data) + sum(
+                sys.getsizeof(key) + sys.getsizeof(item) + sys.getsizeof(item[1])
+                for key, item in self._data.items()
+            )
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'approx_bytes': approx_bytes,
+            }
+
+
+class RedisExpiringStore:
+    """ExpiringStore 的 Redis 实现，供多个工作进程共享（值以 JSON 保存）。
+
+    过期由 Redis 的键 TTL 负责，不需要清理任务；pop 在事务中读取并删除，
+    并发取出同一条目时只有一个调用方能拿到值。
+    """
+
+    def __init__(self, client, name, prefix, ttl):
+        self.client = client
+        self.name = name
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return default if value is None else fast_loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, fast_dumps(value), px=int((ttl or self.ttl) * 1000))
+
+    def pop(self, key, default=None):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        value, deleted = pipe.execute()
+        return default if value is None or not deleted else fast_loads(value)
+
+    def pop_where(self, predicate):
+        """删除 predicate(key, value) 为真的条目，返回删除数量（需要扫描全部键，只用于低频操作）"""
+        removed = 0
+        for raw_key in self.client.scan_iter(match=self.prefix + '*', count=500):
+            full_key = raw_key.decode('utf-8') if isinstance(raw_key, bytes) else raw_key
+            value = self.client.get(full_key)
+            if value is not None and predicate(full_key[len(self.prefix):], fast_loads(value)):
+                removed += self.client.delete(full_key)
+        return removed
+
+    def sweep(self):
+        return 0
+
+    def stats(self):
+        return {'backend': 'redis', 'ttl': self.ttl}
+
+
+class LocalSharedState:
+    """进程内的共享状态（单进程默认）：限流、验证码与在线状态保存在本进程内存中，无需跨进程同步"""
+
+    distributed = False
+
+    def expiring_store(self, name, ttl, max_size, sweep_interval=60):
+        return ExpiringStore(name, ttl=ttl, max_size=max_size, sweep_interval=sweep_interval)
+
+    def rate_limiter(self, burst, refill_rate, max_size, sweep_interval=60):
+        return SendRateLimiter(burst=burst, refill_rate=refill_rate, max_size=max_size, sweep_interval=sweep_interval)
+
+    def presence_registry(self, timeout):
+        return PresenceRegistry(timeout)
+
+    def start(self):
+        pass
+
+    def publish(self, name, args, kwargs=None):
+        pass
+
+    def stats(self):
+        return {'backend': 'local'}
+
+
+class RedisSharedState:
+    """基于 Redis 的共享状态，多个工作进程（通常在粘性负载均衡之后）共用。
+
+    限流、验证码与在线状态直接读写 Redis；各进程内的缓存（权限、用户资料、最近消息、
+    SSE 订阅者等）通过 @replicated 方法把调用经 Redis 频道广播给其他进程，由它们重放。
+    """
+
+    distributed = True
+
+    def __init__(self, client, prefix='stellarsis:'):
+        self.client = client
+        self.prefix = prefix
+        self.channel = prefix + 'replicate'
+        self.worker_id = secrets.token_hex(8)
+        self._listener_started = False
+        self.published = 0
+        self.received = 0
+        self.failures = 0
+
+    @classmethod
+    def from_url(cls, url, prefix='stellarsis:'):
+        if redis is None:
+            raise RuntimeError('SHARED_STATE_URL 使用 Redis，但未安装 redis 包（pip install redis）')
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def expiring_store(self, name, ttl, max_size, sweep_interval=60):
+        return RedisExpiringStore(self.client, name, f'{self.prefix}{name}:', ttl)
+
+    def rate_limiter(self, burst, refill_rate, max_size, sweep_interval=60):
+        return RedisSendRateLimiter(self.client, self.prefix + 'send_rate:', burst, refill_rate)
+
+    def presence_registry(self, timeout):
+        return RedisPresenceRegistry(self.client, self.prefix + 'presence:', timeout)
+
+    def start(self):
+        """启动订阅任务（首个请求或 Socket.IO 连接时调用）"""
+        if not self._listener_started:
+            self._listener_started = True
+            socketio.start_background_task(self._listen)
+
+    def publish(self, name, args, kwargs=None):
+        self.start()
+        try:
+            self.client.publish(self.channel, encode_json({
+                'origin': self.worker_id,
+                'name': name,
+                'args': list(args),
+                'kwargs': kwargs or {},
+            }))
+            self.published += 1
+        except Exception:
+            self.failures += 1
+            logger.exception(f'广播 {name} 到其他工作进程失败')
+
+    def _listen(self):
+        retry = 1
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                retry = 1
+                for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    data = fast_loads(message['data'])
+                    if data.get('origin') == self.worker_id:
+                        continue
+                    self.received += 1
+                    apply_replicated(data['name'], data.get('args', []), data.get('kwargs', {}))
+            except Exception:
+                self.failures += 1
+                logger.exception(f'共享状态订阅中断，{retry} 秒后重连')
+                socketio.sleep(retry)
+                retry = min(retry * 2, 60)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'worker_id': self.worker_id,
+            'published': self.published,
+            'received': self.received,
+            'failures': self.failures,
+        }
+
+
+def create_shared_state(url, prefix='stellarsis:'):
+    if not url or url == 'local':
+        return LocalSharedState()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSharedState.from_url(url, prefix)
+    raise ValueError(f'不支持的 SHARED_STATE_URL: {url}')
+
+
+shared_state = create_shared_state(app.config.get('SHARED_STATE_URL'), app.config.get('SHARED_STATE_PREFIX', 'stellarsis:'))
+if app.config.get('SOCKETIO_MESSAGE_QUEUE') and not shared_state.distributed:
+    logger.warning('已配置 SOCKETIO_MESSAGE_QUEUE，但 SHARED_STATE_URL 仍为 local：多进程时限流与在线状态不会共享')
+
+# @replicated 方法登记表：'对象名.方法名' -> 未包装的方法
+replicated_methods = {}
+
+
+def replicated(target):
+    """把模块级单例 target 的方法调用同步到其他工作进程。
+
+    本进程执行后经 shared_state 广播（参数需可 JSON 编码），其他进程收到后
+    对同名对象调用未包装的方法，不再继续转发。单进程模式下广播为空操作。
+    """
+    def decorator(method):
+        name = f'{target}.{method.__name__}'
+        replicated_methods[name] = method
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            if shared_state.distributed:
+                shared_state.publish(name, args, kwargs)
+            return result
+        return wrapper
+    return decorator
+
+
+def apply_replicated(name, args, kwargs):
+    """重放其他工作进程广播的 @replicated 调用"""
+    method = replicated_methods.get(name)
+    if method is None:
+        logger.warning(f'收到未知的同步调用: {name}')
+        return
+    target = globals()[name.split('.', 1)[0]]
+    with app.app_context():
+        method(target, *args, **kwargs)
+
+
+# 验证码存储
+# 键：user:{user_id} -> {'captcha_id': str, 'question': str, 'answer': int, 'expires': float,
+#                        'user_id': int, 'pending': dict}，每个用户最多一个未完成的验证码
+captcha_store = shared_state.expiring_store('captcha_store', ttl=300,
+                                            max_size=app.config.get('CAPTCHA_STORE_MAX_SIZE', 10000),
+                                            sweep_interval=app.config.get('MEMORY_STORE_SWEEP_INTERVAL', 60))
+
+
+class SendRateLimiter:
+    """按用户的令牌桶发送限流。
+
+    每个用户一个桶，容量为 burst，每秒补充 refill_rate 个令牌，发送一条消息消耗一个令牌；
+    桶空时才要求验证码。桶状态是 [tokens, updated_at] 小列表，读改写只涉及该用户自己的桶，
+    不再需要全局锁（并发竞争最多多放行一条，不影响防刷效果）。
+    空闲到已回满的桶由后台任务清理，桶数量不超过 max_size。
+    """
+
+    def __init__(self, burst, refill_rate, max_size, sweep_interval=60):
+        self.burst = float(burst)
+        self.refill_rate = float(refill_rate)
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._buckets = {}  # user_id -> [tokens, updated_at]
+        self._sweeper_started = False
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+
+    def consume(self, key, now=None):
+        """尝试消耗一个令牌，成功返回 True，桶空返回 False"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_size:
+                self._make_room(now)
+            bucket = self._buckets.setdefault(key, [self.burst, now])
+            if not self._sweeper_started:
+                self._sweeper_started = True
+                socketio.start_background_task(self._run)
+        tokens = min(self.burst, bucket[0] + max(0.0, now - bucket[1]) * self.refill_rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.limited += 1
+            return False
+        bucket[0] = tokens - 1
+        self.allowed += 1
+        return True
+
+    def _idle_full(self, bucket, now):
+        return bucket[0] + (now - bucket[1]) * self.refill_rate >= self.burst
+
+    def _make_room(self, now):
+        if self.sweep(now):
+            return
+        # 没有可清理的空闲桶时淘汰最早创建的桶
+        try:
+            self._buckets.pop(next(iter(self._buckets)), None)
+            self.evicted += 1
+        except (StopIteration, RuntimeError):
+            pass
+
+    def sweep(self, now=None):
+        """清理已回满的空闲桶（与新建桶等价），返回清理数量"""
+        now = time.monotonic() if now is None else now
+        keys = [key for key, bucket in list(self._buckets.items()) if self._idle_full(bucket, now)]
+        for key in keys:
+            self._buckets.pop(key, None)
+        return len(keys)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('清理发送限流桶失败')
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def stats(self):
+        return {
+            'size': len(self._buckets),
+            'max_size': self.max_size,
+            'burst': self.burst,
+            'refill_rate': self.refill_rate,
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'evicted': self.evicted,
+        }
+
 
-# 简单的内存结构用于跟踪用户发送速度与验证码
-# 键：captcha_id -> {'answer': int, 'expires': float, 'user_id': int, 'pending': dict}
-captcha_store = {}
-# 键：user_id -> last_send_time (float seconds)
-last_send_times = {}
-captcha_lock = threading.Lock()
+class RedisSendRateLimiter:
+    """SendRateLimiter 的 Redis 实现：每个用户的令牌桶是一个带 TTL 的哈希，
+    补充与扣减在 Lua 脚本中原子完成，多个工作进程共享同一配额。
+    """
+
+    CONSUME_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local burst = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * refill_rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / refill_rate) + 1)
+return allowed
+"""
+
+    def __init__(self, client, prefix, burst, refill_rate):
+        self.client = client
+        self.prefix = prefix
+        self.burst = float(burst)
+        self.refill_rate = float(refill_rate)
+        self._consume = client.register_script(self.CONSUME_SCRIPT)
+        self.allowed = 0
+        self.limited = 0
+
+    def consume(self, key, now=None):
+        """尝试消耗一个令牌，成功返回 True，桶空返回 False（时间使用各进程一致的墙上时钟）"""
+        now = time.time() if now is None else now
+        if self._consume(keys=[f'{self.prefix}{key}'], args=[self.burst, self.refill_rate, now]):
+            self.allowed += 1
+            return True
+        self.limited += 1
+        return False
+
+    def sweep(self, now=None):
+        return 0  # 空闲的桶由 Redis TTL 清理
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'burst': self.burst,
+            'refill_rate': self.refill_rate,
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
+
+
+def issue_send_captcha(user_id, pending):
+    """发送限流触发时生成算术验证码，pending 为通过验证后要发送的内容。
+
+    每个用户只保留一个未完成的验证码：限流期间继续发送时复用未过期的验证码，只更新待发送内容，
+    不会不断写入新条目把其他用户的验证码挤出容量有限的存储。
+    """
+    key = f'user:{user_id}'
+    now = time.time()
+    info = captcha_store.get(key)
+    if info and now < info.get('expires', 0):
+        info['pending'] = pending
+        captcha_store.set(key, info, ttl=info['expires'] - now)
+        return info['captcha_id'], info['question']
+
+    a = random.randint(1, 9)
+    b = random.randint(1, 9)
+    op = random.choice(['+', '-'])
+    captcha_id = secrets.token_urlsafe(8)
+    question = f'{a}{op}{b} = ?'
+    captcha_store.set(key, {
+        'captcha_id': captcha_id,
+        'question': question,
+        'answer': a + b if op == '+' else a - b,
+        'expires': now + 300,
+        'user_id': user_id,
+        'pending': pending
+    })
+    return captcha_id, question
+
+
+def verify_send_captcha(user_id, captcha_id, captcha_answer):
+    """校验验证码，返回 (pending, 错误信息)；验证通过时条目被取出，不能重复使用"""
+    key = f'user:{user_id}'
+    info = captcha_store.get(key)
+    # 验证存在性、过期以及归属（条目按用户存放，ID 不符说明不是该用户当前的验证码）
+    if not info or info.get('captcha_id') != captcha_id:
+        return None, '验证码无效或已过期'
+    if time.time() > info.get('expires', 0):
+        captcha_store.pop(key, None)
+        return None, '验证码已过期'
+    try:
+        provided = int(captcha_answer)
+    except Exception:
+        return None, '验证码输入错误'
+    if provided != info['answer']:
+        return None, '验证码错误'
+    # 并发提交同一验证码时只有一个能取出条目；取出的条目带有最新的待发送内容
+    info = captcha_store.pop(key, None)
+    if info is None:
+        return None, '验证码无效或已过期'
+    if info.get('captcha_id') != captcha_id:
+        # 期间已换成新的验证码，放回
+        captcha_store.set(key, info, ttl=max(info.get('expires', 0) - time.time(), 1))
+        return None, '验证码无效或已过期'
+    return info.get('pending', {}), None
+
+
+send_rate_limiter = shared_state.rate_limiter(burst=app.config.get('SEND_RATE_BURST', 5),
+                                              refill_rate=app.config.get('SEND_RATE_REFILL_PER_SEC', 1.4),
+                                              max_size=app.config.get('SEND_RATE_STORE_MAX_SIZE', 10000),
+                                              sweep_interval=app.config.get('MEMORY_STORE_SWEEP_INTERVAL', 60))
 
 # 初始化登录管理
 login_manager = LoginManager()
@@ -280,6 +1031,145 @@ def normalize_permission_value(value):
     return None
 
 
+class PermissionCache:
+    """用户权限矩阵缓存：user_id -> (加载时间, {room_id: perm}, {section_id: perm})。
+
+    一次 UNION 查询加载用户全部聊天室与贴吧分区权限，进程内共享，
+    由权限/角色修改、房间与分区增删等操作显式失效，TTL 作为兜底。
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    def _load(self, user_id):
+        chat_rows = db_session.query(
+            literal('chat').label('scope'),
+            ChatPermission.room_id.label('target_id'),
+            ChatPermission.perm.label('perm')
+        ).filter(ChatPermission.user_id == user_id)
+        forum_rows = db_session.query(
+            literal('forum'),
+            ForumPermission.section_id,
+            ForumPermission.perm
+        ).filter(ForumPermission.user_id == user_id)
+        chat_perms, forum_perms = {}, {}
+        for scope, target_id, perm in chat_rows.union_all(forum_rows).all():
+            # 规范化权限值以避免数据库中存储格式差异导致的比较失败
+            (chat_perms if scope == 'chat' else forum_perms)[target_id] = normalize_permission_value(perm)
+        return chat_perms, forum_perms
+
+    def get(self, user_id):
+        """返回 (chat_perms, forum_perms)，调用方不应修改返回的字典"""
+        entry = self._entries.get(user_id)
+        now = time.time()
+        if entry is None or now - entry[0] > self.ttl:
+            entry = (now,) + self._load(user_id)
+            self._entries[user_id] = entry
+        return entry[1], entry[2]
+
+    @replicated('permission_cache')
+    def invalidate(self, user_id=None):
+        """使指定用户（或全部用户）的权限缓存失效"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+
+permission_cache = PermissionCache(app.config.get('PERMISSION_CACHE_TTL', 300))
+
+
+class UserProfile:
+    """缓存的只读用户资料，Socket.IO 事件中作为 current_user 使用"""
+
+    __slots__ = ('id', 'username', 'nickname', 'color', 'badge', 'role', 'loaded_at')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, nickname, color, badge, role, loaded_at):
+        self.id = id
+        self.username = username
+        self.nickname = nickname
+        self.color = color
+        self.badge = badge
+        self.role = role
+        self.loaded_at = loaded_at
+
+    def get_id(self):
+        return str(self.id)
+
+    def is_admin(self):
+        return self.role == 'admin'
+
+
+class UserProfileCache:
+    """用户资料的读穿缓存：user_id -> UserProfile。
+
+    未命中时用独立连接一次查询取得（可在后台任务中使用），
+    由资料、角色修改与删除用户显式失效，TTL 兜底（例如通过数据库管理界面直接修改）。
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, user_ids):
+        table = User.__table__
+        now = time.time()
+        with engine.connect() as conn:
+            rows = conn.execute(
+                table.select().with_only_columns(table.c.id, table.c.username, table.c.nickname,
+                                                 table.c.color, table.c.badge, table.c.role)
+                .where(table.c.id.in_(list(user_ids)))
+            ).all()
+        profiles = {row.id: UserProfile(row.id, row.username, row.nickname, row.color,
+                                        row.badge, row.role, now) for row in rows}
+        if len(self._entries) + len(profiles) > self.max_size:
+            self._entries.clear()
+        self._entries.update(profiles)
+        return profiles
+
+    def get_many(self, user_ids):
+        """返回 {user_id: UserProfile}，不存在的用户不在结果中"""
+        now = time.time()
+        result, missing = {}, []
+        for user_id in user_ids:
+            profile = self._entries.get(user_id)
+            if profile is None or now - profile.loaded_at > self.ttl:
+                missing.append(user_id)
+            else:
+                result[user_id] = profile
+        self.hits += len(result)
+        if missing:
+            self.misses += len(missing)
+            result.update(self._load(missing))
+        return result
+
+    def get(self, user_id):
+        return self.get_many([user_id]).get(user_id)
+
+    @replicated('user_profiles')
+    def invalidate(self, user_id=None):
+        """使指定用户（或全部用户）的资料缓存失效"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'size': len(self._entries), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+user_profiles = UserProfileCache(app.config.get('USER_PROFILE_CACHE_TTL', 300),
+                                 app.config.get('USER_PROFILE_CACHE_SIZE', 10000))
+
+
 def get_chat_permission_value(user, room_id):
     """获取用户在指定聊天室的权限"""
     # 明确只对 None 做空值判断，避免 0 或者其他可判断值被错误当作空
@@ -287,9 +1177,7 @@ def get_chat_permission_value(user, room_id):
         return 'Null'
     if user.is_admin():
         return 'su'
-    perm = db_session.query(ChatPermission).filter_by(user_id=user.id, room_id=room_id).first()
-    # 规范化权限值以避免数据库中存储格式差异导致的比较失败
-    return normalize_permission_value(perm.perm) if perm else 'Null'
+    return permission_cache.get(user.id)[0].get(room_id, 'Null')
 
 
 def get_forum_permission_value(user, section_id):
@@ -299,9 +1187,21 @@ def get_forum_permission_value(user, section_id):
         return 'Null'
     if user.is_admin():
         return 'su'
-    perm = db_session.query(ForumPermission).filter_by(user_id=user.id, section_id=section_id).first()
-    # 规范化权限值以避免数据库中存储格式差异导致的比较失败
-    return normalize_permission_value(perm.perm) if perm else 'Null'
+    return permission_cache.get(user.id)[1].get(section_id, 'Null')
+
+
+def get_chat_permission_map(user):
+    """获取用户在各聊天室的权限 {room_id: perm}，未列出的房间视为 Null"""
+    if not user:
+        return {}
+    return permission_cache.get(user.id)[0]
+
+
+def get_forum_permission_map(user):
+    """获取用户在各贴吧分区的权限 {section_id: perm}，未列出的分区视为 Null"""
+    if not user:
+        return {}
+    return permission_cache.get(user.id)[1]
 
 
 def user_can_view_chat(user, room_id):
@@ -320,74 +1220,198 @@ def user_can_post_forum(user, section_id):
     return get_forum_permission_value(user, section_id) in FORUM_POST_PERMISSIONS
 
 
-# 检查并更新数据库结构
-def update_database_schema():
-    """检查并更新数据库结构，添加缺失的列"""
-    try:
-        conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
-        cursor = conn.cursor()
-        
-        # 检查用户表的所有列
-        cursor.execute("PRAGMA table_info(users);")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'role' not in columns:
-            # 添加role列，默认为'user'
-            cursor.execute("ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT 'user';")
-            logger.info("Added 'role' column to users table")
-            conn.commit()
-        
-        if 'upload_used' not in columns:
-            # 添加upload_used列，默认为0
-            cursor.execute("ALTER TABLE users ADD COLUMN upload_used INTEGER DEFAULT 0;")
-            logger.info("Added 'upload_used' column to users table")
-            conn.commit()
-        
-        conn.close()
-    except Exception as e:
-        logger.error(f"数据库结构更新失败: {str(e)}")
+# 数据库迁移：按版本号顺序执行，已执行的版本记录在 schema_migrations 表中
+SCHEMA_MIGRATIONS = []
 
 
-def ensure_permission_tables():
-    """确保权限表存在并且为所有 admin 用户分配 su 权限"""
-    try:
-        conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
-        cursor = conn.cursor()
-
-        # 检查表是否存在；若不存在，创建表
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chat_permissions';")
-        if not cursor.fetchone():
-            cursor.execute('''
-                CREATE TABLE chat_permissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    room_id INTEGER NOT NULL,
-                    perm VARCHAR(10) DEFAULT 'Null'
-                )
-            ''')
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='forum_permissions';")
-        if not cursor.fetchone():
-            cursor.execute('''
-                CREATE TABLE forum_permissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    section_id INTEGER NOT NULL,
-                    perm VARCHAR(10) DEFAULT 'Null'
-                )
-            ''')
+def migration(version, description):
+    """注册一个数据库迁移，函数接收 SQLAlchemy 连接，可返回一段执行报告"""
+    def decorator(fn):
+        SCHEMA_MIGRATIONS.append((version, description, fn))
+        return fn
+    return decorator
 
-        conn.commit()
-        conn.close()
+
+def explain_query_plan(conn, sql):
+    """返回 SQLite 查询计划的简要描述"""
+    if conn.dialect.name != 'sqlite':
+        return ''
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return '; '.join(str(row[-1]) for row in rows)
+
+
+def create_index(conn, name, table, columns, sample_query, unique=False, dedupe_sql=None):
+    """创建索引并对比创建前后的查询计划。
+    unique=True 时先执行 dedupe_sql 清理重复数据，再创建唯一索引。
+    """
+    before = explain_query_plan(conn, sample_query)
+    if dedupe_sql:
+        for statement in dedupe_sql:
+            result = conn.exec_driver_sql(statement)
+            if result.rowcount and result.rowcount > 0:
+                logger.info(f"索引 {name}: 清理 {table} 重复数据 {result.rowcount} 行")
+    conn.exec_driver_sql(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    )
+    after = explain_query_plan(conn, sample_query)
+    return f"{sample_query}\n  之前: {before}\n  之后: {after}"
+
+
+def dedupe_rows(table, key_columns, keep='MAX(id)'):
+    """生成删除重复行的 SQL：按 key_columns 分组，只保留 keep 选出的一行"""
+    keys = ', '.join(key_columns)
+    return [f"DELETE FROM {table} WHERE id NOT IN (SELECT {keep} FROM {table} GROUP BY {keys})"]
+
+
+def dedupe_last_views(table, target_column):
+    """最后查看时间表去重：保留的行取该组最新的 last_view"""
+    return [
+        f"UPDATE {table} SET last_view = (SELECT MAX(v.last_view) FROM {table} v "
+        f"WHERE v.user_id = {table}.user_id AND v.{target_column} = {table}.{target_column}) "
+        f"WHERE id IN (SELECT MAX(id) FROM {table} GROUP BY user_id, {target_column} HAVING COUNT(*) > 1)",
+    ] + dedupe_rows(table, ['user_id', target_column])
+
+
+@migration(1, '创建权限表')
+def _migration_permission_tables(conn):
+    tables = inspect(conn).get_table_names()
+    if 'chat_permissions' not in tables:
+        conn.exec_driver_sql('''
+            CREATE TABLE chat_permissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                room_id INTEGER NOT NULL,
+                perm VARCHAR(10) DEFAULT 'Null'
+            )
+        ''')
+    if 'forum_permissions' not in tables:
+        conn.exec_driver_sql('''
+            CREATE TABLE forum_permissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                section_id INTEGER NOT NULL,
+                perm VARCHAR(10) DEFAULT 'Null'
+            )
+        ''')
+
+
+@migration(2, '用户表添加 role 与 upload_used 列')
+def _migration_user_columns(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('users')}
+    if 'role' not in columns:
+        # 添加role列，默认为'user'
+        conn.exec_driver_sql("ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT 'user'")
+    if 'upload_used' not in columns:
+        # 添加upload_used列，默认为0
+        conn.exec_driver_sql("ALTER TABLE users ADD COLUMN upload_used INTEGER DEFAULT 0")
+
+
+@migration(3, '索引 chat_messages(room_id, id)：历史消息游标分页')
+def _migration_chat_messages_room_id(conn):
+    return create_index(conn, 'ix_chat_messages_room_id_id', 'chat_messages', ['room_id', 'id'],
+                        "SELECT id FROM chat_messages WHERE room_id = 1 AND id < 1000 ORDER BY id DESC LIMIT 51")
+
+
+@migration(4, '索引 chat_messages(room_id, timestamp)：历史分页与未读统计')
+def _migration_chat_messages_room_timestamp(conn):
+    return create_index(conn, 'ix_chat_messages_room_id_timestamp', 'chat_messages', ['room_id', 'timestamp'],
+                        "SELECT COUNT(*) FROM chat_messages WHERE room_id = 1 AND timestamp > '2000-01-01'")
+
+
+@migration(5, '索引 chat_messages(user_id, room_id, id)：重复消息合并查询')
+def _migration_chat_messages_user_room(conn):
+    return create_index(conn, 'ix_chat_messages_user_id_room_id_id', 'chat_messages', ['user_id', 'room_id', 'id'],
+                        "SELECT id FROM chat_messages WHERE user_id = 1 AND room_id = 1 ORDER BY id DESC LIMIT 1")
+
+
+@migration(6, '唯一索引 chat_last_views(user_id, room_id)')
+def _migration_chat_last_views(conn):
+    return create_index(conn, 'ux_chat_last_views_user_id_room_id', 'chat_last_views', ['user_id', 'room_id'],
+                        "SELECT last_view FROM chat_last_views WHERE user_id = 1 AND room_id = 1",
+                        unique=True, dedupe_sql=dedupe_last_views('chat_last_views', 'room_id'))
+
+
+@migration(7, '唯一索引 forum_last_views(user_id, section_id)')
+def _migration_forum_last_views(conn):
+    return create_index(conn, 'ux_forum_last_views_user_id_section_id', 'forum_last_views', ['user_id', 'section_id'],
+                        "SELECT last_view FROM forum_last_views WHERE user_id = 1 AND section_id = 1",
+                        unique=True, dedupe_sql=dedupe_last_views('forum_last_views', 'section_id'))
+
+
+@migration(8, '索引 forum_replies(thread_id, timestamp)：主题回复分页')
+def _migration_forum_replies(conn):
+    return create_index(conn, 'ix_forum_replies_thread_id_timestamp', 'forum_replies', ['thread_id', 'timestamp'],
+                        "SELECT id FROM forum_replies WHERE thread_id = 1 ORDER BY timestamp ASC LIMIT 50")
+
+
+@migration(9, '索引 forum_threads(section_id, timestamp)：分区主题列表与未读统计')
+def _migration_forum_threads(conn):
+    return create_index(conn, 'ix_forum_threads_section_id_timestamp', 'forum_threads', ['section_id', 'timestamp'],
+                        "SELECT id FROM forum_threads WHERE section_id = 1 ORDER BY timestamp DESC")
+
+
+@migration(10, '唯一索引 chat_permissions(user_id, room_id)')
+def _migration_chat_permissions(conn):
+    return create_index(conn, 'ux_chat_permissions_user_id_room_id', 'chat_permissions', ['user_id', 'room_id'],
+                        "SELECT perm FROM chat_permissions WHERE user_id = 1 AND room_id = 1",
+                        unique=True, dedupe_sql=dedupe_rows('chat_permissions', ['user_id', 'room_id']))
+
+
+@migration(11, '唯一索引 forum_permissions(user_id, section_id)')
+def _migration_forum_permissions(conn):
+    return create_index(conn, 'ux_forum_permissions_user_id_section_id', 'forum_permissions', ['user_id', 'section_id'],
+                        "SELECT perm FROM forum_permissions WHERE user_id = 1 AND section_id = 1",
+                        unique=True, dedupe_sql=dedupe_rows('forum_permissions', ['user_id', 'section_id']))
+
+
+@migration(12, '唯一索引 user_follows(follower_id, followed_id)')
+def _migration_user_follows(conn):
+    return create_index(conn, 'ux_user_follows_follower_id_followed_id', 'user_follows', ['follower_id', 'followed_id'],
+                        "SELECT id FROM user_follows WHERE follower_id = 1 AND followed_id = 2",
+                        unique=True, dedupe_sql=dedupe_rows('user_follows', ['follower_id', 'followed_id'], keep='MIN(id)'))
+
+
+@migration(13, '索引 users(last_seen)：在线人数校准')
+def _migration_users_last_seen(conn):
+    return create_index(conn, 'ix_users_last_seen', 'users', ['last_seen'],
+                        "SELECT id, last_seen FROM users WHERE last_seen >= '2000-01-01'")
+
+
+def run_migrations():
+    """执行所有未执行过的数据库迁移，返回本次执行的版本号列表"""
+    applied_now = []
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INTEGER PRIMARY KEY, description VARCHAR(255), applied_at DATETIME, report TEXT)"
+            )
+            applied = {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
     except Exception as e:
-        logger.error(f"确保权限表失败: {str(e)}")
+        logger.error(f"读取迁移记录失败: {str(e)}")
+        return applied_now
 
+    for version, description, fn in sorted(SCHEMA_MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as conn:
+                report = fn(conn) or ''
+                conn.exec_driver_sql(
+                    "INSERT INTO schema_migrations (version, description, applied_at, report) VALUES (?, ?, ?, ?)",
+                    (version, description, datetime.now(timezone.utc).replace(tzinfo=None).isoformat(' '), report)
+                )
+            applied_now.append(version)
+            logger.info(f"数据库迁移 {version} 完成: {description}" + (f"\n{report}" if report else ''))
+        except Exception as e:
+            # 后续迁移可能依赖本次迁移，失败时停止
+            logger.error(f"数据库迁移 {version} 失败: {description} - {str(e)}")
+            break
+    return applied_now
 
-# 确保权限表存在
-ensure_permission_tables()
 
-# 应用启动时更新数据库结构
-update_database_schema()
+# 应用启动时执行数据库迁移
+run_migrations()
 
 # 确保admin用户是管理员
 def ensure_admin_user():
@@ -441,6 +1465,7 @@ def grant_su_to_admins():
                     existing.perm = 'su'
 
         db_session.commit()
+        permission_cache.invalidate()
     except Exception as e:
         logger.error(f"为管理员分配权限失败: {str(e)}")
 
@@ -449,7 +1474,19 @@ grant_su_to_admins()
 # 用户加载函数
 @login_manager.user_loader
 def load_user(user_id):
+    # Socket.IO 事件只读取用户资料，使用缓存避免每个事件查询一次 users 表；
+    # HTTP 请求仍返回 ORM 对象，视图可以直接修改并提交
+    if getattr(request, 'sid', None) is not None:
+        return user_profiles.get(int(user_id))
     return db_session.query(User).get(int(user_id))
+
+
+@app.before_request
+def start_shared_state():
+    # 多进程模式下开始接收其他工作进程同步的缓存失效等调用
+    shared_state.start()
+
+
 @app.context_processor
 def inject_app_info():
     """将应用信息注入到所有模板中"""
@@ -499,10 +1536,33 @@ class ProfileForm(FlaskForm):
 
 # 全局工具函数
 
+# 需要移除的HTML标签（包括自闭合、带属性、大小写、h1-h6等）
+HTML_TAGS = (
+    'a','abbr','acronym','address','applet','area','article','aside','audio','b','base','basefont','bdi','bdo','big','blockquote','body','br','button','canvas','caption','center','cite','code','col','colgroup','data','datalist','dd','del','details','dfn','dialog','dir','div','dl','dt','em','embed','fieldset','figcaption','figure','font','footer','form','frame','frameset','h1','h2','h3','h4','h5','h6','head','header','hgroup','hr','html','i','iframe','img','input','ins','kbd','label','legend','li','link','main','map','mark','menu','meta','meter','nav','noframes','noscript','object','ol','optgroup','option','output','p','param','picture','pre','progress','q','rp','rt','ruby','s','samp','script','search','section','select','small','source','span','strike','strong','style','sub','summary','sup','svg','table','tbody','td','template','textarea','tfoot','th','thead','time','title','tr','track','tt','u','ul','var','video','wbr','!DOCTYPE'
+)
+_HTML_TAG_RE = re.compile(r'</?(' + '|'.join(HTML_TAGS) + r')(\s+[^>]*?|)\s*/?>', re.IGNORECASE)
+
+# 代码块、LaTeX 与 @quote 的联合词法规则，一次扫描完成保护。
+# 代码优先于 LaTeX：LaTeX 片段不跨越反引号，因此 "$a`b$c`" 中的 `b$c` 仍按代码处理。
+# 未闭合的 ``` 或 ` 之后不再识别代码，剩余部分改用 _TAIL_TOKEN_RE 继续扫描。
+_LATEX_BODY = r'\$[^$`]*?\$|\$\$[^$`]*?\$\$|\\\([^\n`]*?\\\)|\\\[[^\n`]*?\\\]'
+_QUOTE_BODY = r'@quote\{(?P<qid>\d+)\}'
+# 分支顺序即优先级：未闭合的 ``` 必须先于行内代码匹配，否则其中的 `` 会被当作空的行内代码，
+# 之后的内容被错误地当作代码而不转义。
+_CONTENT_TOKEN_RE = re.compile(
+    r'(?P<code>```.*?```)|(?P<open>```)|(?P<inline>`[^`]*`)|(?P<open_inline>`)'
+    r'|(?P<latex>' + _LATEX_BODY + r')|(?P<quote>' + _QUOTE_BODY + r')',
+    re.DOTALL
+)
+_TAIL_TOKEN_RE = re.compile(
+    r'(?P<latex>\$[^$]*?\$|\$\$[^$]*?\$\$|\\\(.*?\\\)|\\\[.*?\\\])|(?P<quote>' + _QUOTE_BODY + r')'
+)
+
+
 def sanitize_content(content, room_id=None):
     """
-    移除HTML标签，保留代码块、LaTeX、@quote等内容。
-    room_id: 若提供则校验@quote引用的消息是否在该房间内。
+    移除HTML标签，保留代码块、LaTeX、@quote等内容，其余文本做HTML转义。
+    room_id: 若提供则校验@quote引用的消息是否在该房间内（所有引用合并为一次查询）。
     """
     if not content:
         return ""
@@ -516,108 +1576,657 @@ def sanitize_content(content, room_id=None):
     except Exception:
         pass
 
-    temp_placeholders = {}
+    content = _HTML_TAG_RE.sub('', content)
+
+    # parts 中的字符串原样输出；(quote_id, 原文) 元组待校验后决定是否保留
+    parts = []
+    quote_ids = set()
+    pos = 0
+    code_parts, code_end = 0, 0  # 最后一个代码片段结束时 parts 的长度与文本位置
+    pattern = _CONTENT_TOKEN_RE
+    while True:
+        match = pattern.search(content, pos)
+        if not match:
+            break
+        start = match.start()
+        kind = match.lastgroup
+        if kind in ('open', 'open_inline'):
+            # 未闭合的代码标记：之后的内容不再识别代码。与原实现一致，LaTeX 与引用
+            # 在代码之外的整段文本上匹配（可以跨过这个标记），因此回退到最后一个代码片段之后重新扫描
+            pattern = _TAIL_TOKEN_RE
+            del parts[code_parts:]
+            quote_ids = {part[0] for part in parts if not isinstance(part, str)}
+            pos = code_end
+            continue
+        if start > pos:
+            parts.append(html.escape(content[pos:start], quote=True))
+        if kind == 'quote':
+            quote_id = int(match.group('qid'))
+            quote_ids.add(quote_id)
+            parts.append((quote_id, match.group(0)))
+        else:
+            parts.append(match.group(0))
+        pos = match.end()
+        if kind in ('code', 'inline'):
+            code_parts, code_end = len(parts), pos
+    parts.append(html.escape(content[pos:], quote=True))
+
+    if quote_ids and room_id is not None:
+        chat_write_queue.flush_if_pending(quote_ids)
+        valid_ids = {row.id for row in db_session.query(ChatMessage.id).filter(
+            ChatMessage.id.in_(quote_ids),
+            ChatMessage.room_id == room_id
+        )}
+    else:
+        valid_ids = quote_ids
 
-    # 表达式树解析代码块（支持```和`嵌套，优先多行）
-    def parse_code_blocks(text):
-        result = []
-        i = 0
-        n = len(text)
-        buf = []
-        while i < n:
-            if text[i:i+3] == '```':
-                # 多行代码块
-                end = text.find('```', i+3)
-                if end == -1:
-                    buf.append(text[i:])
-                    break
-                key = f"__CODEBLOCK_{len(temp_placeholders)}__"
-                temp_placeholders[key] = text[i:end+3]
-                buf.append(key)
-                i = end + 3
-            elif text[i] == '`':
-                # 行内代码
-                j = i+1
-                while j < n and text[j] != '`':
-                    j += 1
-                if j < n:
-                    key = f"__INLINECODE_{len(temp_placeholders)}__"
-                    temp_placeholders[key] = text[i:j+1]
-                    buf.append(key)
-                    i = j+1
-                else:
-                    buf.append(text[i:])
-                    break
-            else:
-                buf.append(text[i])
-                i += 1
-        return ''.join(buf)
-    # 读取所有HTML标签（静态列表，实际部署可直接硬编码）
-    html_tags = [
-        'a','abbr','acronym','address','applet','area','article','aside','audio','b','base','basefont','bdi','bdo','big','blockquote','body','br','button','canvas','caption','center','cite','code','col','colgroup','data','datalist','dd','del','details','dfn','dialog','dir','div','dl','dt','em','embed','fieldset','figcaption','figure','font','footer','form','frame','frameset','h1','h2','h3','h4','h5','h6','head','header','hgroup','hr','html','i','iframe','img','input','ins','kbd','label','legend','li','link','main','map','mark','menu','meta','meter','nav','noframes','noscript','object','ol','optgroup','option','output','p','param','picture','pre','progress','q','rp','rt','ruby','s','samp','script','search','section','select','small','source','span','strike','strong','style','sub','summary','sup','svg','table','tbody','td','template','textarea','tfoot','th','thead','time','title','tr','track','tt','u','ul','var','video','wbr','!DOCTYPE'
-    ]
-    # 构造严格的正则，移除所有这些标签（包括自闭合、带属性、大小写、h1-h6等）
-    tag_regex = r'</?(' + '|'.join(html_tags) + r')(\s+[^>]*?|)\s*/?>'
-    content = re.sub(tag_regex, '', content, flags=re.IGNORECASE)
-    
-    content = parse_code_blocks(content)
-
-    # LaTeX表达式保护
-    latex_pattern = r'\$[^\$]*?\$|\$\$[^\$]*?\$\$|\\\(.*?\\\)|\\\[.*?\\\]'
-    def replace_latex(match):
-        key = f"__LATEX_{len(temp_placeholders)}__"
-        temp_placeholders[key] = match.group(0)
-        return key
-    content = re.sub(latex_pattern, replace_latex, content, flags=re.MULTILINE)
-
-    # @quote引用保护/校验
-    quote_pattern = r'@quote\{(\d+)\}'
-    def replace_quote(match):
-        quote_id = int(match.group(1))
-        if room_id is not None:
-            quoted_message = db_session.query(ChatMessage).filter_by(id=quote_id, room_id=room_id).first()
-            if not quoted_message:
-                return ''
-        key = f"__QUOTE_{len(temp_placeholders)}__"
-        temp_placeholders[key] = match.group(0)
-        return key
-    content = re.sub(quote_pattern, replace_quote, content, flags=re.MULTILINE)
-
-    content = html.escape(content, quote=True)
-    for key, original in temp_placeholders.items():
-        content = content.replace(key, original)
-    return content
+    return ''.join(
+        part if isinstance(part, str) else (part[1] if part[0] in valid_ids else '')
+        for part in parts
+    )
 
 
 # 已合并到sanitize_content
 
+class SocketSessions:
+    """Socket.IO 连接表：sid -> {'user_id', 'rooms', 'connected_at'}。
+
+    用于在断开连接时立即清理在线状态；同一用户在多个标签页中打开同一房间时，
+    只有最后一个连接离开后才视为离开房间。仍有连接的用户不会因心跳间隔而超时。
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._user_sids = {}
+        self._lock = threading.Lock()
+
+    def connect(self, sid, user_id):
+        with self._lock:
+            self._sessions[sid] = {'user_id': user_id, 'rooms': set(), 'connected_at': time.time()}
+            self._user_sids.setdefault(user_id, set()).add(sid)
+
+    def join(self, sid, room_id):
+        """返回该连接是否为首次进入此房间"""
+        with self._lock:
+            info = self._sessions.get(sid)
+            if not info or room_id in info['rooms']:
+                return False
+            info['rooms'].add(room_id)
+            return True
+
+    def leave(self, sid, room_id):
+        """返回该连接此前是否在此房间"""
+        with self._lock:
+            info = self._sessions.get(sid)
+            if not info or room_id not in info['rooms']:
+                return False
+            info['rooms'].discard(room_id)
+            return True
+
+    def disconnect(self, sid):
+        """移除连接，返回其会话信息（未登记时返回 None）"""
+        with self._lock:
+            info = self._sessions.pop(sid, None)
+            if info:
+                sids = self._user_sids.get(info['user_id'])
+                if sids:
+                    sids.discard(sid)
+                    if not sids:
+                        del self._user_sids[info['user_id']]
+        return info
+
+    def in_room(self, room_id, user_id):
+        """用户是否仍有连接停留在该房间"""
+        with self._lock:
+            return any(room_id in self._sessions[sid]['rooms'] for sid in self._user_sids.get(user_id, ()))
+
+    def has_user(self, user_id):
+        with self._lock:
+            return user_id in self._user_sids
+
+    def stats(self):
+        with self._lock:
+            return {'connections': len(self._sessions), 'users': len(self._user_sids)}
+
+
+socket_sessions = SocketSessions()
+
+
+class PresenceRegistry:
+    """进程内的聊天室在线状态表：room_id -> {user_id: 最后活动时间戳}。
+
+    心跳只刷新内存中的时间戳，不再写数据库；超过 ONLINE_TIMEOUT 未活动的条目
+    在 sweep() 时被移除并返回，由调用方把最后活动时间落库到 ChatLastView。
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def touch(self, room_id, user_id, now=None):
+        """刷新用户在房间内的活动时间，返回该用户是否为新上线"""
+        now = now or time.time()
+        with self._lock:
+            members = self._rooms.setdefault(room_id, {})
+            is_new = user_id not in members
+            members[user_id] = now
+        return is_new
+
+    def remove(self, room_id, user_id):
+        """移除用户，返回被移除条目的最后活动时间（不存在时返回 None）"""
+        with self._lock:
+            members = self._rooms.get(room_id)
+            if not members:
+                return None
+            last_active = members.pop(user_id, None)
+            if not members:
+                self._rooms.pop(room_id, None)
+        return last_active
+
+    def rooms_of(self, user_id):
+        with self._lock:
+            return [room_id for room_id, members in self._rooms.items() if user_id in members]
+
+    def hold(self, room_id, user_id):
+        """登记一个连接进入房间（单进程时连接由 socket_sessions 统计，这里无需记录）"""
+
+    def release(self, room_id, user_id):
+        """一个连接离开房间，返回其他进程中是否也已没有该用户在此房间的连接"""
+        return True
+
+    def sweep(self, now=None, keep=None):
+        """移除超时条目，返回 [(room_id, user_id, last_active), ...]。
+        keep(room_id, user_id) 为真的条目视为仍然活跃，刷新时间而不移除。
+        """
+        now = now or time.time()
+        cutoff = now - self.timeout
+        expired = []
+        with self._lock:
+            for room_id in list(self._rooms):
+                members = self._rooms[room_id]
+                for user_id, last_active in list(members.items()):
+                    if last_active < cutoff:
+                        if keep and keep(room_id, user_id):
+                            members[user_id] = now
+                            continue
+                        del members[user_id]
+                        expired.append((room_id, user_id, last_active))
+                if not members:
+                    del self._rooms[room_id]
+        return expired
+
+    def user_ids(self, room_id):
+        with self._lock:
+            return list(self._rooms.get(room_id, ()))
+
+
+class RedisPresenceRegistry:
+    """PresenceRegistry 的 Redis 实现：每个房间一个有序集合（成员为 user_id，分数为最后活动时间），
+    另有一个集合记录有在线用户的房间。各工作进程共享同一份在线名单。
+
+    sweep() 的 keep 只能判断本进程的连接，因此先为本进程仍连接的用户刷新时间，
+    其余超时条目由 Lua 脚本在分数仍然超时的前提下删除，并发清理时同一条目只会被一个进程返回。
+
+    用户可能在不同工作进程上各有连接，因此每个房间另有一个哈希记录用户在所有进程中的连接数，
+    只有最后一个连接离开时才立即移除在线状态。工作进程异常退出时遗留的计数在条目超时清理时一并删除。
+    """
+
+    EXPIRE_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) < tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    if redis.call('ZCARD', KEYS[1]) == 0 then
+        redis.call('SREM', KEYS[2], ARGV[3])
+    end
+    return score
+end
+return false
+"""
+
+    RELEASE_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return count
+"""
+
+    def __init__(self, client, prefix, timeout):
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self._rooms_key = prefix + 'rooms'
+        self._expire = client.register_script(self.EXPIRE_SCRIPT)
+        self._release = client.register_script(self.RELEASE_SCRIPT)
+
+    def _room_key(self, room_id):
+        return f'{self.prefix}room:{room_id}'
+
+    def _conns_key(self, room_id):
+        return f'{self.prefix}conns:{room_id}'
+
+    def _rooms(self):
+        return [int(room_id) for room_id in self.client.smembers(self._rooms_key)]
+
+    def touch(self, room_id, user_id, now=None):
+        """刷新用户在房间内的活动时间，返回该用户是否为新上线"""
+        now = now or time.time()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zadd(self._room_key(room_id), {user_id: now})
+        pipe.sadd(self._rooms_key, room_id)
+        added, _ = pipe.execute()
+        return bool(added)
+
+    def remove(self, room_id, user_id):
+        """移除用户，返回被移除条目的最后活动时间（不存在时返回 None）"""
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zscore(self._room_key(room_id), user_id)
+        pipe.zrem(self._room_key(room_id), user_id)
+        last_active, removed = pipe.execute()
+        return last_active if removed else None
+
+    def rooms_of(self, user_id):
+        rooms = self._rooms()
+        if not rooms:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for room_id in rooms:
+            pipe.zscore(self._room_key(room_id), user_id)
+        return [room_id for room_id, score in zip(rooms, pipe.execute()) if score is not None]
+
+    def hold(self, room_id, user_id):
+        """登记一个连接进入房间"""
+        self.client.hincrby(self._conns_key(room_id), user_id, 1)
+
+    def release(self, room_id, user_id):
+        """一个连接离开房间，返回所有工作进程中是否都已没有该用户在此房间的连接"""
+        return int(self._release(keys=[self._conns_key(room_id)], args=[user_id])) <= 0
+
+    def sweep(self, now=None, keep=None):
+        """移除超时条目，返回 [(room_id, user_id, last_active), ...]。
+        keep(room_id, user_id) 为真的条目视为仍然活跃，刷新时间而不移除。
+        """
+        now = now or time.time()
+        cutoff = now - self.timeout
+        expired = []
+        for room_id in self._rooms():
+            key = self._room_key(room_id)
+            stale = self.client.zrangebyscore(key, '-inf', f'({cutoff}')
+            if not stale:
+                if not self.client.zcard(key):
+                    self.client.srem(self._rooms_key, room_id)
+                continue
+            for member in stale:
+                user_id = int(member)
+                if keep and keep(room_id, user_id):
+                    self.client.zadd(key, {user_id: now}, xx=True)
+                    continue
+                last_active = self._expire(keys=[key, self._rooms_key, self._conns_key(room_id)],
+                                           args=[user_id, cutoff, room_id])
+                if last_active is not None:
+                    expired.append((room_id, user_id, float(last_active)))
+        return expired
+
+    def user_ids(self, room_id):
+        return [int(member) for member in self.client.zrange(self._room_key(room_id), 0, -1)]
+
+
+presence = shared_state.presence_registry(app.config.get('ONLINE_TIMEOUT', 30))
+
+
+class OnlineTracker:
+    """全站在线人数：user_id -> 最后活动时间戳，按活动时间排序。
+
+    登录、Socket 连接、加入房间和心跳时 touch()，count() 只需从队首淘汰超时条目，
+    不再每次渲染都执行 COUNT 查询。其他进程或路径写入的 users.last_seen
+    由 reconcile() 定期合并进来。
+    """
+
+    def __init__(self, timeout, reconcile_interval, is_connected=None):
+        self.timeout = timeout
+        self.reconcile_interval = reconcile_interval
+        self.is_connected = is_connected
+        self._last_seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_reconcile = 0.0
+
+    def touch(self, user_id, now=None):
+        now = now or time.time()
+        with self._lock:
+            if self._last_seen.get(user_id, 0) > now:
+                return
+            self._last_seen[user_id] = now
+            self._last_seen.move_to_end(user_id)
+
+    def _expire(self, now):
+        # 调用方需持有 self._lock
+        cutoff = now - self.timeout
+        while self._last_seen:
+            user_id, last_active = next(iter(self._last_seen.items()))
+            if last_active >= cutoff:
+                break
+            if self.is_connected and self.is_connected(user_id):
+                # 仍有 Socket 连接的用户保持在线
+                self._last_seen[user_id] = now
+                self._last_seen.move_to_end(user_id)
+                continue
+            self._last_seen.popitem(last=False)
+
+    def reconcile(self, now=None):
+        """用数据库中的 users.last_seen 校准内存状态"""
+        now = now or time.time()
+        self._last_reconcile = now
+        cutoff = datetime.fromtimestamp(now - self.timeout, timezone.utc).replace(tzinfo=None)
+        try:
+            rows = db_session.query(User.id, User.last_seen).filter(User.last_seen >= cutoff).all()
+        except Exception as e:
+            logger.error(f"校准在线人数失败: {str(e)}")
+            return
+        with self._lock:
+            for user_id, last_seen in rows:
+                seen = last_seen.replace(tzinfo=timezone.utc).timestamp()
+                if seen > self._last_seen.get(user_id, 0):
+                    self._last_seen[user_id] = seen
+            # 合并后重新按活动时间排序，保证 _expire 可以从队首淘汰
+            self._last_seen = OrderedDict(sorted(self._last_seen.items(), key=lambda item: item[1]))
+            self._expire(now)
+
+    def count(self):
+        now = time.time()
+        if now - self._last_reconcile >= self.reconcile_interval:
+            self.reconcile(now)
+        with self._lock:
+            self._expire(now)
+            return len(self._last_seen)
+
+
+online_tracker = OnlineTracker(app.config.get('ONLINE_TIMEOUT', 30),
+                               app.config.get('ONLINE_RECONCILE_INTERVAL', 60),
+                               is_connected=socket_sessions.has_user)
+
+
+class LastSeenAggregator:
+    """合并写入 users.last_seen 与 chat_last_views.last_view。
+
+    心跳、连接、进出房间只在内存中记录最新时间，后台任务每 interval 秒
+    用一次批量 UPDATE / UPSERT 写入。interval 为 0 时每次记录都立即写入。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._users = {}  # user_id -> datetime
+        self._views = {}  # (user_id, room_id) -> datetime
+        self._worker_started = False
+        self.recorded = 0
+        self.rows_written = 0
+        self.flushes = 0
+
+    def record_user(self, user_id, when=None):
+        self._record(self._users, user_id, when)
+
+    def record_view(self, user_id, room_id, when=None):
+        self._record(self._views, (user_id, room_id), when)
+
+    def _record(self, target, key, when):
+        when = (when or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            self.recorded += 1
+            if key not in target or target[key] < when:
+                target[key] = when
+        if self.interval <= 0:
+            self.flush()
+        elif not self._worker_started:
+            self._worker_started = True
+            socketio.start_background_task(self._run)
+
+    def has_views_for(self, user_id):
+        with self._lock:
+            return any(key[0] == user_id for key in self._views)
+
+    def flush(self):
+        """写入累计的时间，返回写入行数"""
+        with self._flush_lock:
+            with self._lock:
+                users, self._users = self._users, {}
+                views, self._views = self._views, {}
+            if not users and not views:
+                return 0
+            try:
+                with engine.begin() as conn:
+                    if users:
+                        users_table = User.__table__
+                        conn.execute(
+                            users_table.update()
+                            .where(users_table.c.id == bindparam('uid'))
+                            .where(or_(users_table.c.last_seen.is_(None), users_table.c.last_seen < bindparam('ts')))
+                            .values(last_seen=bindparam('ts')),
+                            [{'uid': user_id, 'ts': when} for user_id, when in users.items()]
+                        )
+                    if views:
+                        self._write_views(conn, views)
+            except Exception as e:
+                # 写入失败时放回，下次重试（保留较新的时间）
+                with self._lock:
+                    for user_id, when in users.items():
+                        if self._users.get(user_id, when) <= when:
+                            self._users[user_id] = when
+                    for key, when in views.items():
+                        if self._views.get(key, when) <= when:
+                            self._views[key] = when
+                logger.error(f"批量写入最后活动时间失败: {str(e)}")
+                return 0
+            written = len(users) + len(views)
+            with self._lock:
+                self.rows_written += written
+                self.flushes += 1
+            return written
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('最后活动时间后台写入任务异常')
+
+    @staticmethod
+    def _write_views(conn, views):
+        """写入 {(user_id, room_id): 时间}。页面访问可能已直接写入更新的时间，只在更新时覆盖。
+
+        SQLite 与 PostgreSQL 使用 UPSERT（依赖 chat_last_views(user_id, room_id) 唯一索引，迁移 6）；
+        其他数据库先批量 UPDATE，再插入不存在的行。
+        """
+        views_table = ChatLastView.__table__
+        dialect = conn.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                stmt = sqlite_insert(views_table)
+                newer = func.max  # SQLite 的多参数 max() 返回最大值
+            else:
+                stmt = postgresql_insert(views_table)
+                newer = func.greatest
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'room_id'],
+                set_={'last_view': newer(
+                    func.coalesce(views_table.c.last_view, stmt.excluded.last_view),
+                    stmt.excluded.last_view
+                )}
+            )
+            conn.execute(stmt, [
+                {'user_id': user_id, 'room_id': room_id, 'last_view': when}
+                for (user_id, room_id), when in views.items()
+            ])
+            return
+
+        conn.execute(
+            views_table.update()
+            .where(views_table.c.user_id == bindparam('uid'))
+            .where(views_table.c.room_id == bindparam('rid'))
+            .where(or_(views_table.c.last_view.is_(None), views_table.c.last_view < bindparam('ts')))
+            .values(last_view=bindparam('ts')),
+            [{'uid': user_id, 'rid': room_id, 'ts': when} for (user_id, room_id), when in views.items()]
+        )
+        existing = set(conn.execute(
+            select(views_table.c.user_id, views_table.c.room_id)
+            .where(views_table.c.user_id.in_({user_id for user_id, _ in views}))
+        ).all())
+        missing = [
+            {'user_id': user_id, 'room_id': room_id, 'last_view': when}
+            for (user_id, room_id), when in views.items() if (user_id, room_id) not in existing
+        ]
+        if missing:
+            conn.execute(views_table.insert(), missing)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'pending': len(self._users) + len(self._views),
+                'recorded': self.recorded,
+                'rows_written': self.rows_written,
+                'writes_avoided': self.recorded - self.rows_written - len(self._users) - len(self._views),
+                'flushes': self.flushes,
+            }
+
+
+last_seen_aggregator = LastSeenAggregator(app.config.get('LAST_SEEN_FLUSH_INTERVAL', 15))
+atexit.register(last_seen_aggregator.flush)
+
+
+def expire_presence():
+    """清理超时的在线条目，并把其最后活动时间记入 ChatLastView，返回受影响的房间ID集合"""
+    expired = presence.sweep(keep=socket_sessions.in_room)
+    if not expired:
+        return set()
+    for room_id, user_id, last_active in expired:
+        last_seen_aggregator.record_view(user_id, room_id, datetime.fromtimestamp(last_active, timezone.utc))
+    return {room_id for room_id, _, _ in expired}
+
+
+def user_profile(user):
+    """用户在消息、在线名单等处展示的公共信息"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'nickname': user.nickname or user.username,
+        'color': user.color,
+        'badge': user.badge
+    }
+
+
+def load_roster_users(user_ids):
+    """读取在线名单中展示的用户信息，返回 {user_id: dict}。
+
+    经由 user_profiles 缓存，未命中时使用独立连接，可在后台任务中调用。
+    """
+    if not user_ids:
+        return {}
+    return {user_id: user_profile(profile) for user_id, profile in user_profiles.get_many(user_ids).items()}
+
+
+class RosterBroadcaster:
+    """按房间合并在线名单变化，以带版本号的增量事件广播。
+
+    mark_dirty() 只登记房间，窗口期结束后统一与上次广播的名单比较，
+    有变化时发送 online_users_delta {room_id, version, joined, left}，没有变化则不发送。
+    新加入者通过 snapshot() 获得完整名单；客户端发现版本号不连续时重新请求快照。
+    """
+
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000.0
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._rosters = {}  # room_id -> {user_id: 用户信息}，即最近一次广播后的名单
+        self._scheduled = set()
+
+    @replicated('roster_broadcaster')
+    def mark_dirty(self, room_id):
+        if self.window <= 0:
+            self.flush(room_id)
+            return
+        with self._lock:
+            if room_id in self._scheduled:
+                return
+            self._scheduled.add(room_id)
+        socketio.start_background_task(self._flush_later, room_id)
+
+    def _flush_later(self, room_id):
+        socketio.sleep(self.window)
+        try:
+            self.flush(room_id)
+        except Exception:
+            logger.exception(f'广播房间 {room_id} 在线名单失败')
+
+    def _diff(self, room_id):
+        """把名单同步到当前在线状态，返回 (version, roster, joined, left)；没有变化时 joined/left 为空"""
+        current_ids = set(presence.user_ids(room_id))
+        with self._lock:
+            self._scheduled.discard(room_id)
+            roster = self._rosters.get(room_id, {})
+            joined_ids = current_ids - roster.keys()
+            left_ids = sorted(roster.keys() - current_ids)
+        joined = list(load_roster_users(joined_ids).values()) if joined_ids else []
+        with self._lock:
+            roster = dict(self._rosters.get(room_id, {}))
+            for user_id in left_ids:
+                roster.pop(user_id, None)
+            joined = [user for user in joined if user['id'] not in roster]
+            for user in joined:
+                roster[user['id']] = user
+            version = self._versions.get(room_id, 0)
+            if joined or left_ids:
+                version += 1
+                self._versions[room_id] = version
+            if roster:
+                self._rosters[room_id] = roster
+            else:
+                self._rosters.pop(room_id, None)
+        return version, roster, joined, left_ids
+
+    def flush(self, room_id):
+        version, _, joined, left = self._diff(room_id)
+        if not joined and not left:
+            return
+        # 每个工作进程根据共享的在线状态各自维护名单和版本号，只推送给本进程的连接
+        socketio.emit('online_users_delta', {
+            'room_id': room_id,
+            'version': version,
+            'joined': joined,
+            'left': left
+        }, room=f"room_{room_id}", ignore_queue=True)
+
+    def snapshot(self, room_id):
+        """返回最近一次广播的完整名单及其版本号，尚未广播的变化随后以增量送达"""
+        with self._lock:
+            roster = self._rosters.get(room_id, {})
+            return {
+                'room_id': room_id,
+                'version': self._versions.get(room_id, 0),
+                'users': list(roster.values())
+            }
+
+
+roster_broadcaster = RosterBroadcaster(app.config.get('ROSTER_BROADCAST_WINDOW_MS', 1000))
+
+
 def update_room_online_count(room_id):
-    """更新特定房间的在线人数"""
-    socketio.emit('online_users', {
-        'users': get_room_users_data(room_id)
-    }, room=f"room_{room_id}")
+    """登记房间在线名单变化，由 roster_broadcaster 合并后增量广播"""
+    roster_broadcaster.mark_dirty(room_id)
+
 
 def get_room_users_data(room_id):
     """获取房间中用户的详细信息"""
     users_data = []
-    # 获取在指定聊天室最后活动时间在超时时间内的用户
-    cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 30))
-    online_users = db_session.query(ChatLastView).filter(
-        ChatLastView.room_id == room_id,
-        ChatLastView.last_view >= cutoff_time
-    ).all()
-    
-    user_ids = [view.user_id for view in online_users]
+    for expired_room_id in expire_presence() - {room_id}:
+        update_room_online_count(expired_room_id)
+    user_ids = presence.user_ids(room_id)
     if user_ids:
         users = db_session.query(User).filter(User.id.in_(user_ids)).all()
-        for user in users:
-            users_data.append({
-                'id': user.id,
-                'username': user.username,
-                'nickname': user.nickname or user.username,
-                'color': user.color,
-                'badge': user.badge
-            })
+        users_data = [user_profile(user) for user in users]
     return users_data
 
 def allowed_image_extension(filename):
@@ -656,29 +2265,76 @@ def get_image_type(stream):
 
 def get_online_users(room_id):
     """获取指定房间的在线用户"""
-    # 获取最近ONLINE_TIMEOUT秒内在该聊天室有活动的用户
-    cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 30))
-    
-    # 从ChatLastView表中获取最近活动的用户
-    online_users = db_session.query(ChatLastView).filter(
-        ChatLastView.room_id == room_id,
-        ChatLastView.last_view >= cutoff_time
-    ).all()
-    
-    users_data = []
-    user_ids = [view.user_id for view in online_users]
-    if user_ids:
-        users = db_session.query(User).filter(User.id.in_(user_ids)).all()
-        for user in users:
-            users_data.append({
-                'id': user.id,
-                'username': user.username,
-                'nickname': user.nickname or user.username,
-                'color': user.color,
-                'badge': user.badge
-            })
-    
-    return users_data
+    return get_room_users_data(room_id)
+
+def compute_unread_counts(user):
+    """计算用户在所有可访问聊天室与贴吧分区上的未读数量。
+
+    查询次数与房间/分区数量无关：房间、分区、两类权限各一次，
+    未读数通过 last_view 子查询关联后按 room_id / section_id 分组统计。
+    用户当前所在的聊天室未读数为 0。
+    返回 dict: chat_counts, forum_counts, rooms, sections
+    """
+    # 离开房间时记录的最后查看时间可能还未写入
+    if last_seen_aggregator.has_views_for(user.id):
+        last_seen_aggregator.flush()
+    is_admin = user.is_admin()
+
+    rooms = db_session.query(ChatRoom).all()
+    chat_perms = {} if is_admin else get_chat_permission_map(user)
+    accessible_rooms = [room for room in rooms if is_admin or chat_perms.get(room.id, 'Null') != 'Null']
+    room_ids = [room.id for room in accessible_rooms]
+
+    sections = db_session.query(ForumSection).all()
+    forum_perms = {} if is_admin else get_forum_permission_map(user)
+    accessible_sections = [section for section in sections if is_admin or forum_perms.get(section.id, 'Null') != 'Null']
+    section_ids = [section.id for section in accessible_sections]
+
+    chat_counts = dict.fromkeys(room_ids, 0)
+    # 用户当前所在的房间（任一标签页打开着）中的消息已实时送达，不计未读；
+    # 最后查看时间在离开房间或在线状态超时时才记录，不能用来统计这些房间
+    present_rooms = set(presence.rooms_of(user.id))
+    counted_room_ids = [room_id for room_id in room_ids if room_id not in present_rooms]
+    if counted_room_ids:
+        # 同一房间可能存在多条历史记录，取最新的查看时间
+        chat_views = db_session.query(
+            ChatLastView.room_id.label('room_id'),
+            func.max(ChatLastView.last_view).label('last_view')
+        ).filter(ChatLastView.user_id == user.id).group_by(ChatLastView.room_id).subquery()
+        rows = db_session.query(ChatMessage.room_id, func.count(ChatMessage.id)) \
+            .outerjoin(chat_views, chat_views.c.room_id == ChatMessage.room_id) \
+            .filter(ChatMessage.room_id.in_(counted_room_ids),
+                    or_(chat_views.c.last_view.is_(None), ChatMessage.timestamp > chat_views.c.last_view)) \
+            .group_by(ChatMessage.room_id).all()
+        chat_counts.update(rows)
+
+    forum_counts = dict.fromkeys(section_ids, 0)
+    if section_ids:
+        forum_views = db_session.query(
+            ForumLastView.section_id.label('section_id'),
+            func.max(ForumLastView.last_view).label('last_view')
+        ).filter(ForumLastView.user_id == user.id).group_by(ForumLastView.section_id).subquery()
+        thread_rows = db_session.query(ForumThread.section_id, func.count(ForumThread.id)) \
+            .outerjoin(forum_views, forum_views.c.section_id == ForumThread.section_id) \
+            .filter(ForumThread.section_id.in_(section_ids),
+                    or_(forum_views.c.last_view.is_(None), ForumThread.timestamp > forum_views.c.last_view)) \
+            .group_by(ForumThread.section_id).all()
+        # 回复：需要关联 thread -> section
+        reply_rows = db_session.query(ForumThread.section_id, func.count(ForumReply.id)) \
+            .join(ForumThread, ForumReply.thread_id == ForumThread.id) \
+            .outerjoin(forum_views, forum_views.c.section_id == ForumThread.section_id) \
+            .filter(ForumThread.section_id.in_(section_ids),
+                    or_(forum_views.c.last_view.is_(None), ForumReply.timestamp > forum_views.c.last_view)) \
+            .group_by(ForumThread.section_id).all()
+        for section_id, cnt in thread_rows + reply_rows:
+            forum_counts[section_id] += cnt
+
+    return {
+        'chat_counts': chat_counts,
+        'forum_counts': forum_counts,
+        'rooms': accessible_rooms,
+        'sections': accessible_sections
+    }
 
 def get_recent_logs(limit=10):
     """获取最近的系统日志"""
@@ -737,63 +2393,112 @@ def log_admin_action(action):
         except Exception as e2:
             print(f"记录管理员操作失败(二次错误): {str(e2)}")
 
+DEFAULT_QUOTE = "书山有路勤为径，学海无涯苦作舟。 - 韩愈"
+
+
+class QuotesStore:
+    """quotes.json 的内存缓存。
+
+    只有文件 mtime 变化时才重新读取，并预先格式化为 "text - author" 列表供随机选取；
+    管理端的修改在锁内完成读-改-写，通过临时文件 + os.replace 原子替换。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._mtime = None
+        self._quotes = []
+        self._formatted = []
+        self._error = None
+
+    def _read_file(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _set(self, quotes_data, mtime):
+        quotes = quotes_data.get('quotes', [])
+        self._quotes = quotes
+        # Format the quote as "text - author"
+        self._formatted = [f"{quote['text']} - {quote['author']}" for quote in quotes if 'text' in quote and 'author' in quote]
+        self._mtime = mtime
+        self._error = None
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError as e:
+            with self._lock:
+                self._mtime, self._quotes, self._formatted, self._error = None, [], [], e
+            return
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                self._set(self._read_file(), mtime)
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                self._mtime, self._quotes, self._formatted, self._error = mtime, [], [], e
+
+    def quotes(self):
+        """返回名言列表副本；文件不存在或格式错误时抛出对应异常"""
+        self._refresh()
+        if self._error:
+            raise self._error
+        return list(self._quotes)
+
+    def random_quote(self):
+        """随机返回一条格式化后的名言，没有可用名言时返回 None"""
+        self._refresh()
+        formatted = self._formatted
+        return random.choice(formatted) if formatted else None
+
+    def update(self, fn):
+        """在写锁内读取最新文件，调用 fn(quotes) 修改列表后原子写回，返回 fn 的结果"""
+        with self._write_lock:
+            quotes_data = self._read_file()
+            quotes_data.setdefault('quotes', [])
+            result = fn(quotes_data['quotes'])
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                mode = stat.S_IMODE(os.stat(self.path).st_mode)
+            except FileNotFoundError:
+                mode = 0o644
+            fd, tmp_path = tempfile.mkstemp(prefix='.quotes_', suffix='.json', dir=directory)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(quotes_data, f, ensure_ascii=False, indent=2)
+                # mkstemp 创建的文件权限为 0600，替换前恢复原文件的权限
+                os.chmod(tmp_path, mode)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            with self._lock:
+                self._set(quotes_data, os.stat(self.path).st_mtime_ns)
+            return result
+
+
+quotes_store = QuotesStore('quotes.json')
+
+
 # 路由定义
 @app.route('/')
 def index():
     # If user is authenticated, show the homepage; otherwise redirect to login
     if current_user.is_authenticated:
         # Get unread counts for the homepage
-        chat_counts = {}
-        forum_counts = {}
-        
-        # Chat rooms
-        rooms = db_session.query(ChatRoom).all()
-        accessible_rooms = []
-        for room in rooms:
-            if get_chat_permission_value(current_user, room.id) == 'Null':
-                continue
-            last = db_session.query(ChatLastView).filter_by(user_id=current_user.id, room_id=room.id).first()
-            if last:
-                cnt = db_session.query(ChatMessage).filter(ChatMessage.room_id == room.id, ChatMessage.timestamp > last.last_view).count()
-            else:
-                cnt = db_session.query(ChatMessage).filter_by(room_id=room.id).count()
-            chat_counts[room.id] = cnt
-            accessible_rooms.append(room)
-
-        # Forum sections
-        sections = db_session.query(ForumSection).all()
-        accessible_sections = []
-        for section in sections:
-            if get_forum_permission_value(current_user, section.id) == 'Null':
-                continue
-            last = db_session.query(ForumLastView).filter_by(user_id=current_user.id, section_id=section.id).first()
-            if last:
-                last_time = last.last_view
-                cnt_threads = db_session.query(ForumThread).filter(ForumThread.section_id == section.id, ForumThread.timestamp > last_time).count()
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id) \
-                    .filter(ForumThread.section_id == section.id, ForumReply.timestamp > last_time).count()
-            else:
-                cnt_threads = db_session.query(ForumThread).filter_by(section_id=section.id).count()
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id) \
-                    .filter(ForumThread.section_id == section.id).count()
-            forum_counts[section.id] = cnt_threads + cnt_replies
-            accessible_sections.append(section)
+        unread = compute_unread_counts(current_user)
+        chat_counts = unread['chat_counts']
+        forum_counts = unread['forum_counts']
+        accessible_rooms = unread['rooms']
+        accessible_sections = unread['sections']
         
-        # Load quotes from JSON file for the "一言" module
-        import random
-        try:
-            with open('quotes.json', 'r', encoding='utf-8') as f:
-                quotes_data = json.load(f)
-                quotes = quotes_data.get('quotes', [])
-                # Format the quote as "text - author"
-                formatted_quotes = [f"{quote['text']} - {quote['author']}" for quote in quotes if 'text' in quote and 'author' in quote]
-                selected_quote = random.choice(formatted_quotes) if formatted_quotes else "书山有路勤为径，学海无涯苦作舟。 - 韩愈"
-        except FileNotFoundError:
-            # Fallback if JSON file doesn't exist
-            selected_quote = "书山有路勤为径，学海无涯苦作舟。 - 韩愈"
-        except json.JSONDecodeError:
-            # Fallback if JSON is invalid
-            selected_quote = "书山有路勤为径，学海无涯苦作舟。 - 韩愈"
+        # "一言" module: quotes are cached and reloaded only when quotes.json changes
+        selected_quote = quotes_store.random_quote() or DEFAULT_QUOTE
         
         return render_template('index.html', 
                              chat_counts=chat_counts, 
@@ -818,6 +2523,7 @@ def login():
         login_user(user)
         user.last_seen = datetime.now(timezone.utc)
         db_session.commit()
+        online_tracker.touch(user.id)
         log_admin_action(f"用户登录: {user.username}")
         return redirect(url_for('index'))
     
@@ -857,6 +2563,8 @@ def profile():
         current_user.color = form.color.data or '#000000'
         current_user.badge = form.badge.data
         db_session.commit()
+        user_profiles.invalidate(current_user.id)
+        recent_messages.invalidate()
         log_admin_action(f"用户更新个人资料: {current_user.username}")
         flash('个人资料已更新', 'success')
         return redirect(url_for('profile'))
@@ -908,6 +2616,576 @@ def chat_room(room_id):
 
     return render_template('chat/room.html', room=room, room_permission=permission)
 
+class ChatWriteQueue:
+    """聊天消息写后（write-behind）队列。
+
+    开启后消息先由单调递增的 ID 分配器取得 ID 并立即广播，再进入内存队列，
+    由后台任务每 interval_ms 毫秒或累计 batch_size 条时在一个事务中批量写入。
+    关闭时 store() 直接同步提交，行为与原来一致。
+
+    批量写入失败时改为逐条写入，避免一行坏数据阻塞整个队列：违反约束（如用户或房间已被删除）的行
+    直接丢弃，其他失败的行放回队首，重试超过 max_retries 次后丢弃。丢弃的行保留在 dead_letters 中。
+    """
+
+    COLUMNS = ('id', 'content', 'timestamp', 'user_id', 'room_id')
+
+    def __init__(self, enabled, interval_ms, batch_size, max_retries=50):
+        self.enabled = enabled
+        self.interval = interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._pending = []   # 等待写入的行
+        self._inflight = []  # 正在写入的行
+        self.dead_letters = deque(maxlen=1000)  # 最近丢弃的行（附带错误信息）
+        self._next_id = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker_started = False
+        self.flushed_total = 0
+        self.flush_failures = 0
+        self.dropped_total = 0
+        self.last_flush_at = None
+
+    def _allocate_id(self):
+        # 调用方需持有 self._lock
+        if self._next_id is None:
+            max_id = db_session.query(func.max(ChatMessage.id)).scalar() or 0
+            self._next_id = max_id + 1
+        message_id = self._next_id
+        self._next_id += 1
+        return message_id
+
+    def store(self, user_id, room_id, content):
+        """保存一条新消息，返回带 id 与 timestamp 的 ChatMessage"""
+        if not self.enabled:
+            message = ChatMessage(content=content, user_id=user_id, room_id=room_id)
+            db_session.add(message)
+            db_session.commit()
+            return message
+
+        self._ensure_worker()
+        with self._lock:
+            row = {
+                'id': self._allocate_id(),
+                'content': content,
+                'timestamp': datetime.utcnow(),
+                'user_id': user_id,
+                'room_id': room_id,
+                'queued_at': time.time(),
+            }
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        return ChatMessage(id=row['id'], content=content, timestamp=row['timestamp'],
+                           user_id=user_id, room_id=room_id)
+
+    def last_pending(self, user_id, room_id):
+        """返回该用户在房间内尚未落库的最后一条消息（不存在时返回 None）"""
+        with self._lock:
+            for row in reversed(self._inflight + self._pending):
+                if row['user_id'] == user_id and row['room_id'] == room_id:
+                    return ChatMessage(id=row['id'], content=row['content'], timestamp=row['timestamp'],
+                                       user_id=user_id, room_id=room_id)
+        return None
+
+    def update_pending(self, message_id, content):
+        """修改尚在队列中的消息内容，消息已开始写入时返回 False"""
+        with self._lock:
+            for row in self._pending:
+                if row['id'] == message_id:
+                    row['content'] = content
+                    return True
+        return False
+
+    def flush_if_pending(self, message_ids):
+        """如果给定消息中有尚未落库的，先执行一次写入，保证随后的查询能看到它们"""
+        if not self.enabled or not message_ids:
+            return
+        ids = set(message_ids)
+        with self._lock:
+            waiting = any(row['id'] in ids for row in self._inflight + self._pending)
+        if waiting:
+            self.flush()
+
+    def flush(self):
+        """把队列中的消息批量写入数据库，返回写入条数"""
+        if not self.enabled:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._inflight, self._pending = self._pending, []
+                batch = list(self._inflight)
+            try:
+                self._insert(batch)
+                written, retry = len(batch), []
+            except Exception as e:
+                self.flush_failures += 1
+                logger.warning(f"批量写入聊天消息失败（{len(batch)} 条），改为逐条写入: {str(e)}")
+                written, retry = self._insert_each(batch)
+            with self._lock:
+                # 失败待重试的行放回队首，保持消息顺序
+                self._pending = retry + self._pending
+                self._inflight = []
+            self.flushed_total += written
+            if written:
+                self.last_flush_at = time.time()
+            return written
+
+    def _insert(self, rows):
+        with engine.begin() as conn:
+            conn.execute(ChatMessage.__table__.insert(),
+                         [{key: row[key] for key in self.COLUMNS} for row in rows])
+
+    def _insert_each(self, rows):
+        """逐条写入，返回 (写入条数, 需要重试的行)"""
+        written = 0
+        retry = []
+        for row in rows:
+            try:
+                self._insert([row])
+                written += 1
+            except Exception as e:
+                row['attempts'] = row.get('attempts', 0) + 1
+                if isinstance(e, IntegrityError) or row['attempts'] > self.max_retries:
+                    self.dropped_total += 1
+                    self.dead_letters.append(dict(row, error=str(e)))
+                    logger.error(f"聊天消息 {row['id']}（房间 {row['room_id']}，用户 {row['user_id']}）"
+                                 f"写入失败 {row['attempts']} 次，已丢弃: {str(e)}")
+                else:
+                    retry.append(row)
+        return written, retry
+
+    def _ensure_worker(self):
+        if self._worker_started:
+            return
+        self._worker_started = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('聊天消息后台写入任务异常')
+
+    def stats(self):
+        """队列状态，lag_seconds 为最早一条未落库消息已等待的时间"""
+        with self._lock:
+            waiting = self._inflight + self._pending
+            oldest = min((row['queued_at'] for row in waiting), default=None)
+            pending = len(waiting)
+        return {
+            'enabled': self.enabled,
+            'pending': pending,
+            'retrying': sum(1 for row in waiting if row.get('attempts')),
+            'dropped_total': self.dropped_total,
+            'lag_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+            'flushed_total': self.flushed_total,
+            'flush_failures': self.flush_failures,
+            'last_flush_at': datetime.fromtimestamp(self.last_flush_at).isoformat() if self.last_flush_at else None,
+        }
+
+
+if app.config.get('CHAT_WRITE_BEHIND') and shared_state.distributed:
+    # 写后模式在进程内分配消息ID，多个工作进程会分配出重复的ID
+    logger.warning('多进程模式（SHARED_STATE_URL 为 Redis）不支持 CHAT_WRITE_BEHIND，已改为同步写入')
+chat_write_queue = ChatWriteQueue(app.config.get('CHAT_WRITE_BEHIND', False) and not shared_state.distributed,
+                                  app.config.get('CHAT_WRITE_BEHIND_INTERVAL_MS', 200),
+                                  app.config.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 100),
+                                  app.config.get('CHAT_WRITE_BEHIND_MAX_RETRIES', 50))
+# 进程正常退出时写入剩余消息（SIGTERM/SIGINT 不会触发 atexit，见 install_shutdown_handlers）
+atexit.register(chat_write_queue.flush)
+
+
+def flush_pending_writes():
+    """写入写后队列中的消息与聚合的最后活动时间（进程退出前调用）"""
+    chat_write_queue.flush()
+    last_seen_aggregator.flush()
+
+
+def update_chat_message_content(message, content, user=None):
+    """修改消息内容：仍在写后队列中的直接改队列，否则写数据库。
+
+    返回修改后的消息结构（已放入最近消息缓存，可直接用于广播）。
+    """
+    if not chat_write_queue.update_pending(message.id, content):
+        chat_write_queue.flush()
+        db_session.query(ChatMessage).filter_by(id=message.id).update({'content': content})
+        db_session.commit()
+    message.content = content
+    message_dict = chat_message_to_dict(message, user)
+    recent_messages.replace(message.room_id, message_dict)
+    return message_dict
+
+
+def author_fields(user):
+    """消息/回复中的作者字段；作者已被删除时为 None"""
+    if user is None:
+        return {'username': None, 'nickname': None, 'color': None, 'badge': None}
+    profile = user_profile(user)
+    del profile['id']
+    return profile
+
+
+def chat_message_to_dict(msg, user=None):
+    """聊天消息的 JSON 结构（HTTP 接口、Socket.IO 与 SSE 事件共用）
+
+    user 用于尚未落库、没有加载 user 关系的消息对象（通常是 current_user）；
+    列表查询应使用 chat_message_query() 以 JOIN 一次取得作者，避免逐条加载。
+    内容还原为原始Markdown；返回 PreEncoded，编码结果在广播、缓存和历史接口之间复用。
+    """
+    content = msg.content
+    if isinstance(content, str):
+        content = html.unescape(content)
+    data = PreEncoded(
+        id=msg.id,
+        content=content,
+        timestamp=msg.timestamp.isoformat(),
+        user_id=msg.user_id,
+    )
+    data.update(author_fields(user if user is not None else msg.user))
+    return data
+
+
+def chat_message_query():
+    """预先 JOIN 作者的聊天消息查询"""
+    return db_session.query(ChatMessage).options(joinedload(ChatMessage.user))
+
+
+def forum_reply_to_dict(reply):
+    """论坛回复的 JSON 结构"""
+    data = {
+        'id': reply.id,
+        'thread_id': reply.thread_id,
+        'user_id': reply.user_id,
+        'content': reply.content,
+        'timestamp': reply.timestamp.isoformat() if hasattr(reply.timestamp, 'isoformat') else str(reply.timestamp)
+    }
+    data.update(author_fields(reply.user))
+    return data
+
+
+def encode_history_cursor(room_id, message_id):
+    """生成不透明的历史消息游标"""
+    raw = f"{room_id}:{message_id}".encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_history_cursor(cursor, room_id):
+    """解析游标，返回消息ID；游标无效或不属于该房间时返回 None"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_room, message_id = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii').split(':', 1)
+        if int(cursor_room) != room_id:
+            return None
+        return int(message_id)
+    except Exception:
+        return None
+
+
+class RecentMessageCache:
+    """每个聊天室最近 capacity 条消息的内存环形缓冲（已序列化的字典）。
+
+    缓冲始终是房间消息按 id 排序的连续尾部，并记录房间消息总数，
+    因此 page=last 与 after_id 增量读取可以不查数据库。房间首次读取时加载一次，
+    之后由发送、删除与重复合并路径维护；批量删除等难以精确维护的操作直接让房间失效。
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 0)
+        self._rooms = {}        # room_id -> {'messages': deque, 'total': int}
+        self._generations = {}  # room_id -> 修改计数，用于丢弃加载期间已过时的结果
+        self._epoch = 0         # 全部失效的次数
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _bump(self, room_id):
+        # 调用方需持有 self._lock
+        self._generations[room_id] = self._generations.get(room_id, 0) + 1
+
+    def _generation(self, room_id):
+        # 调用方需持有 self._lock
+        return self._epoch, self._generations.get(room_id, 0)
+
+    def _load(self, room_id):
+        """从数据库加载房间尾部消息；加载期间房间被修改时不缓存本次结果"""
+        with self._lock:
+            generation = self._generation(room_id)
+        # 写后模式下先落库，保证加载的尾部完整
+        chat_write_queue.flush()
+        total = db_session.query(func.count(ChatMessage.id)).filter(ChatMessage.room_id == room_id).scalar() or 0
+        rows = chat_message_query()\
+            .filter(ChatMessage.room_id == room_id)\
+            .order_by(ChatMessage.id.desc()).limit(self.capacity).all()
+        room = {'messages': deque((chat_message_to_dict(msg) for msg in reversed(rows)), maxlen=self.capacity),
+                'total': total}
+        with self._lock:
+            if self._generation(room_id) == generation:
+                self._rooms[room_id] = room
+        return room
+
+    def _room(self, room_id):
+        """返回 (房间缓冲, 是否命中)，未加载的房间先从数据库加载"""
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                self.misses += 1
+        if room is None:
+            return self._load(room_id), False
+        return room, True
+
+    def last_page(self, room_id, limit):
+        """page=last 的 (messages, page, total_pages)，缓冲不足以覆盖最后一页时返回 None"""
+        if not self.capacity:
+            return None
+        room, hit = self._room(room_id)
+        with self._lock:
+            total = room['total']
+            total_pages = (total + limit - 1) // limit if total > 0 else 1
+            page = total_pages - 1
+            count = total - page * limit
+            if count > len(room['messages']):
+                # 删除使缓冲短于最后一页，下次读取时重新加载
+                self._rooms.pop(room_id, None)
+                if hit:
+                    self.misses += 1
+                return None
+            messages = list(room['messages'])[len(room['messages']) - count:] if count else []
+            if hit:
+                self.hits += 1
+        return messages, page, total_pages
+
+    def since(self, room_id, after_id, limit):
+        """after_id 之后的最多 limit 条消息与 has_more，缓冲未覆盖 after_id 时返回 None"""
+        if not self.capacity:
+            return None
+        room, hit = self._room(room_id)
+        with self._lock:
+            messages = room['messages']
+            covered = len(messages) == room['total'] or (messages and messages[0]['id'] <= after_id + 1)
+            if not covered:
+                if hit:
+                    self.misses += 1
+                return None
+            rows = [msg for msg in messages if msg['id'] > after_id]
+            if hit:
+                self.hits += 1
+        return rows[:limit], len(rows) > limit
+
+    @replicated('recent_messages')
+    def append(self, room_id, message_dict):
+        if not isinstance(message_dict, PreEncoded):
+            message_dict = PreEncoded(message_dict)  # 来自其他工作进程的同步调用
+        with self._lock:
+            self._bump(room_id)
+            room = self._rooms.get(room_id)
+            if room is None:
+                return
+            messages = room['messages']
+            if not messages or messages[-1]['id'] < message_dict['id']:
+                messages.append(message_dict)
+                room['total'] += 1
+                return
+            # 多进程时其他进程的消息可能晚于本进程更新的消息到达，按 ID 插入到正确位置
+            if any(msg['id'] == message_dict['id'] for msg in messages):
+                return
+            index = len(messages)
+            while index > 0 and messages[index - 1]['id'] > message_dict['id']:
+                index -= 1
+            if len(messages) == messages.maxlen:
+                if index == 0:
+                    return  # 比缓存中最早的消息还早，不在缓存窗口内
+                messages.popleft()
+                index -= 1
+            messages.insert(index, message_dict)
+            room['total'] += 1
+
+    @replicated('recent_messages')
+    def replace(self, room_id, message_dict):
+        """消息内容被修改，用新的结构替换缓存中的同 ID 消息"""
+        if not isinstance(message_dict, PreEncoded):
+            message_dict = PreEncoded(message_dict)
+        with self._lock:
+            self._bump(room_id)
+            room = self._rooms.get(room_id)
+            if room is None:
+                return
+            for index, msg in enumerate(room['messages']):
+                if msg['id'] == message_dict['id']:
+                    room['messages'][index] = message_dict
+                    break
+
+    @replicated('recent_messages')
+    def remove(self, room_id, message_id):
+        """消息已从数据库删除"""
+        with self._lock:
+            self._bump(room_id)
+            room = self._rooms.get(room_id)
+            if room is None:
+                return
+            room['total'] = max(0, room['total'] - 1)
+            for msg in room['messages']:
+                if msg['id'] == message_id:
+                    room['messages'].remove(msg)
+                    break
+
+    @replicated('recent_messages')
+    def invalidate(self, room_id=None):
+        """让一个房间（room_id 为 None 时为全部房间）在下次读取时重新加载"""
+        with self._lock:
+            if room_id is None:
+                self._epoch += 1
+                self._rooms.clear()
+            else:
+                self._bump(room_id)
+                self._rooms.pop(room_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity': self.capacity,
+                'rooms': len(self._rooms),
+                'messages': sum(len(room['messages']) for room in self._rooms.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+recent_messages = RecentMessageCache(app.config.get('CHAT_RECENT_CACHE_SIZE', 200))
+
+
+class ChatTombstones:
+    """聊天消息删除记录（墓碑），供轮询客户端增量同步删除。
+
+    每次删除分配一个递增序号，客户端用不透明游标记住已同步到的位置。
+    批量删除不逐条记录，而是写入一条整房间（room_id 为 None 时为全部房间）的重新同步标记；
+    游标来自重启前的进程或已被淘汰出记录窗口时同样要求重新同步。
+    """
+
+    def __init__(self, capacity):
+        self._entries = deque(maxlen=max(int(capacity), 1))  # (seq, room_id, message_id)，message_id 为 None 表示重新同步
+        self._seq = 0
+        self._epoch = secrets.token_hex(4)
+        self._lock = threading.Lock()
+
+    @replicated('chat_tombstones')
+    def record(self, room_id, message_id=None):
+        with self._lock:
+            self._seq += 1
+            self._entries.append((self._seq, room_id, message_id))
+
+    def _cursor(self):
+        # 调用方需持有 self._lock
+        return f'{self._epoch}.{self._seq}'
+
+    def since(self, room_id, cursor):
+        """返回 (已删除的消息ID列表, 是否需要重新同步, 新游标)；cursor 为空时只返回当前游标"""
+        with self._lock:
+            if not cursor:
+                return [], False, self._cursor()
+            try:
+                epoch, seq = cursor.split('.', 1)
+                seq = int(seq)
+            except ValueError:
+                return [], True, self._cursor()
+            oldest = self._entries[0][0] if self._entries else self._seq + 1
+            if epoch != self._epoch or seq > self._seq or (seq < self._seq and oldest > seq + 1):
+                return [], True, self._cursor()
+            deleted = []
+            resync = False
+            for entry_seq, entry_room, message_id in reversed(self._entries):
+                if entry_seq <= seq:
+                    break
+                if entry_room is not None and entry_room != room_id:
+                    continue
+                if message_id is None:
+                    resync = True
+                else:
+                    deleted.append(message_id)
+            deleted.reverse()
+            return deleted, resync, self._cursor()
+
+
+chat_tombstones = ChatTombstones(app.config.get('CHAT_TOMBSTONE_LOG_SIZE', 1000))
+
+
+class RoomEventHub:
+    """聊天室事件的 SSE 订阅者登记表。
+
+    每个订阅者一个由 Socket.IO 异步驱动创建的队列（eventlet 下为协程队列），
+    请求阻塞在队列上等待，不查询数据库；broadcast_room_event 发布事件时唤醒。
+    积压超过 max_queue 的订阅者视为已断开并被移除。
+    """
+
+    def __init__(self, max_queue):
+        self.max_queue = max_queue
+        self._subscribers = {}  # room_id -> set(queue)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, room_id):
+        queue = socketio.server.eio.create_queue()
+        with self._lock:
+            self._subscribers.setdefault(room_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, room_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(room_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[room_id]
+
+    @replicated('room_events')
+    def publish(self, room_id, event, payload):
+        with self._lock:
+            queues = list(self._subscribers.get(room_id, ()))
+        for queue in queues:
+            if queue.qsize() >= self.max_queue:
+                # 客户端读取过慢，结束该连接，由客户端重连后补齐
+                self.unsubscribe(room_id, queue)
+                queue.put(None)
+                self.dropped += 1
+                continue
+            queue.put((event, payload))
+        self.published += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._subscribers),
+                'subscribers': sum(len(queues) for queues in self._subscribers.values()),
+                'published': self.published,
+                'dropped': self.dropped,
+            }
+
+
+room_events = RoomEventHub(app.config.get('SSE_MAX_QUEUE', 500))
+
+
+def broadcast_room_event(event, payload, room_id):
+    """广播聊天室事件：Socket.IO 客户端（room_{room_id}）与 SSE 订阅者共用同一入口"""
+    socketio.emit(event, payload, to=f'room_{room_id}')
+    room_events.publish(room_id, event, payload)
+
+
+def format_sse(event, payload, event_id=None):
+    """编码一条 Server-Sent Events 消息"""
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    return ('\n'.join(lines) + '\ndata: ').encode('utf-8') + encode_json(payload) + b'\n\n'
+
+
 @app.route('/api/chat/<int:room_id>/history')
 @login_required
 def chat_history(room_id):
@@ -916,24 +3194,75 @@ def chat_history(room_id):
         return jsonify(success=False, message="权限不足"), 403
 
     limit = min(request.args.get('limit', 50, type=int), 100)
+
+    # 游标分页：before/after 为不透明游标，before_id/after_id 为消息ID。
+    # 基于 (room_id, id) 索引定位，每次只查询一次且不需要 COUNT。
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    for param in ('before', 'after'):
+        cursor = request.args.get(param)
+        if cursor:
+            cursor_id = decode_history_cursor(cursor, room_id)
+            if cursor_id is None:
+                return jsonify(success=False, message="无效的游标"), 400
+            if param == 'before':
+                before_id = cursor_id
+            else:
+                after_id = cursor_id
+    if before_id is not None and after_id is not None:
+        return jsonify(success=False, message="before 与 after 不能同时使用"), 400
+    if before_id is not None or after_id is not None:
+        if limit < 1:
+            limit = 1
+        if before_id is None:
+            # 增量读取通常只需要最近几条，优先由内存缓冲提供
+            cached = recent_messages.since(room_id, after_id, limit)
+            if cached is not None:
+                messages_data, has_more = cached
+                prev_cursor = encode_history_cursor(room_id, messages_data[0]['id']) if messages_data else None
+                next_cursor = encode_history_cursor(room_id, messages_data[-1]['id'] if messages_data else after_id)
+                return jsonify(messages=messages_data, has_more=has_more,
+                               prev_cursor=prev_cursor, next_cursor=next_cursor)
+        # 写后模式下先把队列中的消息写入，保证历史记录完整
+        chat_write_queue.flush()
+        query = chat_message_query().filter(ChatMessage.room_id == room_id)
+        if before_id is not None:
+            # 向前翻页：取 before_id 之前最近的 limit 条，多取一条用于判断是否还有更早的消息
+            rows = query.filter(ChatMessage.id < before_id)\
+                .order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            messages = list(reversed(rows[:limit]))
+            prev_cursor = encode_history_cursor(room_id, messages[0].id) if has_more else None
+            next_cursor = encode_history_cursor(room_id, messages[-1].id) if messages else None
+        else:
+            # 向后翻页：取 after_id 之后的 limit 条，多取一条用于判断是否还有更新的消息
+            rows = query.filter(ChatMessage.id > after_id)\
+                .order_by(ChatMessage.id.asc()).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            messages = rows[:limit]
+            prev_cursor = encode_history_cursor(room_id, messages[0].id) if messages else None
+            next_cursor = encode_history_cursor(room_id, messages[-1].id if messages else after_id)
+        return jsonify(messages=[chat_message_to_dict(msg) for msg in messages],
+                       has_more=has_more, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
     # 支持 page 参数（0-based）或特殊值 'last'
     page_param = request.args.get('page')
+    if isinstance(page_param, str) and page_param.lower() == 'last' and limit > 0:
+        # 打开聊天室时读取最后一页，由内存缓冲提供，不需要 COUNT 与 OFFSET 查询
+        cached = recent_messages.last_page(room_id, limit)
+        if cached is not None:
+            messages_data, page, total_pages = cached
+            prev_cursor = encode_history_cursor(room_id, messages_data[0]['id']) if messages_data and page > 0 else None
+            return jsonify(messages=messages_data, page=page, total_pages=total_pages, has_more=False,
+                           prev_cursor=prev_cursor)
+    chat_write_queue.flush()
     if page_param is None:
         # 使用 offset/limit 兼容旧客户端
         offset = request.args.get('offset', 0, type=int)
         # 按时间戳升序排列（最旧的在前），确保消息按时间顺序排列
-        messages = db_session.query(ChatMessage).filter_by(room_id=room_id)\
+        messages = chat_message_query().filter_by(room_id=room_id)\
             .order_by(ChatMessage.timestamp.asc()).limit(limit).offset(offset).all()
-        messages_data = [{
-            'id': msg.id,
-            'content': html.unescape(msg.content) if isinstance(msg.content, str) else msg.content,
-            'timestamp': msg.timestamp.isoformat(),
-            'user_id': msg.user_id,
-            'username': msg.user.username,
-            'nickname': msg.user.nickname or msg.user.username,
-            'color': msg.user.color,
-            'badge': msg.user.badge
-        } for msg in messages]
+        messages_data = [chat_message_to_dict(msg) for msg in messages]
         return jsonify(messages=messages_data)
     else:
         # 计算分页信息并返回指定页（支持 page='last'）
@@ -953,27 +3282,112 @@ def chat_history(room_id):
         if page < 0: page = 0
         if page >= total_pages: page = total_pages - 1
         offset = page * limit
-        messages = db_session.query(ChatMessage).filter_by(room_id=room_id)\
-            .order_by(ChatMessage.timestamp.asc()).limit(limit).offset(offset).all()
+        # 按 ID 排序，与游标分页使用同一个键，返回的 prev_cursor 才能接续本页
+        messages = chat_message_query().filter_by(room_id=room_id)\
+            .order_by(ChatMessage.id.asc()).limit(limit).offset(offset).all()
         
         # Check if there are more messages after this page
         # Using a more compatible approach to check for existence
         next_offset = (page + 1) * limit
         next_batch = db_session.query(ChatMessage.id).filter_by(room_id=room_id)\
-                      .order_by(ChatMessage.timestamp.asc()).limit(1).offset(next_offset).all()
+                      .order_by(ChatMessage.id.asc()).limit(1).offset(next_offset).all()
         has_more = len(next_batch) > 0
         
-        messages_data = [{
-            'id': msg.id,
-            'content': html.unescape(msg.content) if isinstance(msg.content, str) else msg.content,
-            'timestamp': msg.timestamp.isoformat(),
-            'user_id': msg.user_id,
-            'username': msg.user.username,
-            'nickname': msg.user.nickname or msg.user.username,
-            'color': msg.user.color,
-            'badge': msg.user.badge
-        } for msg in messages]
-        return jsonify(messages=messages_data, page=page, total_pages=total_pages, has_more=has_more)
+        messages_data = [chat_message_to_dict(msg) for msg in messages]
+        # 附带游标，新客户端可改用 before 游标继续向前加载，避免大 OFFSET 扫描
+        prev_cursor = encode_history_cursor(room_id, messages[0].id) if messages and page > 0 else None
+        return jsonify(messages=messages_data, page=page, total_pages=total_pages, has_more=has_more,
+                       prev_cursor=prev_cursor)
+
+@app.route('/api/chat/<int:room_id>/since/<int:last_id>')
+@login_required
+def chat_messages_since(room_id, last_id):
+    """增量获取 last_id 之后的新消息与删除记录（轮询客户端使用）
+
+    查询参数：limit（默认100，最大200），tombstones（上次返回的删除记录游标）。
+    """
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    limit = max(1, min(request.args.get('limit', 100, type=int), 200))
+    cached = recent_messages.since(room_id, last_id, limit)
+    if cached is not None:
+        messages_data, has_more = cached
+    else:
+        # 基于 (room_id, id) 索引定位，多取一条用于判断是否还有更多
+        chat_write_queue.flush()
+        rows = chat_message_query()\
+            .filter(ChatMessage.room_id == room_id, ChatMessage.id > last_id)\
+            .order_by(ChatMessage.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        messages_data = [chat_message_to_dict(msg) for msg in rows[:limit]]
+
+    deleted, resync, tombstones = chat_tombstones.since(room_id, request.args.get('tombstones'))
+    return jsonify(success=True, messages=messages_data, has_more=has_more,
+                   last_id=messages_data[-1]['id'] if messages_data else last_id,
+                   deleted=deleted, resync=resync, tombstones=tombstones)
+
+@app.route('/api/chat/<int:room_id>/events')
+@login_required
+def chat_event_stream(room_id):
+    """聊天室事件流（Server-Sent Events），供无法使用 WebSocket 的客户端
+
+    推送 message / message_updated / message_deleted 事件，数据与 Socket.IO 事件一致。
+    重连时根据 Last-Event-ID 头（或 last_id 参数）先补发错过的消息。
+    """
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_id', type=int)
+    # 先订阅再补发，避免两者之间的消息丢失（重复消息由客户端按 id 去重）
+    queue = room_events.subscribe(room_id)
+    backlog = []
+    try:
+        if last_id is not None:
+            cached = recent_messages.since(room_id, last_id, 200)
+            if cached is not None:
+                backlog = cached[0]
+            else:
+                chat_write_queue.flush()
+                rows = chat_message_query()\
+                    .filter(ChatMessage.room_id == room_id, ChatMessage.id > last_id)\
+                    .order_by(ChatMessage.id.asc()).limit(200).all()
+                backlog = [chat_message_to_dict(msg) for msg in rows]
+    except Exception:
+        room_events.unsubscribe(room_id, queue)
+        raise
+    finally:
+        # 流式响应期间不占用数据库连接
+        db_session.remove()
+
+    keepalive = app.config.get('SSE_KEEPALIVE_INTERVAL', 15)
+    queue_empty = socketio.server.eio.get_queue_empty_exception()
+
+    def generate():
+        try:
+            yield f"retry: {app.config.get('SSE_RETRY_MS', 3000)}\n\n"
+            for msg in backlog:
+                yield format_sse('message', msg, msg['id'])
+            while True:
+                try:
+                    item = queue.get(timeout=keepalive)
+                except queue_empty:
+                    # 注释行用于保持连接并及时发现客户端断开
+                    yield ': keepalive\n\n'
+                    continue
+                if item is None:
+                    return
+                event, payload = item
+                yield format_sse(event, payload, payload.get('id') if event == 'message' else None)
+        finally:
+            room_events.unsubscribe(room_id, queue)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/chat/send', methods=['POST'])
 @login_required
@@ -983,57 +3397,77 @@ def send_chat_message():
         room_id = data.get('room_id')
         message = data.get('message', '')
     else:
+        data = request.form
         room_id = request.form.get('room_id')
         message = request.form.get('message', '')
 
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        room_id = None
+    captcha_id = data.get('captcha_id')
+    if captcha_id:
+        # 与 WebSocket 路径一致：验证通过后以服务器端保存的 pending 为准
+        pending, error = verify_send_captcha(current_user.id, captcha_id, data.get('captcha_answer'))
+        if error:
+            return jsonify(success=False, message=error), 400
+        room_id = pending.get('room_id')
+        message = pending.get('content')
+        if not room_id or not message:
+            return jsonify(success=False, message="参数错误"), 400
+        if not user_can_send_chat(current_user, room_id):
+            return jsonify(success=False, message="当前权限无法发送消息"), 403
+    else:
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            room_id = None
 
-    message = (message or '').strip()
+        message = (message or '').strip()
 
-    if not room_id or not message:
-        return jsonify(success=False, message="参数错误"), 400
+        if not room_id or not message:
+            return jsonify(success=False, message="参数错误"), 400
 
-    if not user_can_send_chat(current_user, room_id):
-        return jsonify(success=False, message="当前权限无法发送消息"), 403
+        if not user_can_send_chat(current_user, room_id):
+            return jsonify(success=False, message="当前权限无法发送消息"), 403
 
-    # XSS基础防护（保持与 WebSocket 路径一致）
-    try:
-        # 检查引用是否为自引用（引用即将保存的消息ID，这在当前情况下是不可能的，但我们可以检查引用模式）
-        # 首先解析消息中的引用ID
-        import re
-        quote_pattern = r'@quote\{(\d+)\}'
-        quote_matches = re.findall(quote_pattern, message)
-        quote_ids = [int(id) for id in quote_matches if id.isdigit()]
-        
-        # 检查是否有重复的引用ID（这可能表示自引用意图）
-        # 这里我们做更严格的检查：获取用户最近发送的消息ID，确保不引用这些ID
-        if quote_ids:
-            # 检查引用的消息是否在当前聊天室内存在（而不是简单地禁止引用自己的消息）
-            # 验证引用的消息是否真实存在且在当前聊天室内
-            valid_messages = db_session.query(ChatMessage.id).filter(
-                ChatMessage.id.in_(quote_ids),
-                ChatMessage.room_id == room_id
-            ).all()
-            valid_ids = {msg.id for msg in valid_messages}
-            invalid_quote_ids = [qid for qid in quote_ids if qid not in valid_ids]
-            if invalid_quote_ids:
-                return jsonify(success=False, message="不能引用不存在的消息"), 400
-        
-        message = sanitize_content(message, room_id)
-    except Exception:
-        pass
-    # 保存到数据库
-    message_obj = ChatMessage(
-        content=message,
-        user_id=current_user.id,
-        room_id=room_id
-    )
+        # XSS基础防护（保持与 WebSocket 路径一致）
+        try:
+            # 检查引用是否为自引用（引用即将保存的消息ID，这在当前情况下是不可能的，但我们可以检查引用模式）
+            # 首先解析消息中的引用ID
+            quote_pattern = r'@quote\{(\d+)\}'
+            quote_matches = re.findall(quote_pattern, message)
+            quote_ids = [int(id) for id in quote_matches if id.isdigit()]
+
+            # 检查是否有重复的引用ID（这可能表示自引用意图）
+            # 这里我们做更严格的检查：获取用户最近发送的消息ID，确保不引用这些ID
+            if quote_ids:
+                # 检查引用的消息是否在当前聊天室内存在（而不是简单地禁止引用自己的消息）
+                # 验证引用的消息是否真实存在且在当前聊天室内
+                chat_write_queue.flush_if_pending(quote_ids)
+                valid_messages = db_session.query(ChatMessage.id).filter(
+                    ChatMessage.id.in_(quote_ids),
+                    ChatMessage.room_id == room_id
+                ).all()
+                valid_ids = {msg.id for msg in valid_messages}
+                invalid_quote_ids = [qid for qid in quote_ids if qid not in valid_ids]
+                if invalid_quote_ids:
+                    return jsonify(success=False, message="不能引用不存在的消息"), 400
+
+            message = sanitize_content(message, room_id)
+        except Exception:
+            pass
+
+        # 发送限流：令牌桶已空时返回验证码，客户端带上 captcha_id 与 captcha_answer 重新提交
+        if not send_rate_limiter.consume(current_user.id):
+            captcha_id, question = issue_send_captcha(current_user.id, {
+                'room_id': room_id,
+                'content': message
+            })
+            return jsonify(success=False, message="发送过于频繁，请输入验证码",
+                           require_captcha=True, captcha_id=captcha_id, question=question), 429
+
+    # 保存到数据库（写后模式下进入批量写入队列）
     try:
-        db_session.add(message_obj)
-        db_session.commit()
+        saved = chat_write_queue.store(current_user.id, room_id, message)
+        message_dict = chat_message_to_dict(saved, current_user)
+        recent_messages.append(room_id, message_dict)
     except Exception as e:
         try:
             db_session.rollback()
@@ -1042,6 +3476,12 @@ def send_chat_message():
         logger.exception('HTTP 保存聊天消息失败')
         return jsonify(success=False, message='服务器保存消息失败'), 500
 
+    # 与 WebSocket 路径一样广播给房间内的 Socket.IO 与 SSE 客户端
+    try:
+        broadcast_room_event('message', message_dict, room_id)
+    except Exception:
+        logger.exception('广播 HTTP 发送的消息失败')
+
     # 返回成功响应
     return jsonify(success=True)
 
@@ -1051,6 +3491,7 @@ def send_chat_message():
 def api_delete_chat_message(room_id, message_id):
     """删除聊天室消息：只有 su（或管理员）可以删除任意消息；777 可删除自己消息。"""
     try:
+        chat_write_queue.flush_if_pending([message_id])
         msg = db_session.query(ChatMessage).filter_by(id=message_id, room_id=room_id).first()
         if not msg:
             return jsonify({'success': False, 'message': '消息未找到'}), 404
@@ -1073,17 +3514,18 @@ def api_delete_chat_message(room_id, message_id):
         # 执行删除
         db_session.delete(msg)
         db_session.commit()
+        recent_messages.remove(room_id, message_id)
+        chat_tombstones.record(room_id, message_id)
         logger.info(f"用户 {current_user.id} 删除了聊天室消息 {message_id} 在房间 {room_id}")
         try:
-                # 广播删除事件给所有客户端，客户端根据 room_id 决定是否处理
+                # 只通知该聊天室内的客户端
                 payload = {
                     'id': message_id,
                     'room_id': room_id,
                     'deleted_by': getattr(current_user, 'id', None),
                     'timestamp': datetime.now(timezone.utc).isoformat()
                 }
-                # 某些 socketio/server 版本不接受 broadcast 参数；默认 emit() 不带 to/room 会推送给所有连接
-                socketio.emit('message_deleted', payload)
+                broadcast_room_event('message_deleted', payload, room_id)
         except Exception as e:
             # 记录广播失败但不影响原有删除流程
             logger.exception('广播 message_deleted 失败')
@@ -1097,20 +3539,11 @@ def api_delete_chat_message(room_id, message_id):
 @app.route('/api/chat/message/<int:message_id>', methods=['GET'])
 @login_required
 def api_get_chat_message(message_id):
-    msg = db_session.query(ChatMessage).filter_by(id=message_id).first()
+    chat_write_queue.flush_if_pending([message_id])
+    msg = chat_message_query().filter_by(id=message_id).first()
     if not msg:
         return jsonify(success=False, message='消息不存在'), 404
-    user = msg.user
-    return jsonify(success=True, message={
-        'id': msg.id,
-        'content': html.unescape(msg.content) if isinstance(msg.content, str) else msg.content,
-        'timestamp': msg.timestamp.isoformat(),
-        'user_id': msg.user_id,
-        'username': user.username if user else None,
-        'nickname': user.nickname if user else None,
-        'color': user.color if user else None,
-        'badge': user.badge if user else None
-    })
+    return jsonify(success=True, message=chat_message_to_dict(msg))
 
 
 @app.route('/api/chat/message/search', methods=['GET'])
@@ -1123,6 +3556,7 @@ def api_search_chat_message():
     if not content:
         return jsonify(success=False, message='内容不能为空'), 400
     
+    chat_write_queue.flush()
     query = db_session.query(ChatMessage).filter_by(user_id=current_user.id, content=content)
     
     if timestamp_str:
@@ -1159,6 +3593,7 @@ def api_validate_quotes():
         return jsonify(success=False, message='参数错误'), 400
     
     # 查询当前聊天室中指定ID的消息
+    chat_write_queue.flush_if_pending(quote_ids)
     valid_messages = db_session.query(ChatMessage.id).filter(
         ChatMessage.id.in_(quote_ids),
         ChatMessage.room_id == room_id
@@ -1221,30 +3656,20 @@ def api_delete_forum_reply(reply_id):
 @login_required
 def get_online_count():
     """获取全局在线用户数"""
-    cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
-    
-    return jsonify(count=online_count)
+    return jsonify(count=online_tracker.count())
 
 
 @app.route('/api/random_quote')
 @login_required
 def get_random_quote():
     """获取随机名言"""
-    import random
     try:
-        with open('quotes.json', 'r', encoding='utf-8') as f:
-            quotes_data = json.load(f)
-            quotes = quotes_data.get('quotes', [])
-            # Format the quote as "text - author"
-            formatted_quotes = [f"{quote['text']} - {quote['author']}" for quote in quotes if 'text' in quote and 'author' in quote]
-            if formatted_quotes:
-                selected_quote = random.choice(formatted_quotes)
-                return jsonify(success=True, quote=selected_quote)
-            else:
-                return jsonify(success=False, message="没有找到名言")
+        quotes_store.quotes()  # 文件不存在或格式错误时抛出异常
+        selected_quote = quotes_store.random_quote()
+        if selected_quote:
+            return jsonify(success=True, quote=selected_quote)
+        else:
+            return jsonify(success=False, message="没有找到名言")
     except FileNotFoundError:
         # Fallback if JSON file doesn't exist
         return jsonify(success=False, message="quotes.json文件不存在")
@@ -1260,6 +3685,9 @@ def get_room_online_count(room_id):
     if not user_can_view_chat(current_user, room_id):
         return jsonify(success=False, message="权限不足"), 403
     
+    # 轮询客户端没有心跳，以此请求刷新其在线状态
+    presence.touch(room_id, current_user.id)
+
     # 获取房间在线用户
     users_data = get_room_users_data(room_id)
     
@@ -1273,38 +3701,9 @@ def get_room_online_count(room_id):
 def api_unread_counts():
     """返回用户在可访问的聊天室和贴吧分区上的未读数量映射"""
     try:
-        chat_counts = {}
-        forum_counts = {}
-
-        # 聊天室
-        rooms = db_session.query(ChatRoom).all()
-        for room in rooms:
-            if get_chat_permission_value(current_user, room.id) == 'Null':
-                continue
-            last = db_session.query(ChatLastView).filter_by(user_id=current_user.id, room_id=room.id).first()
-            if last:
-                cnt = db_session.query(ChatMessage).filter(ChatMessage.room_id == room.id, ChatMessage.timestamp > last.last_view).count()
-            else:
-                cnt = db_session.query(ChatMessage).filter_by(room_id=room.id).count()
-            chat_counts[room.id] = cnt
-
-        # 贴吧分区
-        sections = db_session.query(ForumSection).all()
-        for section in sections:
-            if get_forum_permission_value(current_user, section.id) == 'Null':
-                continue
-            last = db_session.query(ForumLastView).filter_by(user_id=current_user.id, section_id=section.id).first()
-            if last:
-                last_time = last.last_view
-                cnt_threads = db_session.query(ForumThread).filter(ForumThread.section_id == section.id, ForumThread.timestamp > last_time).count()
-                # 回复：需要关联 thread -> section
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id)\
-                    .filter(ForumThread.section_id == section.id, ForumReply.timestamp > last_time).count()
-            else:
-                cnt_threads = db_session.query(ForumThread).filter_by(section_id=section.id).count()
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id)\
-                    .filter(ForumThread.section_id == section.id).count()
-            forum_counts[section.id] = cnt_threads + cnt_replies
+        unread = compute_unread_counts(current_user)
+        chat_counts = unread['chat_counts']
+        forum_counts = unread['forum_counts']
 
         return jsonify(success=True, chat=chat_counts, forum=forum_counts)
     except Exception as e:
@@ -1893,8 +4292,8 @@ def forum_section(section_id):
     permission = get_forum_permission_value(current_user, section_id)
     if permission == 'Null':
         abort(403)
-    threads = db_session.query(ForumThread).filter_by(section_id=section_id)\
-        .order_by(ForumThread.timestamp.desc()).all()
+    threads = db_session.query(ForumThread).options(joinedload(ForumThread.user))\
+        .filter_by(section_id=section_id).order_by(ForumThread.timestamp.desc()).all()
     # 记录用户最后查看该分区的时间（用于未读统计）
     try:
         last = db_session.query(ForumLastView).filter_by(user_id=current_user.id, section_id=section_id).first()
@@ -1943,7 +4342,8 @@ def forum_thread(thread_id):
     # 页面使用 0-based page index，默认加载最后一页
     current_page = 0
     offset = current_page * PAGE_SIZE
-    replies = thread.replies.order_by(ForumReply.timestamp.asc()).offset(offset).limit(PAGE_SIZE).all()
+    replies = thread.replies.options(joinedload(ForumReply.user))\
+        .order_by(ForumReply.timestamp.asc()).offset(offset).limit(PAGE_SIZE).all()
     # 解码已存在的实体，保证客户端渲染时能正确还原 code block 内容
     try:
         if thread.content and isinstance(thread.content, str):
@@ -2027,19 +4427,9 @@ def api_get_thread_replies(thread_id):
     if page >= total_pages:
         page = total_pages - 1
     offset = page * PAGE_SIZE
-    replies = thread.replies.order_by(ForumReply.timestamp.asc()).offset(offset).limit(PAGE_SIZE).all()
-    result = []
-    for r in replies:
-        result.append({
-            'id': r.id,
-            'thread_id': r.thread_id,
-            'user_id': r.user_id,
-            'username': r.user.username if r.user else None,
-            'nickname': r.user.nickname if r.user else None,
-            'color': r.user.color if r.user else None,
-            'content': r.content,
-            'timestamp': r.timestamp.isoformat() if hasattr(r.timestamp, 'isoformat') else str(r.timestamp)
-        })
+    replies = thread.replies.options(joinedload(ForumReply.user))\
+        .order_by(ForumReply.timestamp.asc()).offset(offset).limit(PAGE_SIZE).all()
+    result = [forum_reply_to_dict(r) for r in replies]
     return jsonify(success=True, replies=result, page=page, total_pages=total_pages)
 
 @app.route('/forum/new/<int:section_id>', methods=['GET', 'POST'])
@@ -2409,7 +4799,19 @@ def get_system_info():
             'memory_usage': memory_usage,
             'server_time': datetime.now().isoformat(),
             'python_version': sys.version,
-            'flask_version': flask_version
+            'flask_version': flask_version,
+            'chat_write_queue': chat_write_queue.stats(),
+            'socket_handlers': handler_stats.snapshot(),
+            'socket_sessions': socket_sessions.stats(),
+            'last_seen_writes': last_seen_aggregator.stats(),
+            'recent_messages': recent_messages.stats(),
+            'user_profiles': user_profiles.stats(),
+            'event_streams': room_events.stats(),
+            'shared_state': shared_state.stats(),
+            'memory_stores': {
+                'captcha_store': captcha_store.stats(),
+                'send_rate_limiter': send_rate_limiter.stats()
+            }
         })
     except Exception as e:
         log_admin_action(f"获取系统信息失败: {str(e)}")
@@ -2428,6 +4830,9 @@ def clear_cache():
     try:
         # 清除数据库查询缓存
         db_session.expire_all()
+        permission_cache.invalidate()
+        user_profiles.invalidate()
+        recent_messages.invalidate()
         
         log_admin_action("管理员清除了系统缓存")
         return jsonify(success=True, message="缓存清除成功")
@@ -2447,6 +4852,7 @@ def restart_server():
         # 在新线程中重启服务器，给客户端响应
         def restart():
             time.sleep(2)  # 等待响应发送
+            flush_pending_writes()  # os._exit 不会触发 atexit，先写入队列中的数据
             os._exit(0)  # 强制退出，由调试模式自动重启
         
         threading.Thread(target=restart).start()
@@ -2463,7 +4869,6 @@ def backup_database():
         return jsonify(success=False, message="权限不足"), 403
     
     try:
-        db_path = Path(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
         backup_dir = Path(app.root_path) / 'backups'
         backup_dir.mkdir(exist_ok=True)
         
@@ -2471,7 +4876,16 @@ def backup_database():
         backup_name = f"backup_{timestamp}.db"
         backup_path = backup_dir / backup_name
         
-        shutil.copy2(db_path, backup_path)
+        # WAL 模式下直接复制主文件会丢失尚未检查点的写入，使用 SQLite 在线备份接口
+        conn = engine.raw_connection()
+        try:
+            target = sqlite3.connect(str(backup_path))
+            try:
+                conn.driver_connection.backup(target)
+            finally:
+                target.close()
+        finally:
+            conn.close()
         
         log_admin_action(f"数据库备份成功: {backup_path}")
         return jsonify(success=True, message="数据库备份成功", backup_path=str(backup_path))
@@ -2507,12 +4921,15 @@ def optimize_database():
         return jsonify(success=False, message="权限不足"), 403
     
     try:
-        db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("VACUUM")
-        conn.commit()
-        conn.close()
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("VACUUM")
+            cursor.execute("PRAGMA optimize")
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.commit()
+        finally:
+            conn.close()
         
         log_admin_action("数据库优化成功")
         return jsonify(success=True, message="数据库优化成功")
@@ -2583,6 +5000,9 @@ def download_database_file():
         dirpath = os.path.dirname(db_path)
         fname = os.path.basename(db_path)
 
+        # 将 WAL 中的写入合并回主文件，保证下载的文件是完整的
+        checkpoint_database()
+
         log_admin_action(f"管理员 {current_user.username} 下载了数据库文件 {fname}")
         return send_from_directory(directory=dirpath, path=fname, as_attachment=True)
     except Exception as e:
@@ -2604,6 +5024,7 @@ def shutdown_server():
         # 在新线程中关闭服务器
         def shutdown():
             time.sleep(2)
+            flush_pending_writes()
             os._exit(0)
         
         threading.Thread(target=shutdown).start()
@@ -2636,6 +5057,8 @@ def update_user(user_id):
             user.badge = data['badge']
         
         db_session.commit()
+        user_profiles.invalidate(user.id)
+        recent_messages.invalidate()
         log_admin_action(f"更新了用户 {user.username} 的信息")
         return jsonify(success=True, message="用户信息更新成功")
     except Exception as e:
@@ -2672,6 +5095,8 @@ def remove_user_and_related(user_id, session=None):
     if user.id == 1:
         return False, "不能删除超级管理员"
 
+    chat_write_queue.flush()
+
     try:
         # 删除用户相关数据
         # - 消息、帖子、回复
@@ -2690,6 +5115,10 @@ def remove_user_and_related(user_id, session=None):
         username = user.username
         session.delete(user)
         session.commit()
+        permission_cache.invalidate(user_id)
+        user_profiles.invalidate(user_id)
+        recent_messages.invalidate()
+        chat_tombstones.record(None)
         return True, username
     except Exception as e:
         session.rollback()
@@ -2726,6 +5155,8 @@ def update_user_role(user_id):
                 perm.perm = 'Null'
 
         db_session.commit()
+        permission_cache.invalidate(user.id)
+        user_profiles.invalidate(user.id)
 
         if new_role == 'admin':
             grant_su_to_admins()
@@ -2831,6 +5262,7 @@ def update_user_permissions(user_id):
                 db_session.add(ForumPermission(user_id=user.id, section_id=target_id, perm=perm_value))
 
     db_session.commit()
+    permission_cache.invalidate(user.id)
     log_admin_action(f"管理员 {current_user.username} 更新用户 {user.username} 的 {scope} 权限")
     return jsonify(success=True, message="权限已更新", perm=perm_value)
 
@@ -2989,9 +5421,14 @@ def delete_chat_room(room_id):
         if room.id == 1:  # 默认聊天室不能删除
             return jsonify(success=False, message="不能删除默认聊天室"), 400
 
+        chat_write_queue.flush()
+
         room_name = room.name
         db_session.delete(room)
         db_session.commit()
+        permission_cache.invalidate()
+        recent_messages.invalidate(room_id)
+        chat_tombstones.record(room_id)
 
         log_admin_action(f"删除了聊天室: {room_name}")
         return jsonify(success=True, message=f"聊天室 {room_name} 删除成功")
@@ -3011,6 +5448,7 @@ def delete_chat_messages():
         room_id = request.args.get('room_id', type=int)
         before_date = request.args.get('before', type=str)
 
+        chat_write_queue.flush()
         query = db_session.query(ChatMessage)
         
         if room_id:
@@ -3021,8 +5459,38 @@ def delete_chat_messages():
             before_datetime = datetime.fromisoformat(before_date.replace('Z', '+00:00'))
             query = query.filter(ChatMessage.timestamp < before_datetime)
 
+        # 删除前按房间统计受影响的范围，删除后每个房间推送一次批量删除事件，不逐条列出ID：
+        # 整个房间被清空时 all 为真；按日期删除时给出边界 before_id，客户端移除 ID 不大于它的消息
+        if before_date:
+            deleted_rooms = {}
+            for message_room_id, max_id, count in query.with_entities(
+                    ChatMessage.room_id, func.max(ChatMessage.id), func.count(ChatMessage.id)
+            ).group_by(ChatMessage.room_id):
+                # 消息 ID 通常随时间递增；若有更早 ID 的消息被保留（时间戳被修改或导入的数据），边界不成立
+                older_total = db_session.query(func.count(ChatMessage.id)).filter(
+                    ChatMessage.room_id == message_room_id, ChatMessage.id <= max_id
+                ).scalar()
+                deleted_rooms[message_room_id] = max_id if older_total == count else None
+        else:
+            deleted_rooms = {row.room_id: None for row in query.with_entities(ChatMessage.room_id).distinct()}
+
         deleted_count = query.delete()
         db_session.commit()
+        recent_messages.invalidate(room_id)
+        chat_tombstones.record(room_id)
+
+        deleted_at = datetime.now(timezone.utc).isoformat()
+        for message_room_id, before_id in deleted_rooms.items():
+            if before_date and before_id is None:
+                # 边界不成立时不推送增量，客户端重新加载后看到准确的结果
+                event_data = {'room_id': message_room_id, 'resync': True}
+            else:
+                event_data = {'room_id': message_room_id, 'all': not before_date, 'before_id': before_id}
+            event_data.update(deleted_by=current_user.id, timestamp=deleted_at)
+            try:
+                broadcast_room_event('messages_deleted', event_data, message_room_id)
+            except Exception:
+                logger.exception('广播 messages_deleted 失败')
 
         log_admin_action(f"清空聊天消息: {deleted_count} 条消息被删除")
         return jsonify(success=True, message=f"成功删除 {deleted_count} 条聊天消息")
@@ -3164,6 +5632,7 @@ def delete_forum_section(section_id):
         db_session.query(ForumThread).filter_by(section_id=section_id).delete()
         db_session.delete(section)
         db_session.commit()
+        permission_cache.invalidate()
         
         log_admin_action(f"删除了贴吧分区 {section.name}")
         return jsonify(success=True, message="贴吧分区删除成功")
@@ -3206,7 +5675,7 @@ def db_admin():
         abort(403)
 
     # 获取所有表名
-    conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     tables = [row[0] for row in cursor.fetchall()]
@@ -3221,12 +5690,13 @@ def db_table_view(table_name):
         abort(403)
 
     # 验证表名是否合法（防止SQL注入）
-    conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     valid_tables = [row[0] for row in cursor.fetchall()]
     
     if table_name not in valid_tables:
+        conn.close()
         abort(404)
     
     # 获取表结构
@@ -3253,12 +5723,13 @@ def db_table_data(table_name):
         return jsonify(success=False, message="权限不足"), 403
 
     # 验证表名是否合法（防止SQL注入）
-    conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     valid_tables = [row[0] for row in cursor.fetchall()]
     
     if table_name not in valid_tables:
+        conn.close()
         return jsonify(success=False, message="表不存在"), 404
     
     # 获取分页参数
@@ -3298,20 +5769,23 @@ def db_table_edit(table_name):
         return jsonify(success=False, message="权限不足"), 403
 
     # 验证表名是否合法（防止SQL注入）
-    conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     valid_tables = [row[0] for row in cursor.fetchall()]
     
     if table_name not in valid_tables:
+        conn.close()
         return jsonify(success=False, message="表不存在"), 404
     
     data = request.get_json()
     if not data:
+        conn.close()
         return jsonify(success=False, message="无效数据"), 400
     
     record_id = data.get('id')
     if not record_id:
+        conn.close()
         return jsonify(success=False, message="记录ID不能为空"), 400
     
     # 获取表结构，确定主键
@@ -3335,6 +5809,7 @@ def db_table_edit(table_name):
             values.append(value)
     
     if not updates:
+        conn.close()
         return jsonify(success=False, message="没有要更新的字段"), 400
     
     values.append(record_id)  # 主键值用于WHERE子句
@@ -3343,6 +5818,8 @@ def db_table_edit(table_name):
         update_sql = f"UPDATE {table_name} SET {', '.join(updates)} WHERE {primary_key} = ?"
         cursor.execute(update_sql, values)
         conn.commit()
+        if table_name in ('chat_permissions', 'forum_permissions', 'users'):
+            permission_cache.invalidate()
         
         log_admin_action(f"修改了表 {table_name} 中ID为 {record_id} 的记录")
         return jsonify(success=True, message="记录更新成功")
@@ -3360,20 +5837,23 @@ def db_table_delete(table_name):
         return jsonify(success=False, message="权限不足"), 403
 
     # 验证表名是否合法（防止SQL注入）
-    conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     valid_tables = [row[0] for row in cursor.fetchall()]
     
     if table_name not in valid_tables:
+        conn.close()
         return jsonify(success=False, message="表不存在"), 404
     
     data = request.get_json()
     if not data:
+        conn.close()
         return jsonify(success=False, message="无效数据"), 400
     
     record_id = data.get('id')
     if not record_id:
+        conn.close()
         return jsonify(success=False, message="记录ID不能为空"), 400
     
     # 获取表结构，确定主键
@@ -3392,6 +5872,8 @@ def db_table_delete(table_name):
         delete_sql = f"DELETE FROM {table_name} WHERE {primary_key} = ?"
         cursor.execute(delete_sql, (record_id,))
         conn.commit()
+        if table_name in ('chat_permissions', 'forum_permissions', 'users'):
+            permission_cache.invalidate()
         
         log_admin_action(f"删除了表 {table_name} 中ID为 {record_id} 的记录")
         return jsonify(success=True, message="记录删除成功")
@@ -3431,224 +5913,283 @@ def list_directory(path):
     
     return items
 
+class HandlerStats:
+    """Socket.IO 事件处理耗时统计：调用次数、平均/最大耗时，以及最近样本的 p50/p95"""
+
+    def __init__(self, samples=256):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def record(self, event_name, elapsed_ms):
+        with self._lock:
+            entry = self._events.get(event_name)
+            if entry is None:
+                entry = self._events[event_name] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'recent': deque(maxlen=self.samples)
+                }
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['recent'].append(elapsed_ms)
+
+    def snapshot(self):
+        result = {}
+        with self._lock:
+            for event_name, entry in self._events.items():
+                recent = sorted(entry['recent'])
+                result[event_name] = {
+                    'count': entry['count'],
+                    'avg_ms': round(entry['total_ms'] / entry['count'], 3),
+                    'max_ms': round(entry['max_ms'], 3),
+                    'p50_ms': round(recent[len(recent) // 2], 3),
+                    'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 3),
+                }
+        return result
+
+
+handler_stats = HandlerStats()
+
+
+def timed_handler(event_name):
+    """记录 Socket.IO 事件处理函数的耗时（放在 @socketio.on 之下）"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                handler_stats.record(event_name, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
+
+
 # Socket.IO 事件处理
 @socketio.on('connect')
-def handle_connect():
+@timed_handler('connect')
+def handle_connect(auth=None):
     """用户连接"""
     if not current_user.is_authenticated:
         return False  # 拒绝未认证用户
     
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db_session.commit()
+        shared_state.start()
+        last_seen_aggregator.record_user(current_user.id)
+        online_tracker.touch(current_user.id)
+        socket_sessions.connect(request.sid, current_user.id)
     
     session['receive_count'] = session.get('receive_count', 0) + 1
     emit('my_response', {'count': session['receive_count']})
 
+def parse_room_id(data, key='room'):
+    try:
+        return int((data or {}).get(key))
+    except (TypeError, ValueError):
+        return None
+
+
+def join_chat_room(room_id):
+    """当前连接加入聊天室（调用方已完成权限检查）。
+
+    last_seen 与其他房间的最后查看时间交给 last_seen_aggregator 合并写入；
+    只有用户从不在线变为在线时才广播 user_join 并登记名单变化。
+    """
+    room_name = f"room_{room_id}"
+    join_room(room_name)
+    if socket_sessions.join(request.sid, room_id):
+        presence.hold(room_id, current_user.id)
+
+    now = datetime.now(timezone.utc)
+    last_seen_aggregator.record_user(current_user.id, now)
+    # 切换房间时记录其他房间的最后查看时间（用于未读统计）
+    for other_room_id in presence.rooms_of(current_user.id):
+        if other_room_id != room_id:
+            last_seen_aggregator.record_view(current_user.id, other_room_id, now)
+    online_tracker.touch(current_user.id)
+
+    if presence.touch(room_id, current_user.id):
+        # 广播用户进入（供关注者监听）
+        socketio.emit('user_join', {
+            'user_id': current_user.id,
+            'username': current_user.username,
+            'nickname': current_user.nickname or current_user.username,
+            'room_id': room_id
+        }, room=room_name)
+        update_room_online_count(room_id)
+    # 新加入者获得当前名单快照，自己的加入随后以增量送达
+    emit('online_users', roster_broadcaster.snapshot(room_id))
+
+
+def leave_chat_room(room_id):
+    """当前连接离开聊天室"""
+    leave_room(f"room_{room_id}")
+    if socket_sessions.leave(request.sid, room_id):
+        mark_user_left_room(current_user, room_id)
+
+
+def mark_user_left_room(user, room_id):
+    """一个连接离开房间后调用；用户的最后一个连接（包括其他工作进程上的连接）离开时，
+    写入最后查看时间并广播 user_leave"""
+    if not presence.release(room_id, user.id) or socket_sessions.in_room(room_id, user.id):
+        return
+    # 从在线状态表中移除，并记录最后查看时间（用于未读统计）
+    if presence.remove(room_id, user.id) is None:
+        return
+    last_seen_aggregator.record_view(user.id, room_id)
+    socketio.emit('user_leave', {
+        'user_id': user.id,
+        'username': user.username,
+        'nickname': user.nickname or user.username,
+        'room_id': room_id
+    }, room=f"room_{room_id}")
+    update_room_online_count(room_id)
+
+
 @socketio.on('join')
+@timed_handler('join')
 def on_join(data):
     """加入聊天室"""
     if not current_user.is_authenticated:
         return
-    
-    room_id = data.get('room')
-    if not room_id:
-        return
 
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
+    room_id = parse_room_id(data)
+    if not room_id:
         return
 
     if not user_can_view_chat(current_user, room_id):
         emit('permission_denied', {'message': '当前权限无法进入该聊天室', 'room_id': room_id})
         return
-    
-    room_name = f"room_{room_id}"
-    join_room(room_name)
-    # 更新用户最后活动时间
-    current_user.last_seen = datetime.now(timezone.utc)
-    
-    # 在ChatLastView表中记录用户进入房间的时间
-    last = db_session.query(ChatLastView).filter_by(
-        user_id=current_user.id,
-        room_id=room_id
-    ).first()
-    now = datetime.now(timezone.utc)
-    if last:
-        last.last_view = now
-    else:
-        db_session.add(ChatLastView(
-            user_id=current_user.id,
-            room_id=room_id,
-            last_view=now
-        ))
-    db_session.commit()
-    
-    # 广播用户加入
-    emit('user_join', {
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'room_id': room_id
-    }, room=room_name)
-    
-    # 更新在线人数
-    update_room_online_count(room_id)
+
+    join_chat_room(room_id)
 
 
 @socketio.on('leave')
+@timed_handler('leave')
 def on_leave(data):
     """离开聊天室"""
     if not current_user.is_authenticated:
         return
-    
-    room_id = data.get('room')
+
+    room_id = parse_room_id(data)
     if not room_id:
         return
 
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
+    leave_chat_room(room_id)
+
+
+@socketio.on('disconnect')
+@timed_handler('disconnect')
+def handle_disconnect(reason=None):
+    """连接断开：立即离开所在房间，并清理该连接的状态"""
+    info = socket_sessions.disconnect(request.sid)
+    if not info:
         return
-    
-    room_name = f"room_{room_id}"
-    leave_room(room_name)
-    
-    # 不需要从内存中移除用户，因为我们现在使用数据库来跟踪在线状态
-    emit('user_leave', {
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'room_id': room_id
-    }, room=room_name)
-    
-    # 更新在线人数
-    update_room_online_count(room_id)
+    user_id = info['user_id']
+    if info['rooms']:
+        user = current_user if current_user.is_authenticated else user_profiles.get(user_id)
+        if user:
+            for room_id in info['rooms']:
+                mark_user_left_room(user, room_id)
+
+    # 用户已没有其他连接时，释放未完成的验证码（限流桶保留，由后台任务在回满后清理，避免断线重连刷新额度）
+    if not socket_sessions.has_user(user_id):
+        captcha_store.pop_where(lambda key, value: value.get('user_id') == user_id)
+
 
 @socketio.on('send_message')
+@timed_handler('send_message')
 def handle_message(data):
     """处理发送消息"""
     if not current_user.is_authenticated:
         return
     
-    room_id = data.get('room_id')
-    content = data.get('message', '').strip()
-    
-    # 验证
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        room_id = None
+    client_id = data.get('client_id')
+    captcha_id = data.get('captcha_id')
+    if captcha_id:
+        # 携带 captcha_id 与 captcha_answer 时进行验证（通过后以服务器端保存的 pending 为准，
+        # pending 中的内容已在首次提交时校验并转义过）
+        pending, error = verify_send_captcha(current_user.id, captcha_id, data.get('captcha_answer'))
+        if error:
+            emit('error', {'message': error})
+            return
+        room_id = pending.get('room_id')
+        content = pending.get('content')
+        client_id = pending.get('client_id') or client_id
+        if not room_id or not content:
+            emit('error', {'message': '参数错误'})
+            return
+        if not user_can_send_chat(current_user, room_id):
+            emit('error', {'message': '当前权限无法发送消息'})
+            return
+    else:
+        room_id = data.get('room_id')
+        content = data.get('message', '').strip()
 
-    if not room_id or not content:
-        emit('error', {'message': '参数错误'})
-        return
+        # 验证
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            room_id = None
 
-    if not user_can_send_chat(current_user, room_id):
-        emit('error', {'message': '当前权限无法发送消息'})
-        return
-    
-    # 内容长度限制
-    if len(content) > 2000:
-        emit('error', {'message': '消息过长'})
-        return
-    
-    # 检查引用是否为自引用（引用即将保存的消息ID，这在当前情况下是不可能的，但我们可以检查引用模式）
-    # 首先解析消息中的引用ID
-    import re
-    quote_pattern = r'@quote\{(\d+)\}'
-    quote_matches = re.findall(quote_pattern, content)
-    quote_ids = [int(id) for id in quote_matches if id.isdigit()]
-    
-    # 检查是否有重复的引用ID（这可能表示自引用意图）
-    # 这里我们做更严格的检查：验证引用的消息是否真实存在且在当前聊天室内
-    if quote_ids:
-        # 检查引用的消息是否在当前聊天室内存在（而不是简单地禁止引用自己的消息）
-        # 验证引用的消息是否真实存在且在当前聊天室内
-        valid_messages = db_session.query(ChatMessage.id).filter(
-            ChatMessage.id.in_(quote_ids),
-            ChatMessage.room_id == room_id
-        ).all()
-        valid_ids = {msg.id for msg in valid_messages}
-        invalid_quote_ids = [qid for qid in quote_ids if qid not in valid_ids]
-        if invalid_quote_ids:
-            emit('error', {'message': '不能引用不存在的消息'})
+        if not room_id or not content:
+            emit('error', {'message': '参数错误'})
             return
-    
-    # XSS基础防护
-    content = sanitize_content(content, room_id)
-    # 检查发送速度：如果两次发送间隔小于725ms，则触发验证码流程
-    now_ts = time.time()
-    with captcha_lock:
-        last_ts = last_send_times.get(current_user.id)
-        # 如果前一次发送时间存在且间隔短，并且本次没有携带 captcha_id，则要求验证码
-        if last_ts and (now_ts - last_ts) < 0.725 and not data.get('captcha_id'):
-            # 生成一个简单的算术验证码
-            import secrets
-            import random
-
-            a = random.randint(1, 9)
-            b = random.randint(1, 9)
-            op = random.choice(['+', '-'])
-            answer = a + b if op == '+' else a - b
-            captcha_id = secrets.token_urlsafe(8)
-            captcha_store[captcha_id] = {
-                'answer': answer,
-                'expires': now_ts + 300,
-                'user_id': current_user.id,
-                'pending': {
-                    'room_id': room_id,
-                    'content': content,
-                    'client_id': data.get('client_id')
-                }
-            }
-            # 只发送给当前连接的客户端，要求输入验证码
+
+        if not user_can_send_chat(current_user, room_id):
+            emit('error', {'message': '当前权限无法发送消息'})
+            return
+
+        # 内容长度限制
+        if len(content) > 2000:
+            emit('error', {'message': '消息过长'})
+            return
+
+        # 检查引用是否为自引用（引用即将保存的消息ID，这在当前情况下是不可能的，但我们可以检查引用模式）
+        # 首先解析消息中的引用ID
+        quote_pattern = r'@quote\{(\d+)\}'
+        quote_matches = re.findall(quote_pattern, content)
+        quote_ids = [int(id) for id in quote_matches if id.isdigit()]
+
+        # 检查是否有重复的引用ID（这可能表示自引用意图）
+        # 这里我们做更严格的检查：验证引用的消息是否真实存在且在当前聊天室内
+        if quote_ids:
+            # 检查引用的消息是否在当前聊天室内存在（而不是简单地禁止引用自己的消息）
+            # 验证引用的消息是否真实存在且在当前聊天室内
+            chat_write_queue.flush_if_pending(quote_ids)
+            valid_messages = db_session.query(ChatMessage.id).filter(
+                ChatMessage.id.in_(quote_ids),
+                ChatMessage.room_id == room_id
+            ).all()
+            valid_ids = {msg.id for msg in valid_messages}
+            invalid_quote_ids = [qid for qid in quote_ids if qid not in valid_ids]
+            if invalid_quote_ids:
+                emit('error', {'message': '不能引用不存在的消息'})
+                return
+
+        # XSS基础防护
+        content = sanitize_content(content, room_id)
+        # 发送限流：令牌桶已空时要求验证码，只发送给当前连接的客户端
+        if not send_rate_limiter.consume(current_user.id):
+            captcha_id, question = issue_send_captcha(current_user.id, {
+                'room_id': room_id,
+                'content': content,
+                'client_id': client_id
+            })
             emit('require_captcha', {
                 'captcha_id': captcha_id,
-                'question': f'{a}{op}{b} = ?'
+                'question': question
             }, room=request.sid)
             return
 
-    # 如果本次请求携带了 captcha_id 与 captcha_answer，进行验证（并允许通过）
-    captcha_id = data.get('captcha_id')
-    captcha_answer = data.get('captcha_answer')
-    if captcha_id:
-        with captcha_lock:
-            info = captcha_store.get(captcha_id)
-            # 验证存在性、过期以及归属
-            if not info or info.get('user_id') != current_user.id:
-                emit('error', {'message': '验证码无效或已过期'})
-                return
-            if time.time() > info.get('expires', 0):
-                captcha_store.pop(captcha_id, None)
-                emit('error', {'message': '验证码已过期'})
-                return
-            try:
-                provided = int(captcha_answer)
-            except Exception:
-                emit('error', {'message': '验证码输入错误'})
-                return
-            if provided != info['answer']:
-                emit('error', {'message': '验证码错误'})
-                return
-            # 验证通过：将待发送消息替换为存储的 pending（以服务器端为准）
-            pending = info.get('pending', {})
-            room_id = pending.get('room_id', room_id)
-            content = pending.get('content', content)
-            client_id = pending.get('client_id') or data.get('client_id')
-            # 清理验证码条目
-            captcha_store.pop(captcha_id, None)
-
-    # 更新最后发送时间（通过验证或正常发送）
-    with captcha_lock:
-        last_send_times[current_user.id] = now_ts
-    
     # 重复消息合并：如果上一条来自同一用户在同一房间且内容相同，则在上一条末尾增加 *2/*3...
     try:
-        last_msg = db_session.query(ChatMessage).filter_by(
-            user_id=current_user.id, room_id=room_id
-        ).order_by(ChatMessage.id.desc()).first()
+        # 写后模式下最后一条消息可能还在队列中
+        last_msg = chat_write_queue.last_pending(current_user.id, room_id) if chat_write_queue.enabled else None
+        if last_msg is None:
+            last_msg = db_session.query(ChatMessage).filter_by(
+                user_id=current_user.id, room_id=room_id
+            ).order_by(ChatMessage.id.desc()).first()
     except Exception:
         last_msg = None
 
@@ -3667,38 +6208,21 @@ def handle_message(data):
                     count = 2
             else:
                 count = 2
-            last_msg.content = f"{content}*{count}"
-            db_session.add(last_msg)
-            db_session.commit()
-
-            payload = {
-                'id': last_msg.id,
-                'content': last_msg.content,
-                'timestamp': last_msg.timestamp.isoformat(),
-                'user_id': current_user.id,
-                'username': current_user.username,
-                'nickname': current_user.nickname or current_user.username,
-                'color': current_user.color,
-                'badge': current_user.badge
-            }
+            payload = update_chat_message_content(last_msg, f"{content}*{count}", current_user)
             if client_id:
-                payload['client_id'] = client_id
-            emit('message_updated', payload, room=f'room_{room_id}', include_self=True)
+                payload = payload.extend(client_id=client_id)
+            broadcast_room_event('message_updated', payload, room_id)
             
             # 对于重复消息，也发送acknowledgement
             if client_id:
                 emit('message_id_response', {'client_id': client_id, 'server_id': last_msg.id}, to=request.sid)
             return
 
-    # 保存到数据库（非重复的常规消息）
-    message = ChatMessage(
-        content=content,
-        user_id=current_user.id,
-        room_id=room_id
-    )
+    # 保存到数据库（非重复的常规消息；写后模式下先分配ID并广播，稍后批量落库）
     try:
-        db_session.add(message)
-        db_session.commit()
+        message = chat_write_queue.store(current_user.id, room_id, content)
+        message_dict = chat_message_to_dict(message, current_user)
+        recent_messages.append(room_id, message_dict)
     except Exception as e:
         try:
             db_session.rollback()
@@ -3710,25 +6234,14 @@ def handle_message(data):
     
     # 发送消息给房间内所有人（包括发送者），并携带 client_id（如果客户端发送了），
     # 这样发送者可以收到带有服务器 id 的确认消息以更新本地 pending 消息
-    room_name = f"room_{room_id}"
-    client_id = data.get('client_id')
-    payload = {
-        'id': message.id,
-        'content': message.content,  # 原始Markdown
-        'timestamp': message.timestamp.isoformat(),
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'color': current_user.color,
-        'badge': current_user.badge
-    }
+    payload = message_dict
 
-    # 如果前端传来了 client_id，包含在payload中以便发送者进行匹配
+    # 如果前端传来了 client_id，包含在payload中以便发送者进行匹配（在已编码的消息后拼接，不重新编码）
     if client_id:
-        payload['client_id'] = client_id
+        payload = payload.extend(client_id=client_id)
 
-    # include_self=True 使得发送者也能收到这条消息（用于将本地 pending 更新为服务器ID）
-    emit('message', payload, room=room_name, include_self=True)
+    # 发送者也能收到这条消息（用于将本地 pending 更新为服务器ID）
+    broadcast_room_event('message', payload, room_id)
     
     # 发送acknowledgement响应，包含服务器消息ID
     if client_id:
@@ -3736,6 +6249,7 @@ def handle_message(data):
         emit('message_id_response', {'client_id': client_id, 'server_id': message.id}, to=request.sid)
 
 @socketio.on('get_online_users')
+@timed_handler('get_online_users')
 def handle_get_online_users(data):
     """获取在线用户列表"""
     if not current_user.is_authenticated:
@@ -3754,26 +6268,24 @@ def handle_get_online_users(data):
         emit('permission_denied', {'message': '当前权限无法查看该聊天室', 'room_id': room_id})
         return
     
-    # 获取在线用户
-    online_users = get_online_users(room_id)
-    
-    emit('online_users', {'users': online_users})
+    # 返回完整在线名单快照（客户端在加入时或发现版本号不连续时请求）
+    for expired_room_id in expire_presence() - {room_id}:
+        update_room_online_count(expired_room_id)
+    emit('online_users', roster_broadcaster.snapshot(room_id))
 
 
 @socketio.on('get_global_online_count')
+@timed_handler('get_global_online_count')
 def handle_get_global_online_count(data):
     """获取全局在线用户数"""
     if not current_user.is_authenticated:
         return
     
-    cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
     # 发送全局在线人数到客户端
-    emit('global_online_count', {'count': online_count})
+    emit('global_online_count', {'count': online_tracker.count()})
 
 @socketio.on('heartbeat_chat')
+@timed_handler('heartbeat_chat')
 def handle_heartbeat_chat(data):
     """处理聊天室客户端心跳，更新用户最后活动时间"""
     room_id = data.get('room_id')
@@ -3781,27 +6293,18 @@ def handle_heartbeat_chat(data):
         try:
             room_id = int(room_id)
             
-            # 更新用户全局最后活动时间
-            current_user.last_seen = datetime.now(timezone.utc)
+            # 更新用户全局最后活动时间（合并写入）
+            last_seen_aggregator.record_user(current_user.id)
+            online_tracker.touch(current_user.id)
             
-            # 更新房间特定最后查看时间
-            last = db_session.query(ChatLastView).filter_by(
-                user_id=current_user.id, 
-                room_id=room_id
-            ).first()
-            now = datetime.now(timezone.utc)
-            if last:
-                last.last_view = now
-            else:
-                db_session.add(ChatLastView(
-                    user_id=current_user.id, 
-                    room_id=room_id, 
-                    last_view=now
-                ))
-            db_session.commit()
+            # 房间内在线状态只在内存中刷新，ChatLastView 在离开/切换房间/超时时才写入
+            changed_rooms = expire_presence()
+            if presence.touch(room_id, current_user.id):
+                changed_rooms.add(room_id)
             
-            # 触发在线人数更新
-            update_room_online_count(room_id)
+            # 在线名单有变化时才触发在线人数更新
+            for changed_room_id in changed_rooms:
+                update_room_online_count(changed_room_id)
         except Exception as e:
             db_session.rollback()
             logger.error(f"处理心跳失败: {str(e)}")
@@ -3816,13 +6319,7 @@ def get_following():
     following = db_session.query(UserFollow.followed_id).filter_by(follower_id=current_user.id).all()
     following_ids = [row[0] for row in following]
     users = db_session.query(User).filter(User.id.in_(following_ids)).all()
-    user_list = [{
-        'id': u.id,
-        'username': u.username,
-        'nickname': u.nickname or u.username,
-        'color': u.color,
-        'badge': u.badge
-    } for u in users]
+    user_list = [user_profile(u) for u in users]
     return jsonify(success=True, following=user_list)
 
 
@@ -3856,91 +6353,13 @@ def toggle_follow():
     return jsonify(success=True, action=action)
 
 
-# 广播用户进入
-@socketio.on('join')
-def on_join(data):
-    if not current_user.is_authenticated:
-        return
-    room_id = data.get('room')
-    if not room_id:
-        return
-
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        return
-
-    if not user_can_view_chat(current_user, room_id):
-        emit('permission_denied', {'message': '当前权限无法进入该聊天室', 'room_id': room_id})
-        return
-
-    room_name = f"room_{room_id}"
-    join_room(room_name)
-    current_user.last_seen = datetime.now(timezone.utc)
-    db_session.commit()
-    # 广播用户进入（供关注者监听）
-    # emit to the room so only users in the room receive it (includes sender)
-    try:
-        socketio.emit('user_join', {
-            'user_id': current_user.id,
-            'username': current_user.username,
-            'nickname': current_user.nickname or current_user.username,
-            'room_id': room_id
-        }, room=room_name)
-    except Exception:
-        # fallback to emit without room if socketio.emit signature differs
-        try:
-            emit('user_join', {
-                'user_id': current_user.id,
-                'username': current_user.username,
-                'nickname': current_user.nickname or current_user.username,
-                'room_id': room_id
-            })
-        except Exception:
-            pass
-
-
-# 广播用户离开
-@socketio.on('leave')
-def on_leave(data):
-    if not current_user.is_authenticated:
-        return
-    room_id = data.get('room')
-    if not room_id:
-        return
-
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        return
-
-    room_name = f"room_{room_id}"
-    leave_room(room_name)
-    # 广播用户离开
-    try:
-        socketio.emit('user_leave', {
-            'user_id': current_user.id,
-            'username': current_user.username,
-            'nickname': current_user.nickname or current_user.username,
-            'room_id': room_id
-        }, room=room_name)
-    except Exception:
-        try:
-            emit('user_leave', {
-                'user_id': current_user.id,
-                'username': current_user.username,
-                'nickname': current_user.nickname or current_user.username,
-                'room_id': room_id
-            })
-        except Exception:
-            pass
-
 @socketio.on('heartbeat')
+@timed_handler('heartbeat')
 def handle_heartbeat():
     """处理客户端心跳，更新用户最后活动时间"""
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db_session.commit()
+        last_seen_aggregator.record_user(current_user.id)
+        online_tracker.touch(current_user.id)
 
 
 # 管理员：名言管理相关路由
@@ -3961,9 +6380,7 @@ def api_get_quotes():
         return jsonify(success=False, message="权限不足"), 403
     
     try:
-        with open('quotes.json', 'r', encoding='utf-8') as f:
-            quotes_data = json.load(f)
-            quotes = quotes_data.get('quotes', [])
+        quotes = quotes_store.quotes()
         return jsonify(success=True, quotes=quotes)
     except FileNotFoundError:
         return jsonify(success=False, message="quotes.json文件不存在")
@@ -3986,20 +6403,12 @@ def api_add_quote():
         return jsonify(success=False, message="名言内容和作者不能为空")
     
     try:
-        # 读取现有名言
-        with open('quotes.json', 'r', encoding='utf-8') as f:
-            quotes_data = json.load(f)
-        
-        # 添加新名言
+        # 添加新名言（读取、修改、原子写回在同一把锁内完成）
         new_quote = {
             'text': text,
             'author': author
         }
-        quotes_data['quotes'].append(new_quote)
-        
-        # 写回文件
-        with open('quotes.json', 'w', encoding='utf-8') as f:
-            json.dump(quotes_data, f, ensure_ascii=False, indent=2)
+        quotes_store.update(lambda quotes: quotes.append(new_quote))
         
         log_admin_action(f"添加名言: {text} - {author}")
         return jsonify(success=True, message="名言添加成功")
@@ -4022,28 +6431,24 @@ def api_update_quote(quote_index):
     if not text or not author:
         return jsonify(success=False, message="名言内容和作者不能为空")
     
-    try:
-        # 读取现有名言
-        with open('quotes.json', 'r', encoding='utf-8') as f:
-            quotes_data = json.load(f)
-        
-        quotes = quotes_data.get('quotes', [])
+    def replace_quote(quotes):
         if quote_index < 0 or quote_index >= len(quotes):
-            return jsonify(success=False, message="名言索引超出范围")
-        
-        # 更新名言
+            raise IndexError(quote_index)
         old_quote = quotes[quote_index]
         quotes[quote_index] = {
             'text': text,
             'author': author
         }
-        
-        # 写回文件
-        with open('quotes.json', 'w', encoding='utf-8') as f:
-            json.dump(quotes_data, f, ensure_ascii=False, indent=2)
+        return old_quote
+
+    try:
+        # 更新名言
+        old_quote = quotes_store.update(replace_quote)
         
         log_admin_action(f"更新名言: {old_quote['text']} -> {text}")
         return jsonify(success=True, message="名言更新成功")
+    except IndexError:
+        return jsonify(success=False, message="名言索引超出范围")
     except Exception as e:
         logger.error(f"更新名言失败: {str(e)}")
         return jsonify(success=False, message=f"更新名言失败: {str(e)}")
@@ -4056,23 +6461,18 @@ def api_delete_quote(quote_index):
     if not current_user.is_admin():
         return jsonify(success=False, message="权限不足"), 403
     
-    try:
-        # 读取现有名言
-        with open('quotes.json', 'r', encoding='utf-8') as f:
-            quotes_data = json.load(f)
-        
-        quotes = quotes_data.get('quotes', [])
+    def pop_quote(quotes):
         if quote_index < 0 or quote_index >= len(quotes):
-            return jsonify(success=False, message="名言索引超出范围")
-        
-        deleted_quote = quotes.pop(quote_index)
-        
-        # 写回文件
-        with open('quotes.json', 'w', encoding='utf-8') as f:
-            json.dump(quotes_data, f, ensure_ascii=False, indent=2)
+            raise IndexError(quote_index)
+        return quotes.pop(quote_index)
+
+    try:
+        deleted_quote = quotes_store.update(pop_quote)
         
         log_admin_action(f"删除名言: {deleted_quote['text']} - {deleted_quote['author']}")
         return jsonify(success=True, message="名言删除成功")
+    except IndexError:
+        return jsonify(success=False, message="名言索引超出范围")
     except Exception as e:
         logger.error(f"删除名言失败: {str(e)}")
         return jsonify(success=False, message=f"删除名言失败: {str(e)}")
@@ -4087,12 +6487,7 @@ def inject_user():
 @app.context_processor
 def inject_online_count():
     """注入在线用户数到模板"""
-    cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
-    
-    return dict(online_count=online_count)
+    return dict(online_count=online_tracker.count())
 
 # 错误处理
 @app.errorhandler(403)
@@ -4225,8 +6620,160 @@ def create_test_data():
         logger.error(f"创建测试数据失败: {str(e)}")
         db_session.rollback()
 
-# 主程序
+# ----------
+# 服务器启动
+# ----------
+
+def install_shutdown_handlers(stop_server=None):
+    """收到 SIGTERM/SIGINT 时先调用 stop_server 停止服务，再写入待写数据后退出
+    （默认处理方式不会触发 atexit，写后队列中的消息会丢失）。
+
+    信号处理函数可能打断正持有数据库连接的协程，因此只通过管道唤醒后台任务，由后台任务完成写入。
+    """
+    import signal
+    import eventlet.hubs
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+
+    def handle(signum, frame):
+        try:
+            os.write(write_fd, bytes([signum]))
+        except BlockingIOError:
+            pass
+
+    def shutdown():
+        eventlet.hubs.trampoline(read_fd, read=True)
+        signum = os.read(read_fd, 1)[0]
+        logger.info(f"进程 {os.getpid()} 收到信号 {signal.Signals(signum).name}，停止服务并写入待写数据后退出")
+        if stop_server is not None:
+            try:
+                stop_server()
+            except Exception:
+                logger.exception('停止服务失败')
+        try:
+            flush_pending_writes()
+        except Exception:
+            logger.exception('退出前写入待写数据失败')
+        os._exit(0)
+
+    socketio.start_background_task(shutdown)
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+
+def run_eventlet_server(host, port, pool_size, backlog, keepalive, shutdown_timeout):
+    """在当前进程中运行 eventlet WSGI 服务器（不启用热重载与调试器）。
+
+    收到终止信号时停止接受新连接，断开 Socket.IO 客户端（由负载均衡转到其他工作进程），
+    最多等待 shutdown_timeout 秒让进行中的请求结束，然后写入待写数据并退出。
+    """
+    import eventlet
+    import eventlet.hubs
+    import eventlet.wsgi
+    CORS(app, resources={r"/socket.io/*": {"origins": "*"}})
+    sock = eventlet.listen((host, port), backlog=backlog)
+    pool = eventlet.GreenPool(pool_size)
+    server_thread = eventlet.getcurrent()
+
+    def stop_server():
+        # eventlet.wsgi.server 在 accept 中收到 SystemExit 后退出接受循环；随后关闭监听 socket，
+        # 新连接立即被拒绝而不是留在 backlog 中
+        eventlet.hubs.get_hub().schedule_call_global(0, server_thread.throw, SystemExit())
+        eventlet.sleep(0)
+        sock.close()
+        socketio.server.eio.disconnect()
+        deadline = time.time() + shutdown_timeout
+        while pool.running() and time.time() < deadline:
+            eventlet.sleep(0.1)
+        if pool.running():
+            logger.warning(f"工作进程 {os.getpid()} 仍有 {pool.running()} 个连接未结束，强制退出")
+
+    install_shutdown_handlers(stop_server)
+    logger.info(f"工作进程 {os.getpid()} 监听 {host}:{port}（协程池 {pool_size}，backlog {backlog}，keep-alive {keepalive}s）")
+    # app.wsgi_app 已由 Flask-SocketIO 包装，同时处理 /socket.io 与普通请求
+    eventlet.wsgi.server(sock, app, custom_pool=pool, keepalive=keepalive or False,
+                         log_output=app.debug, socket_timeout=None)
+
+
+def supervise_workers(workers, host, port, pool_size, backlog, keepalive, shutdown_timeout):
+    """启动 workers 个子进程，依次监听 port, port+1, ...；子进程异常退出时重启。
+    收到终止信号时通知子进程优雅退出，超过 shutdown_timeout 秒（另加写入待写数据的余量）仍未退出的强制结束"""
+    import signal
+    import subprocess
+
+    def spawn(index):
+        return subprocess.Popen([
+            sys.executable, '-m', 'flask', '--app', 'app', 'serve',
+            '--host', host, '--port', str(port + index), '--workers', '1',
+            '--pool-size', str(pool_size), '--backlog', str(backlog),
+            '--keepalive', str(keepalive), '--shutdown-timeout', str(shutdown_timeout), '--skip-init-db'
+        ], cwd=app.root_path)
+
+    procs = [spawn(index) for index in range(workers)]
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"已启动 {workers} 个工作进程，端口 {port}-{port + workers - 1}")
+    while not stopping:
+        time.sleep(1)
+        for index, proc in enumerate(procs):
+            if proc.poll() is not None and not stopping:
+                logger.warning(f"工作进程（端口 {port + index}）退出，状态码 {proc.returncode}，正在重启")
+                procs[index] = spawn(index)
+    deadline = time.time() + shutdown_timeout + 10
+    for index, proc in enumerate(procs):
+        try:
+            proc.wait(timeout=max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"工作进程（端口 {port + index}）未在 {shutdown_timeout + 10} 秒内退出，强制结束")
+            proc.kill()
+            proc.wait()
+
+
+@app.cli.command('serve')
+@click.option('--host', default=None, help='监听地址，默认 SERVER_HOST')
+@click.option('--port', type=int, default=None, help='端口，默认 SERVER_PORT；多个工作进程时依次使用 port, port+1, ...')
+@click.option('--workers', type=int, default=None, help='工作进程数，默认 SERVER_WORKERS')
+@click.option('--pool-size', type=int, default=None, help='每个工作进程的协程池大小，默认 SERVER_POOL_SIZE')
+@click.option('--backlog', type=int, default=None, help='监听队列长度，默认 SERVER_BACKLOG')
+@click.option('--keepalive', type=int, default=None, help='HTTP keep-alive 空闲超时（秒），0 为关闭，默认 SERVER_KEEPALIVE')
+@click.option('--shutdown-timeout', type=int, default=None,
+              help='收到终止信号后等待进行中的请求结束的最长时间（秒），默认 SERVER_SHUTDOWN_TIMEOUT')
+@click.option('--skip-init-db', is_flag=True, help='跳过 init_db（多进程时由父进程执行一次）')
+def serve_command(host, port, workers, pool_size, backlog, keepalive, shutdown_timeout, skip_init_db):
+    """生产环境服务器：eventlet WSGI，可启动多个工作进程"""
+    host = host or app.config.get('SERVER_HOST', '0.0.0.0')
+    port = port if port is not None else app.config.get('SERVER_PORT', 80)
+    workers = workers if workers is not None else app.config.get('SERVER_WORKERS', 1)
+    pool_size = pool_size if pool_size is not None else app.config.get('SERVER_POOL_SIZE', 1000)
+    backlog = backlog if backlog is not None else app.config.get('SERVER_BACKLOG', 2048)
+    keepalive = keepalive if keepalive is not None else app.config.get('SERVER_KEEPALIVE', 75)
+    shutdown_timeout = shutdown_timeout if shutdown_timeout is not None else app.config.get('SERVER_SHUTDOWN_TIMEOUT', 10)
+    if workers > 1:
+        queue = app.config.get('SOCKETIO_MESSAGE_QUEUE') or ''
+        if not queue or queue.startswith('local://') or not shared_state.distributed:
+            raise click.UsageError('多个工作进程需要配置 SOCKETIO_MESSAGE_QUEUE 与 SHARED_STATE_URL（Redis），并在前面使用粘性会话的负载均衡')
+    if not skip_init_db:
+        init_db()
+    if workers > 1:
+        supervise_workers(workers, host, port, pool_size, backlog, keepalive, shutdown_timeout)
+    else:
+        run_eventlet_server(host, port, pool_size, backlog, keepalive, shutdown_timeout)
+
+
+# 主程序（开发服务器：FLASK_DEBUG=1 时启用热重载与调试器；生产环境使用 flask --app app serve）
 if __name__ == '__main__':
     init_db()
     CORS(app, resources={r"/socket.io/*": {"origins": "*"}})
-    socketio.run(app, host='0.0.0.0', port=80,debug=app.config['DEBUG'])
+    if not app.config['DEBUG'] or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # 热重载时只在实际运行服务的子进程中安装，监视进程保持默认的信号处理
+        install_shutdown_handlers()
+    socketio.run(app, host=app.config.get('SERVER_HOST', '0.0.0.0'), port=app.config.get('SERVER_PORT', 80),
+                 debug=app.config['DEBUG'])
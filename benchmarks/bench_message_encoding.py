@@ -0,0 +1,118 @@
+"""聊天消息 JSON 编码基准
+
+以每 1k 条消息为单位，对比：
+- 标准库 json.dumps（Flask-SocketIO 默认的广播编码方式）与 fast_dumps（安装了 orjson 时使用 orjson）
+- 历史接口返回 1k 条消息：Flask 默认编码 vs 拼接 PreEncoded 缓存的编码结果
+- 广播 + 多次读取的完整生命周期：每次重新编码 vs 编码一次后复用
+校验各方式解码后的结果一致，不一致时以非零状态退出。
+
+用法: python benchmarks/bench_message_encoding.py
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='stellarsis_bench_'), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+import app as stellarsis  # noqa: E402
+from app import PreEncoded, SocketIOJSON, fast_dumps, json_backend  # noqa: E402
+
+MESSAGES = 1000
+READS = 10  # 每条消息在生命周期内被读取的次数（历史接口、增量读取、SSE 补发等）
+REPEAT = 20
+WORDS = ['hello', '你好', '`code`', '$x^2$', '@quote{42}', '**bold**', 'https://example.com', '测试消息', '😀']
+
+
+def build_messages():
+    random.seed(42)
+    now = datetime.utcnow()
+    messages = []
+    for i in range(MESSAGES):
+        messages.append({
+            'id': i + 1,
+            'content': ' '.join(random.choice(WORDS) for _ in range(random.randint(3, 30))),
+            'timestamp': (now - timedelta(seconds=MESSAGES - i)).isoformat(),
+            'user_id': random.randint(1, 50),
+            'username': f'user{random.randint(1, 50)}',
+            'nickname': f'昵称{random.randint(1, 50)}',
+            'color': '#000000',
+            'badge': random.choice(['', '管理员', 'VIP']),
+        })
+    return messages
+
+
+def timed(fn):
+    fn()
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn()
+    return (time.perf_counter() - start) / REPEAT
+
+
+def main():
+    messages = build_messages()
+    default_provider = DefaultJSONProvider(stellarsis.app)
+    provider = stellarsis.app.json
+    ok = True
+
+    # 单条消息编码（广播时每条消息编码一次）
+    stdlib_encode = timed(lambda: [json.dumps(['message', msg], separators=(',', ':')) for msg in messages])
+    fast_encode = timed(lambda: [SocketIOJSON.dumps(['message', msg]) for msg in messages])
+
+    # 历史接口：1k 条消息的响应体
+    cached = [PreEncoded(msg) for msg in messages]
+    for msg in cached:
+        msg.encoded
+    history_default = timed(lambda: default_provider.response(success=True, messages=messages).get_data())
+    history_cached = timed(lambda: provider.response(success=True, messages=cached).get_data())
+
+    # 完整生命周期：广播一次 + READS 次读取
+    def legacy_lifecycle():
+        for msg in messages:
+            json.dumps(['message', msg], separators=(',', ':'))
+        for _ in range(READS):
+            default_provider.response(success=True, messages=messages).get_data()
+
+    def cached_lifecycle():
+        fresh = [PreEncoded(msg) for msg in messages]
+        for msg in fresh:
+            SocketIOJSON.dumps(['message', msg])
+        for _ in range(READS):
+            provider.response(success=True, messages=fresh).get_data()
+
+    lifecycle_legacy = timed(legacy_lifecycle)
+    lifecycle_cached = timed(cached_lifecycle)
+
+    # 结果一致性
+    expected = json.loads(default_provider.response(success=True, messages=messages).get_data())
+    if json.loads(provider.response(success=True, messages=cached).get_data()) != expected:
+        print('历史接口输出不一致')
+        ok = False
+    for msg, pre in zip(messages, cached):
+        if json.loads(SocketIOJSON.dumps(['message', pre])) != ['message', msg] \
+                or json.loads(fast_dumps(msg)) != msg \
+                or json.loads(pre.extend(client_id='c1').encoded) != dict(msg, client_id='c1'):
+            print(f'消息 {msg["id"]} 编码结果不一致')
+            ok = False
+            break
+
+    backend = 'orjson' if json_backend is not None else '标准库 json（未安装 orjson）'
+    print(f'快速编码后端: {backend}')
+    print(f'单条编码（每 1k 条）: 标准库 {stdlib_encode * 1000:8.2f} ms, fast_dumps {fast_encode * 1000:8.2f} ms')
+    print(f'历史接口（1k 条）:    默认编码 {history_default * 1000:8.2f} ms, PreEncoded 拼接 {history_cached * 1000:8.2f} ms')
+    print(f'广播 + {READS} 次读取（每 1k 条）: 每次重新编码 {lifecycle_legacy * 1000:8.2f} ms, '
+          f'编码一次后复用 {lifecycle_cached * 1000:8.2f} ms')
+    print('结果一致' if ok else '结果不一致')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
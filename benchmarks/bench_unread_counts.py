@@ -0,0 +1,155 @@
+"""未读数统计回归基准
+
+在临时 SQLite 数据库中写入 40 个聊天室、20 个贴吧分区和 10k 条聊天消息，
+对比旧的逐房间循环实现与 compute_unread_counts 的查询次数和耗时，
+并校验两者结果一致。查询次数超过上限时以非零状态退出。
+
+用法: python benchmarks/bench_unread_counts.py
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='stellarsis_bench_'), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+import app as stellarsis  # noqa: E402
+from app import (  # noqa: E402
+    db_session, engine, User, ChatRoom, ChatMessage, ChatPermission, ChatLastView,
+    ForumSection, ForumThread, ForumReply, ForumPermission, ForumLastView,
+    get_chat_permission_value, get_forum_permission_value, compute_unread_counts
+)
+
+ROOMS = 40
+SECTIONS = 20
+MESSAGES = 10000
+THREADS = 400
+REPLIES = 2000
+MAX_QUERIES = 10
+
+
+def seed():
+    random.seed(42)
+    user = User(username='bench_user', nickname='bench', role='user')
+    user.set_password('bench123')
+    db_session.add(user)
+    rooms = [ChatRoom(name=f'bench_room_{i}', description='') for i in range(ROOMS)]
+    sections = [ForumSection(name=f'bench_section_{i}', description='') for i in range(SECTIONS)]
+    db_session.add_all(rooms + sections)
+    db_session.commit()
+
+    now = datetime.utcnow()
+    db_session.bulk_insert_mappings(ChatMessage, [{
+        'content': f'message {i}',
+        'timestamp': now - timedelta(seconds=MESSAGES - i),
+        'user_id': user.id,
+        'room_id': random.choice(rooms).id
+    } for i in range(MESSAGES)])
+    db_session.bulk_insert_mappings(ForumThread, [{
+        'title': f'thread {i}',
+        'content': '',
+        'timestamp': now - timedelta(seconds=THREADS - i),
+        'user_id': user.id,
+        'section_id': random.choice(sections).id
+    } for i in range(THREADS)])
+    db_session.commit()
+    thread_ids = [t.id for t in db_session.query(ForumThread.id)]
+    db_session.bulk_insert_mappings(ForumReply, [{
+        'content': f'reply {i}',
+        'timestamp': now - timedelta(seconds=REPLIES - i),
+        'user_id': user.id,
+        'thread_id': random.choice(thread_ids)
+    } for i in range(REPLIES)])
+
+    for room in rooms:
+        db_session.add(ChatPermission(user_id=user.id, room_id=room.id, perm='777'))
+        if random.random() < 0.5:
+            db_session.add(ChatLastView(user_id=user.id, room_id=room.id,
+                                        last_view=now - timedelta(seconds=random.randint(0, MESSAGES))))
+    for section in sections:
+        db_session.add(ForumPermission(user_id=user.id, section_id=section.id, perm='444'))
+        if random.random() < 0.5:
+            db_session.add(ForumLastView(user_id=user.id, section_id=section.id,
+                                         last_view=now - timedelta(seconds=random.randint(0, THREADS))))
+    db_session.commit()
+    return user
+
+
+def legacy_unread_counts(user):
+    """旧实现：每个房间/分区分别查询权限、最后查看时间和计数"""
+    chat_counts = {}
+    for room in db_session.query(ChatRoom).all():
+        if get_chat_permission_value(user, room.id) == 'Null':
+            continue
+        last = db_session.query(ChatLastView).filter_by(user_id=user.id, room_id=room.id).first()
+        if last:
+            cnt = db_session.query(ChatMessage).filter(ChatMessage.room_id == room.id, ChatMessage.timestamp > last.last_view).count()
+        else:
+            cnt = db_session.query(ChatMessage).filter_by(room_id=room.id).count()
+        chat_counts[room.id] = cnt
+
+    forum_counts = {}
+    for section in db_session.query(ForumSection).all():
+        if get_forum_permission_value(user, section.id) == 'Null':
+            continue
+        last = db_session.query(ForumLastView).filter_by(user_id=user.id, section_id=section.id).first()
+        replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id) \
+            .filter(ForumThread.section_id == section.id)
+        threads = db_session.query(ForumThread).filter(ForumThread.section_id == section.id)
+        if last:
+            threads = threads.filter(ForumThread.timestamp > last.last_view)
+            replies = replies.filter(ForumReply.timestamp > last.last_view)
+        forum_counts[section.id] = threads.count() + replies.count()
+    return chat_counts, forum_counts
+
+
+def measure(fn, user, repeat=20):
+    queries = [0]
+
+    def count_query(*args, **kwargs):
+        queries[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count_query)
+    try:
+        db_session.expire_all()
+        result = fn(user)
+        per_call_queries = queries[0]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            db_session.expire_all()
+            fn(user)
+        elapsed = (time.perf_counter() - start) / repeat
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_query)
+    return result, per_call_queries, elapsed
+
+
+def main():
+    user = seed()
+
+    (legacy_chat, legacy_forum), legacy_queries, legacy_time = measure(legacy_unread_counts, user)
+    unread, new_queries, new_time = measure(compute_unread_counts, user)
+
+    print(f'数据规模: {ROOMS} 聊天室, {SECTIONS} 分区, {MESSAGES} 条消息, {THREADS} 主题, {REPLIES} 回复')
+    print(f'旧实现: {legacy_queries:4d} 次查询, {legacy_time * 1000:8.2f} ms/次')
+    print(f'新实现: {new_queries:4d} 次查询, {new_time * 1000:8.2f} ms/次')
+
+    ok = True
+    if unread['chat_counts'] != legacy_chat or unread['forum_counts'] != legacy_forum:
+        print('错误: 新旧实现的未读数不一致')
+        ok = False
+    if new_queries > MAX_QUERIES:
+        print(f'错误: 查询次数 {new_queries} 超过上限 {MAX_QUERIES}')
+        ok = False
+    stellarsis.db_session.remove()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,9 +8,61 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///stellarsis.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    DEBUG = True  # 用于热重载
+    # 数据库连接池
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = 30  # 等待空闲连接的最长时间（秒）
+    DB_POOL_RECYCLE = 3600  # 连接最长复用时间（秒）
+    # SQLite 连接参数（每个新连接建立时通过 PRAGMA 设置）
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')  # WAL 模式下读写互不阻塞
+    SQLITE_SYNCHRONOUS = 'NORMAL'  # WAL 模式下 NORMAL 即可保证数据库不损坏
+    SQLITE_BUSY_TIMEOUT = 5000  # 数据库被锁时的等待时间（毫秒）
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # 内存映射读取大小（字节）
+    SQLITE_CACHE_SIZE = -64000  # 页缓存大小，负数表示 KB，即 64MB
+    DEBUG = os.environ.get('FLASK_DEBUG', '0').lower() in ('1', 'true', 'yes')  # 调试模式（热重载、调试器），生产环境保持关闭
+    # 生产服务器 `flask --app app serve` 的默认参数（命令行参数优先）
+    SERVER_HOST = os.environ.get('HOST', '0.0.0.0')
+    SERVER_PORT = int(os.environ.get('PORT', 80))
+    SERVER_WORKERS = int(os.environ.get('WEB_WORKERS', 1))  # 工作进程数，大于 1 时需要配置消息队列与共享状态
+    SERVER_POOL_SIZE = int(os.environ.get('WEB_POOL_SIZE', 1000))  # 每个工作进程的 eventlet 协程池大小（同时处理的连接数）
+    SERVER_BACKLOG = int(os.environ.get('WEB_BACKLOG', 2048))  # 监听 socket 的连接队列长度
+    SERVER_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', 75))  # HTTP keep-alive 空闲超时（秒），0 表示每个请求后关闭连接
+    SERVER_SHUTDOWN_TIMEOUT = int(os.environ.get('WEB_SHUTDOWN_TIMEOUT', 10))  # 收到终止信号后等待进行中的请求结束的最长时间（秒）
     SOCKETIO_ASYNC_MODE = 'eventlet'
-    ONLINE_TIMEOUT = 30  # 30秒无活动视为离线
+    # 多进程部署：Socket.IO 消息队列（如 redis://localhost:6379/0），房间广播经它送达所有工作进程；
+    # local:// 为进程内替身，仅用于单机验证。未配置时为单进程模式
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'stellarsis')
+    # 发送限流、验证码与聊天室在线状态的存放位置：local 为进程内存（单进程），多进程时使用 redis://...
+    SHARED_STATE_URL = os.environ.get('SHARED_STATE_URL', 'local')
+    SHARED_STATE_PREFIX = os.environ.get('SHARED_STATE_PREFIX', 'stellarsis:')  # Redis 键名与频道前缀
+    ONLINE_TIMEOUT = 30  # 30秒无活动视为离线（Socket.IO 心跳 25 秒、轮询客户端 15 秒刷新一次，须小于该值）
+    ROSTER_BROADCAST_WINDOW_MS = 1000  # 在线名单变化的合并广播窗口（毫秒），0 表示立即广播
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 15))  # last_seen / 最后查看时间合并写入间隔（秒），0 表示立即写入
+    ONLINE_RECONCILE_INTERVAL = 60  # 全站在线人数与数据库 last_seen 的校准间隔（秒）
+    # 聊天消息写后模式：先分配ID并广播，后台批量写库；关闭时每条消息同步提交
+    CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
+    CHAT_WRITE_BEHIND_INTERVAL_MS = 200  # 批量写入间隔（毫秒）
+    CHAT_WRITE_BEHIND_BATCH_SIZE = 100  # 累计达到该条数时立即写入
+    CHAT_WRITE_BEHIND_MAX_RETRIES = 50  # 单条消息写入失败后的最多重试次数（约为 重试次数 × 写入间隔），超过后丢弃并记录
+    CHAT_RECENT_CACHE_SIZE = 200  # 每个聊天室在内存中保留的最近消息条数（用于 page=last 与增量读取），0 表示关闭
+    # 安装了 orjson 时用它编码聊天消息与 Socket.IO 数据包（未安装时使用标准库 json）
+    JSON_FAST_BACKEND = os.environ.get('JSON_FAST_BACKEND', '1').lower() in ('1', 'true', 'yes')
+    CHAT_TOMBSTONE_LOG_SIZE = 1000  # 内存中保留的消息删除记录条数，供轮询客户端同步删除
+    # 聊天室事件流（SSE）：保活注释间隔（秒）、客户端重连间隔（毫秒）、单个连接允许积压的事件数
+    SSE_KEEPALIVE_INTERVAL = 15
+    SSE_RETRY_MS = 3000
+    SSE_MAX_QUEUE = 500
+    # 聊天发送令牌桶限流：最多连续发送 SEND_RATE_BURST 条，之后每秒恢复 SEND_RATE_REFILL_PER_SEC 条，桶空时要求验证码
+    SEND_RATE_BURST = int(os.environ.get('SEND_RATE_BURST', 5))
+    SEND_RATE_REFILL_PER_SEC = float(os.environ.get('SEND_RATE_REFILL_PER_SEC', 1.4))
+    # 验证码与发送频率记录的容量上限（超出时淘汰最久未使用的条目）及过期清理间隔（秒）
+    CAPTCHA_STORE_MAX_SIZE = 10000
+    SEND_RATE_STORE_MAX_SIZE = 10000
+    MEMORY_STORE_SWEEP_INTERVAL = 60
+    USER_PROFILE_CACHE_TTL = 300  # Socket.IO 事件使用的用户资料缓存兜底过期时间（秒），资料修改时会主动失效
+    USER_PROFILE_CACHE_SIZE = 10000
+    PERMISSION_CACHE_TTL = 300  # 权限缓存兜底过期时间（秒），权限变更时会主动失效
     # 图片上传相关配置
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join('static', 'uploads')
     ALLOWED_IMAGE_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'webp'])
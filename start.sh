@@ -1 +1,2 @@
-venv/bin/python app.py
+# 生产环境启动，参数透传给 serve，例如：./start.sh --port 8000 --workers 4
+exec venv/bin/flask --app app serve "$@"
@@ -6,6 +6,7 @@ let chatTotalPages = null;
 let followedUserIds = new Set();  // 关注的用户ID集合
 let lastMessageId = 0;
 let onlineUsers = [];
+let rosterVersion = null; // 在线名单版本号，用于校验增量更新是否连续
 let roomPermission = 'Null';
 let isScrolledToBottom = true; // 跟踪是否滚动到底部
 let newMessagesCount = 0; // 新消息计数
@@ -447,6 +448,8 @@ function loadChatHistory() {
                         btn.className = 'btn';
                         btn.dataset.currentPage = chatCurrentPage;
                         btn.dataset.totalPages = chatTotalPages;
+                        // 服务器提供游标时，使用游标向前加载（避免大 OFFSET 查询）
+                        btn.dataset.cursor = data.prev_cursor || '';
                         btn.textContent = '加载更多';
 
                         // Determine initial visibility based on has_more field
@@ -472,9 +475,13 @@ function loadChatHistory() {
                         btn.addEventListener('click', function () {
                             const cur = parseInt(btn.dataset.currentPage || '0', 10);
                             const nextPage = cur - 1;
+                            const cursor = btn.dataset.cursor;
+                            const url = cursor
+                                ? `/api/chat/${roomId}/history?before=${encodeURIComponent(cursor)}&limit=${pageSize}`
+                                : `/api/chat/${roomId}/history?page=${nextPage}&limit=${pageSize}`;
 
                             btn.disabled = true; btn.textContent = '加载中...';
-                            fetch(`/api/chat/${roomId}/history?page=${nextPage}&limit=${pageSize}`)
+                            fetch(url)
                                 .then(r => { if (!r.ok) throw new Error('加载失败'); return r.json(); })
                                 .then(d => {
                                     if (d && Array.isArray(d.messages)) {
@@ -488,8 +495,12 @@ function loadChatHistory() {
                                         messagesContainer.scrollTop = prevScrollTop + heightDiff;
                                         btn.dataset.currentPage = nextPage;
 
-                                        // Use the new has_more field to determine if we should show the button
-                                        if (d.has_more !== undefined) {
+                                        if (cursor) {
+                                            // 游标模式下 has_more 表示是否还有更早的消息
+                                            btn.dataset.cursor = d.prev_cursor || '';
+                                            btn.style.display = d.has_more && d.prev_cursor ? '' : 'none';
+                                        } else if (d.has_more !== undefined) {
+                                            // Use the new has_more field to determine if we should show the button
                                             // Server provides has_more field, use it
                                             if (d.has_more) {
                                                 btn.style.display = '';
@@ -539,127 +550,224 @@ function loadChatHistory() {
         });
 }
 
+// 处理轮询或事件流收到的服务器消息：匹配本地 pending 或作为新消息显示，已处理过的返回 false
+function applyServerMessage(msg) {
+    // skip if we've already processed this server id
+    if (msg.id && processedMessageIds.has(msg.id)) return false;
+
+    // Try to match this server message to a pending local message
+    let matched = false;
+    const serverContent = msg.content || msg.message || '';
+    const serverTsMs = msg.timestamp ? new Date(msg.timestamp).getTime() : Date.now();
+
+    if (serverContent && pendingMessages.size > 0) {
+        for (const [cid, pending] of pendingMessages.entries()) {
+            try {
+                // Exact content match + reasonable time window (30s)
+                const pendingSent = pending.sentTime || pending.timestamp || 0;
+                // allow match when content equals and timestamps within 30s OR the calendar date matches (tolerate timezone differences)
+                const serverDateIso = new Date(serverTsMs).toISOString().slice(0, 10);
+                const pendingDateIso = new Date(pendingSent).toISOString().slice(0, 10);
+                if (pending.content === serverContent && (Math.abs(serverTsMs - pendingSent) < 30000 || serverDateIso === pendingDateIso)) {
+                    console.debug('Polling matched pending by content/time (or same-date)', cid, '->', msg.id, 'serverDate=', serverDateIso, 'pendingDate=', pendingDateIso);
+                    updateExistingMessage(cid, msg);
+                    pendingMessages.delete(cid);
+                    processedMessageIds.add(msg.id || cid);
+                    matched = true;
+                    break;
+                }
+
+                // Fallback: compare simplified content/time hash
+                const pendingHash = generateContentHash(pending.content || '', pending.timestamp || pending.sentTime || Date.now());
+                const serverHash = generateContentHash(serverContent, msg.timestamp || Date.now());
+                if (pendingHash === serverHash) {
+                    console.debug('Polling matched pending by hash', cid, '->', msg.id);
+                    updateExistingMessage(cid, msg);
+                    pendingMessages.delete(cid);
+                    processedMessageIds.add(msg.id || cid);
+                    matched = true;
+                    break;
+                }
+            } catch (e) {
+                console.debug('Polling pending match error for', cid, e);
+            }
+        }
+    }
+
+    if (!matched) {
+        // New message for UI
+        addMessageToUI(msg, 0, 0);
+        if (msg.id) processedMessageIds.add(msg.id);
+    }
+
+    // 更新最后一条消息ID
+    if (msg.id && msg.id > lastMessageId) {
+        lastMessageId = msg.id;
+    }
+    return true;
+}
+
+// 收到新消息后：在底部时跟随滚动，否则显示新消息提示
+function followNewMessages(messagesContainer) {
+    // 检查当前是否滚动到底部
+    const currentScrollTop = messagesContainer.scrollTop;
+    const currentScrollHeight = messagesContainer.scrollHeight;
+    const currentClientHeight = messagesContainer.clientHeight;
+    const isCurrentlyAtBottom = Math.abs(currentScrollHeight - currentScrollTop - currentClientHeight) < 5;
+    
+    // 更新滚动状态
+    isScrolledToBottom = isCurrentlyAtBottom;
+
+    // 如果当前滚动到底部，则滚动到最新消息
+    if (isScrolledToBottom) {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    } else {
+        // 如果未滚动到底部，显示新消息提示
+        newMessagesCount++;
+        showNewMessageNotification();
+    }
+}
+
+// 按服务器消息ID标记删除，返回是否找到对应元素
+function removeMessageById(mid) {
+    const el = document.querySelector('[data-message-id="' + mid + '"]');
+    if (!el) return false;
+    try {
+        markMessageRemoved(el);
+    } catch (e) {
+        if (el.parentNode) el.parentNode.removeChild(el);
+    }
+    return true;
+}
+
+// 处理批量删除事件：all 为 true 时清除当前显示的全部服务器消息，否则按 ids 逐条标记
+function applyBulkDeletion(data) {
+    if (!data || Number(data.room_id) !== Number(roomId)) return;
+    if (data.resync) {
+        // 服务器无法给出准确的删除范围，重新加载页面
+        location.reload();
+        return;
+    }
+    // 整个房间被清空，或按日期删除了 ID 不大于 before_id 的全部消息
+    document.querySelectorAll('[data-message-id]').forEach(function (el) {
+        const mid = el.dataset.messageId;
+        // 跳过本地 pending 客户端ID
+        if (!mid || mid.indexOf('client-') === 0 || mid.indexOf('sent-') === 0) return;
+        if (data.all || Number(mid) <= data.before_id) removeMessageById(mid);
+    });
+}
+
+// 事件流（Server-Sent Events）：服务器有事件时立即推送，空闲时不产生查询；不可用时退回轮询
+function setupEventStream() {
+    console.log('使用事件流作为WebSocket的降级方案');
+    const source = new EventSource(`/api/chat/${roomId}/events?last_id=${lastMessageId || 0}`);
+    // 与 Socket.IO 相同的 on(event, handler) 接口，复用已有的事件处理函数
+    const adapter = {
+        on: function (event, handler) {
+            source.addEventListener(event, function (e) {
+                try {
+                    handler(JSON.parse(e.data));
+                } catch (err) {
+                    console.error('处理事件流消息失败', event, err);
+                }
+            });
+        }
+    };
+
+    adapter.on('message', function (msg) {
+        if (!applyServerMessage(msg)) return;
+        const messagesContainer = document.getElementById('chat-messages');
+        if (messagesContainer) followNewMessages(messagesContainer);
+    });
+    setupMessageUpdatedHandler(adapter);
+    adapter.on('message_deleted', function (data) {
+        if (data && Number(data.room_id) === Number(roomId)) removeMessageById(data.id);
+    });
+    adapter.on('messages_deleted', applyBulkDeletion);
+
+    source.onerror = function () {
+        // 浏览器会自动重连（携带 Last-Event-ID）；连接被彻底关闭时改用轮询
+        if (source.readyState === EventSource.CLOSED) {
+            source.close();
+            eventStreamFailed = true;
+            pollingStarted = false;
+            setupPolling();
+        }
+    };
+}
+
 // 设置轮询（老旧浏览器降级方案）
+// 只向服务器请求 lastMessageId 之后的新消息和删除记录；没有变化时逐步拉长间隔，有变化时恢复
+const POLL_MIN_INTERVAL = 2000;
+const POLL_MAX_INTERVAL = 30000;
+let pollingStarted = false;
+let pollInterval = POLL_MIN_INTERVAL;
+let tombstoneCursor = '';
+let eventStreamFailed = false;
+let onlineStatusTimer = null;
+// 轮询/SSE 客户端没有心跳，靠在线人数请求刷新在线状态；间隔必须明显短于服务器的 ONLINE_TIMEOUT（30秒），
+// 否则每次清理都会把用户移出名单又重新加入
+const ONLINE_STATUS_INTERVAL = 15000;
+
 function setupPolling() {
+    if (pollingStarted) return;
+    pollingStarted = true;
+    // 每15秒更新在线状态
+    if (!onlineStatusTimer) onlineStatusTimer = setInterval(updateOnlineStatus, ONLINE_STATUS_INTERVAL);
+    if (window.EventSource && !eventStreamFailed) {
+        setupEventStream();
+        return;
+    }
     console.log('使用轮询作为WebSocket的降级方案');
 
-    // 每5秒检查一次新消息
-    setInterval(() => {
-        if (lastMessageId > 0) {
-            fetch(`/api/chat/${roomId}/history?offset=0&limit=50`)
-                .then(response => response.json())
-                .then(data => {
-                    const messagesContainer = document.getElementById('chat-messages');
-                    if (!messagesContainer) return;
-                    let hasNewMessages = false;
-                    data.messages.forEach(msg => {
-                        // skip if we've already processed this server id
-                        if (msg.id && processedMessageIds.has(msg.id)) return;
-
-                        // Try to match this server message to a pending local message
-                        let matched = false;
-                        const serverContent = msg.content || msg.message || '';
-                        const serverTsMs = msg.timestamp ? new Date(msg.timestamp).getTime() : Date.now();
-
-                        if (serverContent && pendingMessages.size > 0) {
-                            for (const [cid, pending] of pendingMessages.entries()) {
-                                try {
-                                    // Exact content match + reasonable time window (30s)
-                                    const pendingSent = pending.sentTime || pending.timestamp || 0;
-                                    // allow match when content equals and timestamps within 30s OR the calendar date matches (tolerate timezone differences)
-                                    const serverDateIso = new Date(serverTsMs).toISOString().slice(0, 10);
-                                    const pendingDateIso = new Date(pendingSent).toISOString().slice(0, 10);
-                                    if (pending.content === serverContent && (Math.abs(serverTsMs - pendingSent) < 30000 || serverDateIso === pendingDateIso)) {
-                                        console.debug('Polling matched pending by content/time (or same-date)', cid, '->', msg.id, 'serverDate=', serverDateIso, 'pendingDate=', pendingDateIso);
-                                        updateExistingMessage(cid, msg);
-                                        pendingMessages.delete(cid);
-                                        processedMessageIds.add(msg.id || cid);
-                                        matched = true;
-                                        break;
-                                    }
+    function scheduleNextPoll(changed) {
+        pollInterval = changed ? POLL_MIN_INTERVAL : Math.min(pollInterval * 2, POLL_MAX_INTERVAL);
+        setTimeout(pollOnce, pollInterval);
+    }
 
-                                    // Fallback: compare simplified content/time hash
-                                    const pendingHash = generateContentHash(pending.content || '', pending.timestamp || pending.sentTime || Date.now());
-                                    const serverHash = generateContentHash(serverContent, msg.timestamp || Date.now());
-                                    if (pendingHash === serverHash) {
-                                        console.debug('Polling matched pending by hash', cid, '->', msg.id);
-                                        updateExistingMessage(cid, msg);
-                                        pendingMessages.delete(cid);
-                                        processedMessageIds.add(msg.id || cid);
-                                        matched = true;
-                                        break;
-                                    }
-                                } catch (e) {
-                                    console.debug('Polling pending match error for', cid, e);
-                                }
-                            }
-                        }
+    function pollOnce() {
+        let url = `/api/chat/${roomId}/since/${lastMessageId || 0}`;
+        if (tombstoneCursor) url += `?tombstones=${encodeURIComponent(tombstoneCursor)}`;
+        fetch(url)
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP错误! 状态: ${response.status}`);
+                return response.json();
+            })
+            .then(data => {
+                tombstoneCursor = data.tombstones || tombstoneCursor;
+                if (data.resync) {
+                    // 服务器发生了批量删除或重启，增量记录不可用，重新加载页面
+                    location.reload();
+                    return;
+                }
+                const messagesContainer = document.getElementById('chat-messages');
+                if (!messagesContainer) return scheduleNextPoll(false);
+                let hasNewMessages = false;
+                data.messages.forEach(msg => {
+                    if (applyServerMessage(msg)) hasNewMessages = true;
+                });
+                // 已通过其他途径显示过的消息也要推进游标，避免重复拉取
+                if (data.last_id && data.last_id > lastMessageId) {
+                    lastMessageId = data.last_id;
+                }
 
-                        if (!matched) {
-                            // New message for UI
-                            addMessageToUI(msg, 0, 0);
-                            if (msg.id) processedMessageIds.add(msg.id);
-                            hasNewMessages = true;
-                        } else {
-                            // matched — still update lastMessageId if necessary
-                            hasNewMessages = true;
-                        }
+                // 服务器返回的删除记录（墓碑）
+                let hasDeletions = false;
+                (data.deleted || []).forEach(function (mid) {
+                    if (removeMessageById(mid)) hasDeletions = true;
+                });
 
-                        // 更新最后一条消息ID
-                        if (msg.id && msg.id > lastMessageId) {
-                            lastMessageId = msg.id;
-                        }
-                    });
+                if (hasNewMessages) followNewMessages(messagesContainer);
 
-                    // 检测服务器上已不存在但客户端仍然显示的消息（标记为已删除）
-                    try {
-                        const serverIds = new Set((data.messages || []).filter(m => m && m.id).map(m => String(m.id)));
-                        document.querySelectorAll('[data-message-id]').forEach(function (el) {
-                            try {
-                                const mid = el.dataset.messageId;
-                                if (!mid) return;
-                                // 跳过本地 pending 客户端ID
-                                if (mid.indexOf('client-') === 0 || mid.indexOf('sent-') === 0) return;
-                                if (!serverIds.has(String(mid))) {
-                                    // 标记为已删除（幂等操作，避免重复插入）
-                                    try {
-                                        markMessageRemoved(el);
-                                    } catch (e) {
-                                        if (el.parentNode) el.parentNode.removeChild(el);
-                                    }
-                                }
-                            } catch (e) { /* ignore per-element errors */ }
-                        });
-                    } catch (e) { console.debug('轮询删除检测失败', e); }
-
-                    if (hasNewMessages) {
-                        // 检查当前是否滚动到底部
-                        const currentScrollTop = messagesContainer.scrollTop;
-                        const currentScrollHeight = messagesContainer.scrollHeight;
-                        const currentClientHeight = messagesContainer.clientHeight;
-                        const isCurrentlyAtBottom = Math.abs(currentScrollHeight - currentScrollTop - currentClientHeight) < 5;
-                        
-                        // 更新滚动状态
-                        isScrolledToBottom = isCurrentlyAtBottom;
-
-                        // 如果当前滚动到底部，则滚动到最新消息
-                        if (isScrolledToBottom) {
-                            messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                        } else {
-                            // 如果未滚动到底部，显示新消息提示
-                            newMessagesCount++;
-                            showNewMessageNotification();
-                        }
-                    }
-                })
-                .catch(error => {
-                    console.error('轮询获取消息失败:', error);
-                });
-        }
-    }, 5000);
+                scheduleNextPoll(hasNewMessages || hasDeletions || data.has_more);
+            })
+            .catch(error => {
+                console.error('轮询获取消息失败:', error);
+                scheduleNextPoll(false);
+            });
+    }
 
-    // 每30秒更新在线状态
-    setInterval(updateOnlineStatus, 30000);
+    setTimeout(pollOnce, POLL_MIN_INTERVAL);
 }
 
 // Developer helper: toggle websocket fallback simulation from console
@@ -703,7 +811,7 @@ function setupWebSocket() {
             if (chatSocket && chatSocket.connected) {
                 chatSocket.emit('heartbeat_chat', { room_id: roomId });
             }
-        }, 5000);
+        }, 25000); // 连接断开由服务器立即处理，心跳只用于刷新最后活动时间
         if (chatSocket && chatSocket.connected) {
             chatSocket.emit('heartbeat_chat', { room_id: roomId });
         }
@@ -711,13 +819,11 @@ function setupWebSocket() {
             console.log('WebSocket连接已建立');
             updateConnectionStatus('connected', '已连接');
             if (!chatSocket.hasJoinedRoom) {
-                // 重新加入房间
+                // 重新加入房间：断开时服务器已清理旧连接的房间与在线状态，新连接必须重新加入
+                // 服务器在加入后推送完整在线名单，之后只推送增量；重连期间可能错过增量，丢弃旧版本号
+                rosterVersion = null;
                 chatSocket.emit('join', { room: roomId });
                 chatSocket.hasJoinedRoom = true;
-                // 重新获取在线人数
-                setTimeout(() => {
-                    chatSocket.emit('get_online_users', { room_id: roomId });
-                }, 1000);
             }
             if (!chatSocket.hasJoinedRoom) {
                 // 加载关注列表
@@ -743,6 +849,8 @@ function setupWebSocket() {
 
         chatSocket.on('disconnect', (reason) => {
             console.log('WebSocket断开连接:', reason);
+            // 服务器在断开时移除该连接的房间，重连后需要重新 join
+            chatSocket.hasJoinedRoom = false;
             const onlineCountElement = document.getElementById('online-count');
             if (onlineCountElement) {
                 onlineCountElement.textContent = '连接中...';
@@ -863,13 +971,35 @@ function setupWebSocket() {
             } catch (e) { console.error('处理 message_deleted 失败', e); }
         });
 
+        // 管理员批量删除：一个事件携带整批消息
+        chatSocket.on('messages_deleted', function (data) {
+            try {
+                applyBulkDeletion(data);
+            } catch (e) { console.error('处理 messages_deleted 失败', e); }
+        });
+
         chatSocket.on('online_users', (data) => {
             onlineUsers = data.users || [];
+            rosterVersion = typeof data.version === 'number' ? data.version : null;
+            updateOnlineCount();
+        });
+
+        // 在线名单增量：版本号必须连续，否则重新请求完整快照
+        chatSocket.on('online_users_delta', (data) => {
+            if (!data || data.room_id != roomId || rosterVersion === null) return;
+            if (data.version <= rosterVersion) return;
+            if (data.version !== rosterVersion + 1) {
+                rosterVersion = null;
+                chatSocket.emit('get_online_users', { room_id: roomId });
+                return;
+            }
+            const left = new Set(data.left || []);
+            const joined = data.joined || [];
+            const joinedIds = new Set(joined.map(u => u.id));
+            onlineUsers = onlineUsers.filter(u => !left.has(u.id) && !joinedIds.has(u.id)).concat(joined);
+            rosterVersion = data.version;
             updateOnlineCount();
         });
-        window.updateOnlineCountInterval = setInterval(() => {
-            chatSocket.emit('get_online_users', { room_id: roomId });
-        }, 5000);
 
         // 监听用户进出事件（用于关注通知） - 使用 addMessageToUI 以利用已存在的系统事件去重逻辑
         chatSocket.on('user_join', (data) => {
@@ -929,7 +1059,8 @@ function toggleFollowUser(userId) {
 // 3. 修复updateOnlineStatus函数
 function updateOnlineStatus() {
     if (chatSocket && chatSocket.connected) {
-        chatSocket.emit('get_online_users', { room_id: roomId });
+        // WebSocket 模式下在线名单由服务器增量推送
+        return;
     } else {
         // 轮询模式下，获取特定房间的在线人数
         fetch(`/api/chat/${roomId}/online_count`)
@@ -1083,22 +1214,10 @@ function sendMessage() {
         }, 50);
     } else {
         // WebSocket不可用，使用AJAX
-        fetch('/api/chat/send', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                room_id: roomId,
-                message: message
-            })
+        postChatMessage({
+            room_id: roomId,
+            message: message
         })
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('发送消息失败');
-                }
-                return response.json();
-            })
             .then(data => {
                 if (data.success) {
                     // 消息发送成功后，添加到UI
@@ -1132,6 +1251,35 @@ function sendMessage() {
     }
 }
 
+// 通过 HTTP 发送消息；发送过快时服务器返回 429 和验证码，答题后带 captcha_id 重新提交
+function postChatMessage(payload) {
+    return fetch('/api/chat/send', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(payload)
+    })
+        .then(response => response.json().catch(() => ({})).then(data => ({ response, data })))
+        .then(({ response, data }) => {
+            if (response.status === 429 && data.require_captcha) {
+                const answer = window.prompt(data.question || '请输入验证码');
+                if (answer === null) {
+                    return data;
+                }
+                return postChatMessage({
+                    room_id: roomId,
+                    captcha_id: data.captcha_id,
+                    captcha_answer: answer.trim()
+                });
+            }
+            if (!response.ok) {
+                throw new Error(data.message || '发送消息失败');
+            }
+            return data;
+        });
+}
+
 // 设置消息输入
 function setupMessageInput() {
     const sendButton = document.getElementById('send-button');
@@ -2055,13 +2203,7 @@ window.initChat = function () {
                 if (chatSocket.connected) {
                     chatSocket.emit('heartbeat_chat', { room_id: roomId });
                 }
-            }, 5000);
-
-            window.updateOnlineCountInterval = setInterval(() => {
-                if (chatSocket.connected) {
-                    chatSocket.emit('get_online_users', { room_id: roomId });
-                }
-            }, 5000);
+            }, 25000);
         }
         console.log('聊天系统初始化完成');
     } catch (e) {